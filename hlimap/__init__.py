@@ -62,6 +62,12 @@ ImapServer.refresh_folders(subscribed = True) - Extracts the folder list from
             want to access a single folder, we simply select it, so it's not
             necessary to retrieve the complete list.
 
+ImapServer.invalidate_folders() - Discards the folder list, also from the
+            folder cache if the ImapServer was created with one (see
+            hlimap.cache). The folder list is cached between ImapServer
+            instances, create_folder, delete_folder, rename_folder,
+            subscribe and unsubscribe invalidate it.
+
 ImapServer.set_folder_iterator() -  Sets the iterator to use when going through
             the folders. There are available several iterators defined on the
             FolderTree class.
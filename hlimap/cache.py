@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+# hlimap - High level IMAP library
+# Copyright (C) 2008 Helder Guerreiro
+
+# This file is part of hlimap.
+#
+# hlimap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# hlimap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@tretas.org>
+#
+
+'''Cache used to keep data between ImapServer instances.
+
+The cache objects have the same interface as the Django cache objects (get,
+set and delete), so when hlimap is used within Django a Django cache can be
+used instead of TTLCache.
+'''
+
+# Global imports
+import threading
+import time
+
+
+class TTLCache(object):
+    '''In memory cache, the entries expire after a given time.
+
+    @param timeout: default entry lifetime, in seconds;
+    @param max_entries: maximum number of entries, when it's reached the
+        expired entries are removed, and if that isn't enough the oldest ones.
+    '''
+
+    def __init__(self, timeout=300, max_entries=1000):
+        self.timeout = timeout
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.data = {}
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                expires, value = self.data[key]
+            except KeyError:
+                return default
+            if expires is not None and expires <= time.monotonic():
+                del self.data[key]
+                return default
+            return value
+
+    def set(self, key, value, timeout=None):
+        '''Stores a value.
+
+        @param timeout: lifetime in seconds, if None the default one is used.
+        '''
+        if timeout is None:
+            timeout = self.timeout
+        expires = time.monotonic() + timeout if timeout else None
+        with self.lock:
+            if key not in self.data and len(self.data) >= self.max_entries:
+                self._cull()
+            self.data[key] = (expires, value)
+
+    def get_many(self, keys):
+        '''Returns a dict with the keys found on the cache'''
+        result = {}
+        for key in keys:
+            value = self.get(key, self)
+            if value is not self:
+                result[key] = value
+        return result
+
+    def set_many(self, data, timeout=None):
+        for key, value in data.items():
+            self.set(key, value, timeout)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data = {}
+
+    def _cull(self):
+        now = time.monotonic()
+        for key, (expires, value) in list(self.data.items()):
+            if expires is not None and expires <= now:
+                del self.data[key]
+        while len(self.data) >= self.max_entries:
+            del self.data[min(self.data, key=lambda Xi: self.data[Xi][0] or
+                              float('inf'))]
+
+    def __len__(self):
+        return len(self.data)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+# hlimap - High level IMAP library
+# Copyright (C) 2008 Helder Guerreiro
+
+# This file is part of hlimap.
+#
+# hlimap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# hlimap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@tretas.org>
+#
+
+'''Measures the round trips and bytes used by the common hlimap paths,
+using the fake IMAP server.
+
+Usage: python3 -m hlimap.examples.fakeserver_example [-m messages]
+    [-l latency in ms] [-b bandwidth in bytes/s]
+'''
+
+import time
+
+import imaplib2.imapll
+import imaplib2.imapp
+from imaplib2.fakeserver import FakeIMAPServer, DEFAULT_MAILBOXES
+import hlimap
+
+imaplib2.imapll.Debug = 0
+imaplib2.imapp.Debug = 0
+
+
+def measure(server, description, function):
+    server.stats.reset()
+    start = time.time()
+    function()
+    elapsed = time.time() - start
+    stats = server.stats.snapshot()
+    print('%-32s %6d %10d %10d %8.3f' % (description, stats['round_trips'],
+                                         stats['bytes_received'],
+                                         stats['bytes_sent'], elapsed))
+
+
+if __name__ == '__main__':
+    import getopt
+    import sys
+
+    try:
+        optlist, args = getopt.getopt(sys.argv[1:], 'm:l:b:')
+    except getopt.error as val:
+        print(__doc__)
+        sys.exit(1)
+    options = dict(optlist)
+
+    mailboxes = dict(DEFAULT_MAILBOXES)
+    mailboxes['INBOX'] = int(options.get('-m', 1000))
+    bandwidth = options.get('-b')
+
+    with FakeIMAPServer(mailboxes=mailboxes,
+                        latency=float(options.get('-l', 0)) / 1000,
+                        bandwidth=int(bandwidth) if bandwidth else None
+                        ) as fake:
+        server = hlimap.ImapServer('127.0.0.1', fake.port)
+
+        print('%-32s %6s %10s %10s %8s' % ('Path', 'RTs', 'Sent',
+                                           'Received', 'Time'))
+        measure(fake, 'login', lambda: server.login('user', 'password'))
+        measure(fake, 'list folders',
+                lambda: [str(folder) for folder in server])
+
+        def select():
+            server['INBOX']
+        measure(fake, 'select INBOX', select)
+
+        INBOX = server['INBOX']
+        INBOX.message_list.paginator.msg_per_page = 50
+        measure(fake, 'message list, first page', lambda: list(INBOX))
+
+        def next_page():
+            INBOX.message_list.paginator.current_page = 2
+            INBOX.message_list.refresh_messages()
+            list(INBOX)
+        measure(fake, 'message list, second page', next_page)
+
+        def threaded():
+            INBOX.message_list.set_threaded()
+            INBOX.message_list.refresh_messages()
+            list(INBOX)
+        measure(fake, 'threaded message list', threaded)
+
+        def show_message():
+            message = INBOX.message_list.get_message(
+                INBOX.message_list.flat_message_list[0])
+            for part in message.bodystructure.serial_message():
+                if part.is_text():
+                    message.part(part)
+        measure(fake, 'show message', show_message)
+
+        def logout():
+            server._imap.logout()
+            server.connected = False
+        measure(fake, 'logout', logout)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+# hlimap - High level IMAP library
+# Copyright (C) 2008 Helder Guerreiro
+
+# This file is part of hlimap.
+#
+# hlimap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# hlimap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@tretas.org>
+#
+
+'''Measures the folder tree construction, sorting and iteration times on
+synthetic folder lists. No IMAP server is used, the trees are loaded from
+folder list snapshots (see FolderTree.list_folders).
+
+Usage: python3 -m hlimap.examples.foldertree_benchmark [-n folders]
+    [-r repeat]
+'''
+
+import random
+import time
+
+from hlimap.imapfolder import FolderTree
+
+DELIMITER = '.'
+
+
+class OfflineServer(object):
+    '''The minimum needed by FolderTree and Folder, no connection is made'''
+    _imap = None
+    delimiter = DELIMITER
+
+
+def snapshot(paths):
+    return {'delimiter': DELIMITER,
+            'subscribed': True,
+            'parent': None,
+            'folders': [(path.split(DELIMITER), False, None)
+                        for path in paths]}
+
+
+def wide_tree(count):
+    '''INBOX with count sub folders'''
+    return ['INBOX'] + ['INBOX.Folder%05d' % i for i in range(count - 1)]
+
+
+def deep_tree(count, depth=50):
+    '''Chains of depth folders'''
+    paths = []
+    chain = 0
+    while len(paths) < count:
+        parts = ['Chain%04d' % chain]
+        for level in range(depth):
+            paths.append(DELIMITER.join(parts))
+            parts.append('Level%02d' % level)
+        chain += 1
+    return paths[:count]
+
+
+def random_tree(count, breadth=8, seed=0):
+    '''Random tree, each folder has up to breadth sub folders'''
+    rnd = random.Random(seed)
+    paths = ['INBOX']
+    children = {'INBOX': 0}
+    while len(paths) < count:
+        parent = rnd.choice(paths)
+        if children[parent] >= breadth:
+            continue
+        children[parent] += 1
+        path = '%s%sFolder%d' % (parent, DELIMITER, children[parent])
+        children[path] = 0
+        paths.append(path)
+    rnd.shuffle(paths)
+    return paths
+
+
+def measure(description, paths, repeat):
+    data = snapshot(paths)
+    times = {'load': 0.0, 'sort': 0.0, 'iter_all': 0.0, 'iter_expand': 0.0}
+    for i in range(repeat):
+        tree = FolderTree(OfflineServer())
+
+        start = time.perf_counter()
+        tree.load(data)
+        times['load'] += time.perf_counter() - start
+
+        tree.set_properties(paths[::10], ['INBOX'])
+        start = time.perf_counter()
+        tree.sort()
+        times['sort'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        total = sum(1 for folder in tree.iter_all())
+        times['iter_all'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        for folder in tree.iter_expand():
+            pass
+        times['iter_expand'] += time.perf_counter() - start
+
+    print('%-8s %8d %10.4f %10.4f %10.4f %12.4f' % (
+        description, total, times['load'] / repeat, times['sort'] / repeat,
+        times['iter_all'] / repeat, times['iter_expand'] / repeat))
+
+
+if __name__ == '__main__':
+    import getopt
+    import sys
+
+    try:
+        optlist, args = getopt.getopt(sys.argv[1:], 'n:r:')
+    except getopt.error as val:
+        print(__doc__)
+        sys.exit(1)
+
+    count = 20000
+    repeat = 3
+    for option, value in optlist:
+        if option == '-n':
+            count = int(value)
+        elif option == '-r':
+            repeat = int(value)
+
+    print('%-8s %8s %10s %10s %10s %12s' % ('Tree', 'Folders', 'load (s)',
+                                            'sort (s)', 'iter_all',
+                                            'iter_expand'))
+    measure('wide', wide_tree(count), repeat)
+    measure('deep', deep_tree(count), repeat)
+    measure('random', random_tree(count), repeat)
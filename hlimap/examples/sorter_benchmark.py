@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+# hlimap - High level IMAP library
+# Copyright (C) 2008 Helder Guerreiro
+
+# This file is part of hlimap.
+#
+# hlimap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# hlimap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@tretas.org>
+#
+
+'''Compares the compiled client side sorter with the previous implementation,
+that did a full sort for each sort keyword, on synthetic messages. The
+MessageColumns engine is also measured alone, with and without numpy. No IMAP
+server is used.
+
+Usage: python3 -m hlimap.examples.sorter_benchmark [-n messages]
+    [-r repeat]
+'''
+
+import datetime
+import random
+import time
+
+from imaplib2.parsefetch import Envelope
+from hlimap.message_columns import HAS_NUMPY, MessageColumns
+from hlimap.message_sorter import Sorter, compile_program
+
+NAMES = ('Ana Silva', 'Bruno Costa', 'Carla Sousa', 'Daniel Pereira',
+         'Eva Santos', 'Filipe Martins', 'Gabriela Lopes', 'Hugo Ferreira',
+         '')
+WORDS = ('meeting', 'release', 'invoice', 'holiday', 'planning', 'server',
+         'backup', 'report', 'budget', 'migration', 'security', 'review')
+PROGRAMS = (('-DATE',), ('FROM', '-DATE'), ('SUBJECT', 'SIZE'),
+            ('-TO', 'CC', 'ARRIVAL'))
+
+
+class LegacySorter:
+    '''The sorter before the sort program compilation'''
+
+    def __init__(self, message_list, message_dict, sort_program):
+        self.message_list = message_list
+        self.message_dict = message_dict
+        self.sort_program = sort_program
+
+    def key_ARRIVAL(self, k):
+        return self.message_dict[k]['data'].internaldate
+
+    def key_CC(self, k):
+        return ', '.join(self.message_dict[k]['data'].envelope.cc_short())
+
+    def key_FROM(self, k):
+        return ', '.join(self.message_dict[k]['data'].envelope.from_short())
+
+    def key_DATE(self, k):
+        return self.message_dict[k]['data'].envelope['env_date']
+
+    def key_SIZE(self, k):
+        return self.message_dict[k]['data'].size
+
+    def key_SUBJECT(self, k):
+        return self.message_dict[k]['data'].envelope['env_subject']
+
+    def key_TO(self, k):
+        return ', '.join(self.message_dict[k]['data'].envelope.to_short())
+
+    def run(self):
+        for keyword in reversed(self.sort_program):
+            reverse = False
+            if keyword[0] == '-':
+                reverse = True
+                keyword = keyword[1:]
+            key_meth = getattr(self, 'key_%s' % keyword)
+            self.message_list.sort(key=key_meth, reverse=reverse)
+        return self.message_list
+
+
+class BenchmarkMessage(object):
+    '''The Message attributes used by the sorters'''
+
+    def __init__(self, envelope, internaldate, size):
+        self.envelope = envelope
+        self.internaldate = internaldate
+        self.size = size
+        self.sort_keys = {}
+
+
+def address(rnd):
+    name = rnd.choice(NAMES)
+    mailbox = (name or rnd.choice(WORDS)).split()[0].lower()
+    return [name or None, None, mailbox, 'example.com']
+
+
+def synthetic_messages(count, seed=0):
+    rnd = random.Random(seed)
+    start = datetime.datetime(2015, 1, 1)
+    message_dict = {}
+    for index in range(1, count + 1):
+        date = start + datetime.timedelta(minutes=rnd.randint(0, count * 7))
+        subject = ' '.join(rnd.sample(WORDS, 3))
+        if rnd.random() < 0.3:
+            subject = 'Re: ' + subject
+        envelope = Envelope([
+            date.strftime('%a, %d %b %Y %H:%M:%S +0000'), subject,
+            [address(rnd)], None, None,
+            [address(rnd) for i in range(rnd.randint(1, 3))],
+            [address(rnd) for i in range(rnd.randint(0, 2))],
+            None, None, '<%d@example.com>' % index])
+        message = BenchmarkMessage(
+            envelope, date + datetime.timedelta(seconds=rnd.randint(1, 90)),
+            str(rnd.randint(500, 500000)))
+        message_dict[index] = {'data': message}
+    return message_dict
+
+
+def measure_engine(message_dict, repeat):
+    '''Sorts on MessageColumns, the columns are already built'''
+    ids = sorted(message_dict)
+    messages = [message_dict[Xi]['data'] for Xi in ids]
+    engines = [False, True] if HAS_NUMPY else [False]
+    for use_numpy in engines:
+        columns = MessageColumns(ids, use_numpy)
+        for keyword, function, reverse in compile_program(
+                [Xi.lstrip('-') for Yi in PROGRAMS for Xi in Yi]):
+            if keyword not in columns:
+                columns.add_column(keyword, [function(Xi) for Xi in messages])
+        for sort_program in PROGRAMS:
+            program = [(keyword, reverse) for keyword, function, reverse in
+                       compile_program(sort_program)]
+            start = time.perf_counter()
+            for i in range(repeat):
+                columns.sort(program)
+            print('%-6s %-24s %10.4f' % ('numpy' if use_numpy else 'python',
+                                         ' '.join(sort_program),
+                                         (time.perf_counter() - start) /
+                                         repeat))
+
+
+def measure(message_dict, sort_program, repeat):
+    times = {'legacy': 0.0, 'compiled': 0.0, 'cached': 0.0}
+    for i in range(repeat):
+        for message in message_dict.values():
+            message['data'].sort_keys = {}
+
+        start = time.perf_counter()
+        LegacySorter(list(message_dict), message_dict, sort_program).run()
+        times['legacy'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        Sorter(list(message_dict), message_dict, sort_program).run()
+        times['compiled'] += time.perf_counter() - start
+
+        # With the keys already on the Message instances
+        start = time.perf_counter()
+        Sorter(list(message_dict), message_dict, sort_program).run()
+        times['cached'] += time.perf_counter() - start
+
+    print('%-24s %10.4f %10.4f %10.4f' % (
+        ' '.join(sort_program), times['legacy'] / repeat,
+        times['compiled'] / repeat, times['cached'] / repeat))
+
+
+if __name__ == '__main__':
+    import getopt
+    import sys
+
+    try:
+        optlist, args = getopt.getopt(sys.argv[1:], 'n:r:')
+    except getopt.error as val:
+        print(__doc__)
+        sys.exit(1)
+
+    count = 100000
+    repeat = 3
+    for option, value in optlist:
+        if option == '-n':
+            count = int(value)
+        elif option == '-r':
+            repeat = int(value)
+
+    message_dict = synthetic_messages(count)
+    print('%-24s %10s %10s %10s' % ('Sort program', 'legacy (s)',
+                                    'compiled', 'cached'))
+    for sort_program in PROGRAMS:
+        measure(message_dict, sort_program, repeat)
+
+    print()
+    print('%-6s %-24s %10s' % ('Engine', 'Sort program', 'time (s)'))
+    measure_engine(message_dict, repeat)
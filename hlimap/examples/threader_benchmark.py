@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+# hlimap - High level IMAP library
+# Copyright (C) 2008 Helder Guerreiro
+
+# This file is part of hlimap.
+#
+# hlimap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# hlimap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@tretas.org>
+#
+
+'''Measures the client side threading time on synthetic folders.
+No IMAP server is used, the threader is fed directly with the message
+information.
+
+Usage: python3 -m hlimap.examples.threader_benchmark [-n messages]
+    [-r repeat]
+'''
+
+import datetime
+import random
+import time
+
+from hlimap.message_threader import (base_subject, thread_orderedsubject,
+                                     thread_references)
+
+WORDS = ('meeting', 'release', 'invoice', 'holiday', 'planning', 'server',
+         'backup', 'report', 'budget', 'migration', 'security', 'review')
+
+
+def synthetic_folder(count, seed=0):
+    '''About a third of the messages are replies to recent messages, with
+    the full References header.
+    '''
+    rnd = random.Random(seed)
+    start = datetime.datetime(2015, 1, 1)
+    messages = []
+    for index in range(1, count + 1):
+        message_id = '<%d.%d@example.com>' % (index, rnd.randint(0, 99999))
+        date = start + datetime.timedelta(minutes=7 * index)
+        if messages and rnd.random() < 0.35:
+            parent = rnd.choice(messages[-200:])
+            references = parent[2] + [parent[1]]
+            subject = 'Re: ' + parent[4]
+        else:
+            references = []
+            subject = '%s %d' % (' '.join(rnd.sample(WORDS, 3)),
+                                 rnd.randint(0, count))
+        messages.append((index, message_id, references, date, subject))
+    return messages
+
+
+def missing(messages, seed=0):
+    '''Drops 10% of the messages, the missing parents become dummies'''
+    rnd = random.Random(seed)
+    return [Xi for Xi in messages if rnd.random() >= 0.1]
+
+
+def reversed_order(messages):
+    '''The replies are numbered before their parents'''
+    count = len(messages)
+    return [(count - Xi[0] + 1,) + Xi[1:] for Xi in reversed(messages)]
+
+
+def in_reply_to(messages):
+    '''Only the parent on the references, as with In-Reply-To'''
+    return [Xi[:2] + (Xi[2][-1:],) + Xi[3:] for Xi in messages]
+
+
+def measure(description, messages, repeat, function=thread_references):
+    elapsed = 0.0
+    for i in range(repeat):
+        base_subject.cache_clear()
+        start = time.perf_counter()
+        result = function(messages)
+        elapsed += time.perf_counter() - start
+    print('%-12s %8d %8d %10.4f' % (description, len(result),
+                                    len(result.roots), elapsed / repeat))
+
+
+if __name__ == '__main__':
+    import getopt
+    import sys
+
+    try:
+        optlist, args = getopt.getopt(sys.argv[1:], 'n:r:')
+    except getopt.error as val:
+        print(__doc__)
+        sys.exit(1)
+
+    count = 100000
+    repeat = 3
+    for option, value in optlist:
+        if option == '-n':
+            count = int(value)
+        elif option == '-r':
+            repeat = int(value)
+
+    messages = synthetic_folder(count)
+    print('%-12s %8s %8s %10s' % ('Folder', 'Messages', 'Threads',
+                                  'time (s)'))
+    print('REFERENCES')
+    measure('synthetic', messages, repeat)
+    measure('missing', missing(messages), repeat)
+    measure('reversed', reversed_order(messages), repeat)
+    measure('in-reply-to', in_reply_to(messages), repeat)
+    print('ORDEREDSUBJECT')
+    measure('synthetic', messages, repeat, thread_orderedsubject)
@@ -21,8 +21,9 @@
 #
 # Helder Guerreiro <helder@tretas.org>
 #
-from .imapmessage import MessageList
+from .imapmessage import MessageList, DELETED
 from imaplib2.utils import to_bytes
+from array import array
 import base64
 import re
 
@@ -51,60 +52,141 @@ class FolderTree(object):
         '''
         self._imap = server._imap
         self.server = server
-        self.dl = None
+        self.dl = server.delimiter
         self.folder_dict = {}
         self.root_folder = []
+        # Pre-order folder listing, see sort
+        self.order = None
+        self.end = None
         self.selected = None
+        self.selected_readonly = False
+        # Complete folder list loaded?
+        self.complete = False
+        # Folders with its sub folders loaded, '' is the top level
+        self.loaded = set()
+        # Folders selected by path that weren't listed yet
+        self.unlisted = {}
 
     def refresh_folders(self, subscribed=True):
-        # It's very fast to retrieve the folder listing, so we just
-        # query the server for all the folders.
-        if subscribed:
-            flat_list = self._imap.lsub("", "*")
+        self.load(self.list_folders(subscribed))
+
+    def list_folders(self, subscribed=True, parent=None):
+        '''Retrieves the folder list from the server.
+
+        @param subscribed: list only the subscribed folders;
+        @param parent: if None all the folders are listed, otherwise only the
+            direct sub folders of parent are, '' is the top level.
+
+        @return: a snapshot of the folder list, a dict with plain python
+            types only, so it can be serialized and cached. Use it with
+            L{load<load>}.
+        '''
+        if parent is None:
+            pattern = '*'
+        elif parent:
+            pattern = '%s%s%%' % (parent, self.dl)
         else:
-            flat_list = self._imap.list("", "*")
+            pattern = '%'
+
+        # LSUB doesn't tell us which folders have children, a level by level
+        # listing needs LIST-EXTENDED to know which folders can be expanded.
+        # With RECURSIVEMATCH the parents of subscribed folders are listed
+        # even if they aren't subscribed, as LSUB does, but without the
+        # \Subscribed attribute.
+        extended = (parent is not None and
+                    self._imap.has_capability('LIST-EXTENDED'))
+        if extended and subscribed:
+            flat_list = self._imap.list("", pattern,
+                                        selection=('SUBSCRIBED',
+                                                   'RECURSIVEMATCH'),
+                                        return_options=('CHILDREN',))
+        elif extended:
+            flat_list = self._imap.list("", pattern,
+                                        return_options=('CHILDREN',))
+        elif subscribed:
+            flat_list = self._imap.lsub("", pattern)
+        else:
+            flat_list = self._imap.list("", pattern)
 
-        if LISTINBOX:
+        if LISTINBOX and not parent:
             if 'INBOX' not in flat_list:
                 inbox_list = self._imap.list("", "INBOX")
                 if not inbox_list:
                     raise NoFolderListError('No INBOX folder found')
                 flat_list.insert(0, inbox_list[0])
 
-        if not flat_list:
+        if not flat_list and not parent:
             raise NoFolderListError('No folders found')
 
-        self.dl = flat_list[0].delimiter
+        return {'delimiter': flat_list[0].delimiter if flat_list else self.dl,
+                'subscribed': subscribed,
+                'parent': parent,
+                'folders': [(list(mailbox.parts),
+                             mailbox.noselect() or
+                             (extended and subscribed and
+                              not mailbox.subscribed() and
+                              mailbox.path != 'INBOX'),
+                             mailbox.children())
+                            for mailbox in flat_list]}
+
+    def load(self, snapshot):
+        '''Builds the folder tree from a snapshot returned by
+        L{list_folders<list_folders>}.
+        '''
+        self.dl = snapshot['delimiter']
+
+        for parts, noselect, children in snapshot['folders']:
+            unlisted = self.unlisted.pop(self.dl.join(parts), None)
+            if unlisted is not None:
+                unlisted.subscribed = snapshot['subscribed']
+            folder = self.add_folder(tuple(parts), snapshot['subscribed'],
+                                     noselect=noselect, folder=unlisted)
+            # The folder may have been added before as a parent folder
+            folder.noselect = noselect
+            folder.children = children
+
+        parent = snapshot.get('parent')
+        if parent is None:
+            self.complete = True
+        else:
+            self.loaded.add(parent)
 
-        for mailbox in flat_list:
-            self.add_folder(mailbox.parts, subscribed,
-                            noselect=mailbox.noselect())
+    def is_loaded(self, path):
+        '''Are the sub folders of path loaded?'''
+        return self.complete or path in self.loaded
 
-        self.sort()
+    def add_folder(self, parts, subscribed, noselect=False, folder=None):
+        '''Adds a folder to the tree, and its parent folders if they
+        aren't on the tree yet. The parent folders added are marked as not
+        subscribed and not selectable.
 
-    def add_folder(self, parts, subscribed, child=None, noselect=False):
+        @return: the Folder object.
+        '''
         path = self.dl.join(parts)
-        if path not in self.folder_dict:
-            self.folder_dict[path] = {'data': Folder(self.server, self,
-                                                     parts, subscribed,
-                                                     noselect),
-                                      'children': []}
-            if len(parts) == 1:
-                self.root_folder.append(path)
-
-        if child:
-            if child not in self.folder_dict[path]['children']:
-                self.folder_dict[path]['children'].append(child)
-
-        parent_parts = parts[:-1]
-
-        if parent_parts:
-            parent_path = self.dl.join(parent_parts)
-            if parent_path not in self.folder_dict:
-                self.add_folder(parent_parts, False, child=path,
-                                noselect=True)
-            else:
-                self.add_folder(parent_parts, subscribed, child=path)
+        if path in self.folder_dict:
+            return self.folder_dict[path]['data']
+        if folder is None:
+            folder = Folder(self.server, self, parts, subscribed, noselect)
+        self.folder_dict[path] = {'data': folder,
+                                  'children': []}
+        self.order = None
+
+        # Go up the hierarchy until we find a parent already on the tree
+        child = path
+        while len(parts) > 1:
+            parts = parts[:-1]
+            parent_path = self.dl.join(parts)
+            parent = self.folder_dict.get(parent_path)
+            if parent is not None:
+                parent['children'].append(child)
+                return folder
+            self.folder_dict[parent_path] = {
+                'data': Folder(self.server, self, parts, False, True),
+                'children': [child]}
+            child = parent_path
+
+        self.root_folder.append(child)
+        return folder
 
     # Set folder properties
     def set_properties(self, expand_list,  special_folders):
@@ -116,16 +198,43 @@ class FolderTree(object):
             if folder_name in self.folder_dict:
                 self.folder_dict[folder_name]['data'].special = True
 
-    def sort(self, folder_list=None):
-        '''Sorts the folders.
+        self.order = None
+
+    def sort(self):
+        '''Sorts the folders, the special folders come first, and computes
+        the pre-order folder listing used by the iterators.
+
+        self.order is the list of folders in pre-order, and self.end[i] is
+        the index on self.order after the last sub folder of self.order[i].
         '''
-        if not folder_list:
-            folder_list = self.root_folder
-        folder_list.sort(key=lambda name: self.folder_dict[name]['data'])
-        for folder_name in folder_list:
-            children = self.folder_dict[folder_name]['children']
-            if children:
-                self.sort(children)
+        folder_dict = self.folder_dict
+
+        def key(path):
+            folder = folder_dict[path]['data']
+            return (not folder.special, folder.name)
+
+        self.root_folder.sort(key=key)
+        for entry in folder_dict.values():
+            if len(entry['children']) > 1:
+                entry['children'].sort(key=key)
+
+        order = []
+        end = array('I', bytes(4 * len(folder_dict)))
+        # The stack has paths to visit, and the indexes (ints) of the
+        # folders whose sub folders were all visited
+        stack = self.root_folder[::-1]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, int):
+                end[item] = len(order)
+                continue
+            stack.append(len(order))
+            entry = folder_dict[item]
+            order.append(entry['data'])
+            stack.extend(entry['children'][::-1])
+
+        self.order = order
+        self.end = end
 
     def refresh_status(self):
         for folder in self.iter_all():
@@ -133,34 +242,30 @@ class FolderTree(object):
 
     # Iterators
 
-    def iter_all(self, folder_list=None):
+    def iter_all(self):
         '''Iteract through all the folders
         '''
-        if folder_list is None:
-            folder_list = self.root_folder
+        if self.order is None:
+            self.sort()
 
-        for folder_name in folder_list:
-            yield self.folder_dict[folder_name]['data']
-            # iteract children
-            children = self.folder_dict[folder_name]['children']
-            for child in self.iter_all(children):
-                yield child
+        for folder in self.order:
+            yield folder
 
-    def iter_expand(self, folder_list=None):
+    def iter_expand(self):
         '''Iteract through the folders that have the folder.expanded flag_list
         set.
         '''
-        if folder_list is None:
-            folder_list = self.root_folder
-
-        for folder_name in folder_list:
-            folder = self.folder_dict[folder_name]['data']
+        if self.order is None:
+            self.sort()
+
+        order = self.order
+        end = self.end
+        i = 0
+        while i < len(order):
+            folder = order[i]
             yield folder
-            # iteract children
-            if folder.expanded:
-                children = self.folder_dict[folder_name]['children']
-                for child in self.iter_expand(children):
-                    yield child
+            # Skip the sub folders of the folders not expanded
+            i = i + 1 if folder.expanded else end[i]
 
     def iter_match(self, regex='.*'):
         '''Iteract through matching mailbox paths
@@ -174,28 +279,78 @@ class FolderTree(object):
                 yield folder
 
     # Folder operations
-    def get_folder(self, path):
-        if path not in self.folder_dict:
-            try:
-                if LISTINBOX and (path.upper() == 'INBOX'):
-                    mailbox = self._imap.list("", path)[0]
-                else:
-                    mailbox = self._imap.lsub("", path)[0]
-                self.dl = mailbox.delimiter
-            except IndexError:
-                raise NoSuchFolder(path)
-            self.add_folder(mailbox.parts, True,
-                            child=None, noselect=mailbox.noselect())
-
-        folder = self.folder_dict[path]['data']
-
-        if self.selected and self._imap.has_capability('UNSELECT'):
-            self._imap.unselect()
-            self.selected = None
-        self.selected = folder.select()
+    def get_folder(self, path, readonly=False, refresh=False):
+        '''Returns the selected folder.
+
+        Folders not yet on the tree are selected directly by path, if the
+        SELECT fails the folder doesn't exist or can't be selected. They're
+        kept apart, as not subscribed, until a folder listing has them, so
+        they don't show up on the tree. The hierarchy delimiter is only
+        asked to the server if it isn't known yet.
+
+        @param path: folder path;
+        @param readonly: if true the folder is selected with EXAMINE, unless
+            it's already selected;
+        @param refresh: select the folder again if it's already selected.
+        '''
+        if path in self.folder_dict:
+            return self.select(self.folder_dict[path]['data'], readonly,
+                               refresh)
+        if path in self.unlisted:
+            return self.select(self.unlisted[path], readonly, refresh)
+
+        if self.dl is None:
+            self.dl = self.delimiter()
+        if self.dl:
+            parts = tuple(path.split(self.dl))
+        else:
+            parts = (path,)
+
+        folder = Folder(self.server, self, parts, False)
+        try:
+            self.select(folder, readonly)
+        except self._imap.Error:
+            raise NoSuchFolder(path)
+        self.unlisted[path] = folder
+        return folder
+
+    def select(self, folder, readonly=False, refresh=False):
+        '''Selects the folder on the server, unless it's already selected.
+
+        A new SELECT or EXAMINE is only issued if the folder isn't the
+        selected one, if we want to change a folder that was examined, or if
+        the connection left the selected state (failed SELECT, CLOSE, BYE).
+        There's no need to UNSELECT before selecting another folder.
+
+        With refresh the folder is always selected, keeping it read-write
+        if it already was. On a connection kept between requests a NOOP
+        isn't enough to get the mailbox state up to date: the servers
+        don't have to send the UIDNEXT or HIGHESTMODSEQ changes.
+        '''
+        current = self._imap.sstatus.get('current_folder', {})
+        if (self.selected is folder and
+                self._imap.state == 'SELECTED' and
+                current.get('name') == folder.path and
+                (readonly or not self.selected_readonly)):
+            if not refresh:
+                return folder
+            readonly = readonly and self.selected_readonly
+
+        self.selected = None
+        self.selected = folder.select(readonly)
+        self.selected_readonly = readonly
 
         return folder
 
+    def delimiter(self):
+        '''Asks the server for the hierarchy delimiter. A LIST command with
+        an empty mailbox name returns the delimiter (RFC3501 6.3.8).
+        '''
+        try:
+            return self._imap.list('', '')[0].delimiter or ''
+        except IndexError:
+            return ''
+
 
 class Flags(object):
     def __init__(self, flag_list, permanent_flags=[r'\*']):
@@ -254,6 +409,9 @@ class Folder(object):
         self.special = False  # Is it a special folder? - trash, sent, etc
         self.noselect = noselect
         self.subscribed = subscribed
+        # Has children according to the server: True, False or None if
+        # unknown
+        self.children = None
 
         # Status
         self.status = {}
@@ -261,10 +419,19 @@ class Folder(object):
 
         # Messages
         self.__message_list = None
+        self.sort_index = None  # See ImapServer.sort_index
 
     # Attributes
     def haschildren(self):
-        return bool(self.tree.folder_dict[self.path]['children'])
+        # Folders selected by path may not be on the tree
+        entry = self.tree.folder_dict.get(self.path)
+        if entry is not None and entry['children']:
+            return True
+        if self.tree.is_loaded(self.path):
+            return False
+        # The sub folders aren't loaded yet, use the server information, if
+        # we don't have it assume it has sub folders
+        return self.children is not False
     has_children = property(haschildren)
 
     def set_expand(self, value):
@@ -343,14 +510,14 @@ class Folder(object):
         self._imap.append(self.path, message, '(\Seen)')
 
     # Folder operations:
-    def select(self):
+    def select(self, readonly=False):
         def get_status(result, key):
             try:
                 return result[key]
             except KeyError:
                 return 0
 
-        result = self._imap.select(self.path)
+        result = self._imap.select(self.path, readonly)
 
         self.flags = Flags(result['FLAGS'], result['PERMANENTFLAGS'])
 
@@ -361,34 +528,91 @@ class Folder(object):
 
         self.status['RECENT'] = get_status(result, 'RECENT')
         self.status['UNSEEN'] = get_status(result, 'UNSEEN')
-        if self._imap.has_capability('UIDPLUS'):
-            self.status['UIDNEXT'] = get_status(result, 'UIDNEXT')
-            self.status['UIDVALIDITY'] = get_status(result, 'UIDVALIDITY')
+        # IMAP4rev1 servers send UIDNEXT and UIDVALIDITY on the SELECT
+        # response, this saves a STATUS command
+        for key in ('UIDNEXT', 'UIDVALIDITY'):
+            if key in result:
+                self.status[key] = result[key]
 
         return self
 
+    def writable(self):
+        '''Makes sure this folder is selected read-write'''
+        self.tree.select(self)
+
     def expunge(self):
+        self.writable()
         self._imap.expunge()
         if self.__message_list:
             self._imap.reset_expunged()
             self.message_list.refresh_messages()
 
+    def store(self, message_list, command, flags):
+        '''Changes the flags of messages. The messages already on the
+        message list are updated in place (see MessageList.update_flags),
+        the message list is only retrieved again if the server reports
+        expunged or new messages.
+
+        @param message_list: message UIDs, or numbers if the server doesn't
+            have UIDs;
+        @param command: STORE command, FLAGS, +FLAGS or -FLAGS, with or
+            without .SILENT;
+        @param flags: the flags.
+        '''
+        self.writable()
+        exists = self._imap.sstatus['current_folder'].get('EXISTS')
+        result = self._imap.store(message_list, command, flags)
+        if self.__message_list:
+            if (self._imap.expunged() or
+                    self._imap.sstatus['current_folder'].get('EXISTS') !=
+                    exists):
+                # Some servers expunge the messages when we mark a message
+                # deleted! The message list is retrieved again when needed
+                self._imap.reset_expunged()
+                self.message_list.refresh = True
+            else:
+                self.message_list.update_flags(message_list, command, flags)
+        return result
+
     def set_flags(self, message_list, *args):
         # TODO: this method sould accept MessageList objects
         if not message_list:
             return
-        self._imap.store(message_list, '+FLAGS.SILENT', args)
-        if self._imap.expunged() and self.__message_list:
-            # Some servers expunge the messages when we mark a message deleted!
-            self._imap.reset_expunged()
-            self.message_list.refresh_messages()
+        return self.store(message_list, '+FLAGS.SILENT', args)
 
     def reset_flags(self, message_list, *args):
-        return self._imap.store(message_list, '-FLAGS.SILENT', args)
+        if not message_list:
+            return
+        return self.store(message_list, '-FLAGS.SILENT', args)
 
     def copy(self, message_list, target):
         return self._imap.copy(message_list, target)
 
+    def move(self, message_list, target):
+        '''Moves the messages to the target folder.
+
+        Uses the MOVE command if the server has the MOVE capability
+        (RFC6851). If not the messages are copied, marked deleted and, if
+        the server has the UIDPLUS capability, expunged with UID EXPUNGE.
+        This way only the moved messages are expunged. Without UIDPLUS the
+        messages are left marked deleted on this folder, the message list
+        is updated like on store.
+        '''
+        if not message_list:
+            return
+        self.writable()
+        if self._imap.has_capability('MOVE'):
+            self._imap.move(message_list, target)
+        else:
+            self._imap.copy(message_list, target)
+            self.store(message_list, '+FLAGS.SILENT', (DELETED,))
+            if self._imap.has_capability('UIDPLUS'):
+                self._imap.expunge_uid(message_list)
+        if self._imap.expunged() and self.__message_list:
+            # The message list is retrieved again when needed
+            self._imap.reset_expunged()
+            self.message_list.refresh = True
+
     # Message list management
     def _get_message_list(self):
         if not self.__message_list:
@@ -408,27 +632,24 @@ class Folder(object):
 
     # Special methods
     def __str__(self):
-        mailbox = bytes(self.name, 'ascii')
-        try:
-            return str(mailbox.replace(b'+', b'+-'
-                                       ).replace(b'&', b'+'
-                                                 ).replace(b',', b'/'),
-                       'utf-7')
-        except UnicodeDecodeError:
-            return str(mailbox.replace(b'+', b'+-'
-                                       ).replace(b'&', b'+'
-                                                 ).replace(b',', b'/'),
-                       'utf-8')
+        return self._imap.decode_mailbox(self.name)
 
     def __repr__(self):
         return '<Folder instance "%s">' % (self.name)
 
-    def __getitem__(self, message_id):
-        '''Returns Message Object'''
+    def get_message(self, message_id, profile='message'):
+        '''Returns Message Object
+
+        @param profile: fetch profile, see hlimap.imapmessage.FETCH_PROFILES
+        '''
         if type(message_id) != int:
             raise TypeError('The message id must ben an integer.')
 
-        return self.message_list.get_message(message_id)
+        return self.message_list.get_message(message_id, profile)
+
+    def __getitem__(self, message_id):
+        '''Returns Message Object'''
+        return self.get_message(message_id)
 
     def __iter__(self):
         return self.message_list.msg_iter_page()
@@ -104,41 +104,107 @@ Please note the THREAD command response is in the form:
 '''
 
 # Imports
+from array import array
 import base64
 import quopri
+import re
 
-from imaplib2.parsefetch import Single
+from imaplib2.parsefetch import (Single, Envelope, ENVELOPE_HEADERS,
+                                 header_envelope)
 
-from .message_threader import Threader
+from .message_threader import (Threader, ThreadAlgError, THREAD_ALGORITHMS,
+                               message_ids)
 from .message_sorter import Sorter, SortProgError
 from .message_paginator import Paginator
 
 # Utils
 
 
-def flaten_nested(nested_list):
-    '''Flaten a nested list.
+def fetch_query(profile):
+    '''Composes the FETCH items for a fetch profile.
+
+    @param profile: profile name (see FETCH_PROFILES) or sequence of field
+        names (see FETCH_FIELDS).
+
+    @return: the FETCH items string, for instance
+        '(FLAGS BODY.PEEK[HEADER.FIELDS (DATE SUBJECT)])'.
     '''
-    for item in nested_list:
-        if type(item) in (list, tuple):
-            for sub_item in flaten_nested(item):
-                yield sub_item
-        else:
-            yield item
+    if isinstance(profile, str):
+        try:
+            profile = FETCH_PROFILES[profile]
+        except KeyError:
+            raise FetchProfileError('Unknown fetch profile: %s' % profile)
+    items = []
+    headers = []
+    for field in profile:
+        try:
+            item = FETCH_FIELDS[field]
+        except KeyError:
+            raise FetchProfileError('Unknown fetch field: %s' % field)
+        if isinstance(item, tuple):
+            headers.extend(Xi for Xi in item if Xi not in headers)
+        elif item not in items:
+            items.append(item)
+    if headers:
+        items.append('BODY.PEEK[HEADER.FIELDS (%s)]' % ' '.join(headers))
+    return '(%s)' % ' '.join(items)
+
+
+def header_fields(msg_info):
+    '''Returns the (header names, header text) of the HEADER.FIELDS item of
+    a fetch response, or None. The servers reply to BODY.PEEK[...] with
+    BODY[...], so both are looked for.
+    '''
+    for key in msg_info:
+        if (isinstance(key, str) and
+                key.upper().startswith(('BODY[HEADER.FIELDS (',
+                                        'BODY.PEEK[HEADER.FIELDS ('))):
+            names = key[key.index('(') + 1:key.rindex(')')].upper().split()
+            return names, msg_info[key] or ''
+    return None
+
 
+def store_flags(flags, command, store):
+    '''Returns the flags of a message after a STORE command.
 
-def threaded_tree(nested_list, base_level=0, parent=None):
-    '''Analyses the tree, returns child depth (level)
+    @param flags: the message flags before the command;
+    @param command: FLAGS, +FLAGS or -FLAGS, with or without .SILENT;
+    @param store: the flags of the command.
     '''
-    level = base_level
-    for item in nested_list:
-        if type(item) in (list, tuple):
-            for sub_item in threaded_tree(item, level, parent):
-                yield sub_item
-        else:
-            yield item, level, parent
-            level += 1
-            parent = item
+    command = command.upper().split('.')[0]
+    if command == '+FLAGS':
+        return list(flags) + [Xi for Xi in store if Xi not in flags]
+    elif command == '-FLAGS':
+        return [Xi for Xi in flags if Xi not in store]
+    # \Recent can't be changed by the client
+    return [Xi for Xi in flags if Xi == RECENT] + list(store)
+
+
+def response_flags(imap):
+    '''Returns the FLAGS of the FETCH responses received with the last
+    command, {message id: flags}.
+
+    If the server has UIDs the message ids are UIDs, the responses without
+    UID are ignored: imaplib2 keeps them by message number (unsolicited
+    flag changes usually come this way), which can't be told apart from a
+    UID.
+    '''
+    use_uid = imap.has_capability('IMAP4REV1')
+    flags = {}
+    for msg_info in imap.sstatus['fetch_response'].values():
+        if 'FLAGS' not in msg_info:
+            continue
+        if not use_uid:
+            flags[msg_info['ID']] = msg_info['FLAGS']
+        elif 'UID' in msg_info:
+            flags[msg_info['UID']] = msg_info['FLAGS']
+    return flags
+
+
+# Regexps
+
+references_re = re.compile(r'^references:(.*(?:\r?\n[ \t].*)*)',
+                           re.I | re.M)
 
 # Exceptions:
 
@@ -146,9 +212,56 @@ def threaded_tree(nested_list, base_level=0, parent=None):
 class MessageNotFound(Exception):
     pass
 
+
+class FetchProfileError(Exception):
+    pass
+
 # Constants:
 
-SORT_KEYS = ('ARRIVAL', 'CC', 'DATE', 'FROM', 'SIZE', 'SUBJECT', 'TO')
+SORT_KEYS = ('ARRIVAL', 'CC', 'DATE', 'DISPLAYFROM', 'DISPLAYTO', 'FROM',
+             'SIZE', 'SUBJECT', 'TO')
+DISPLAY_SORT_KEYS = ('DISPLAYFROM', 'DISPLAYTO')
+
+# Message fields, each one is loaded from a FETCH item or from some headers,
+# the headers of all the fields are fetched with a single
+# BODY.PEEK[HEADER.FIELDS (...)] item.
+FETCH_FIELDS = {
+    'flags': 'FLAGS',
+    'size': 'RFC822.SIZE',
+    'internaldate': 'INTERNALDATE',
+    'envelope': 'ENVELOPE',
+    # The envelope fields used on the message list and to sort, without
+    # Sender, Reply-To, Bcc, In-Reply-To and Message-ID
+    'headers': ('DATE', 'SUBJECT', 'FROM', 'TO', 'CC'),
+    # Client side threading
+    'thread_headers': ('MESSAGE-ID', 'IN-REPLY-TO', 'REFERENCES'),
+    'references': ('REFERENCES',),
+    }
+
+# The fields needed by each view
+FETCH_PROFILES = {
+    'list': ('flags', 'size', 'internaldate', 'headers'),
+    'thread': ('flags', 'size', 'internaldate', 'headers', 'thread_headers'),
+    'message': ('flags', 'size', 'internaldate', 'envelope', 'references'),
+    'action': ('flags',),
+    }
+
+ENVELOPE_KEYS = tuple(key for key, name in ENVELOPE_HEADERS)
+
+# Message attributes and the fields they're loaded from
+ATTRIBUTE_FIELDS = {
+    'flags': 'flags',
+    'seen': 'flags',
+    'deleted': 'flags',
+    'answered': 'flags',
+    'flagged': 'flags',
+    'draft': 'flags',
+    'recent': 'flags',
+    'size': 'size',
+    'internaldate': 'internaldate',
+    'envelope': 'envelope',
+    'references': 'references',
+    }
 
 UNSORTED = 1
 SORTED = 2
@@ -182,14 +295,18 @@ class MessageList(object):
             self.search_capability.append(THREADED)
         if sort:
             self.search_capability.append(SORTED)
-        if thread:
-            if self._imap.has_capability('THREAD=REFERENCES'):
-                self.thread_alg = 'REFERENCES'
-            else:
-                self.thread_alg = 'ORDEREDSUBJECT'
+        # Threading algorithm, if the server doesn't support it the
+        # messages are threaded client side
+        if (self._imap.has_capability('THREAD=ORDEREDSUBJECT') and
+                not self._imap.has_capability('THREAD=REFERENCES')):
+            self.set_thread_alg('ORDEREDSUBJECT')
+        else:
+            self.set_thread_alg('REFERENCES')
         # Sort program setup
         self.set_sort_program('-DATE')
         self.set_search_expression('ALL')
+        self.fetch_profile = None
+        self.previews = False  # Set the message previews, see set_previews
         # Message list options
         self.refresh = True  # Get the message list and their headers
         self.flat_message_list = []
@@ -197,6 +314,15 @@ class MessageList(object):
         self.show_style = SORTED
         self._number_messages = None
         self.paginator = Paginator(self)
+        # Threaded view pagination, see thread_pages
+        self.thread_cap = 10  # Maximum number of messages shown per thread
+        self._thread_pages = None
+        self._message_list = None
+        self.page_sliced = False  # Is flat_message_list the current page?
+        # Threaded view: {message id: id of the thread first message} and
+        # the flags of the messages not shown, see update_flags
+        self.thread_roots = {}
+        self.hidden_flags = {}
 
     # Sort program:
     def sort_string(self):
@@ -225,13 +351,48 @@ class MessageList(object):
 
     def set_sort_program(self, *sort_list):
         '''Define the sort program to use, the available keywords are:
-        ARRIVAL, CC, DATE, FROM, SIZE, SUBJECT, TO
+        ARRIVAL, CC, DATE, DISPLAYFROM, DISPLAYTO, FROM, SIZE, SUBJECT, TO
 
         Any of this words can be perpended by a - meaning reverse order.
         '''
         self.test_sort_program(sort_list)
         self.sort_program = sort_list
 
+    def server_sorting(self):
+        '''True if the server can sort with the current sort program, the
+        DISPLAYFROM and DISPLAYTO keys need the SORT=DISPLAY extension.
+        '''
+        if SORTED not in self.search_capability:
+            return False
+        for keyword in self.sort_program:
+            if keyword.lstrip('-').upper() in DISPLAY_SORT_KEYS:
+                return self._imap.has_capability('SORT=DISPLAY')
+        return True
+
+    def index_sorting(self):
+        '''True if the messages are sorted client side using the folder
+        sort index, see ImapServer.sort_index. The index is kept by UID.
+        '''
+        return (self.show_style == SORTED and not self.server_sorting() and
+                self._imap.has_capability('IMAP4REV1'))
+
+    # Threading algorithm:
+    def set_thread_alg(self, thread_alg):
+        '''Define the threading algorithm, REFERENCES or ORDEREDSUBJECT.
+
+        ORDEREDSUBJECT is cheaper when threading client side, the References
+        header isn't needed.
+        '''
+        thread_alg = thread_alg.upper()
+        if thread_alg not in THREAD_ALGORITHMS:
+            raise ThreadAlgError('Unknown threading algorithm: %s' %
+                                 thread_alg)
+        self.thread_alg = thread_alg
+
+    def server_threading(self):
+        '''True if the server can thread with the current algorithm'''
+        return self._imap.has_capability('THREAD=%s' % self.thread_alg)
+
     # Search expression:
     def set_search_expression(self, search_expression):
         self.search_expression = search_expression
@@ -266,22 +427,86 @@ class MessageList(object):
         +--------------+--------+--------+------+--------+--------+--------+
         | IMAP command | SEARCH | SEARCH | SORT | SORT   | SEARCH | THREAD |
         +--------------+--------+--------+------+--------+--------+--------+
+
+        If the server has an order cache (see ImapServer) the message list
+        is kept on it, and reused while the mailbox state doesn't change
+        (see mailbox_state). Moving to another page of the same message
+        list doesn't repeat the SORT or THREAD command.
         '''
-        if THREADED in self.search_capability and self.show_style == THREADED:
+        ordering = self.ordering()
+        cache = self.server.order_cache
+        state = self.mailbox_state() if cache is not None else None
+        message_list = None
+        if state is not None:
+            key = self.server.order_cache_key(self.folder.path,
+                                              self.search_expression,
+                                              *ordering)
+            cached = cache.get(key)
+            if cached is not None and cached[0] == state:
+                message_list = cached[1]
+        if message_list is None:
+            message_list = self.run_ordering(ordering)
+            if state is not None:
+                cache.set(key, (state, message_list),
+                          self.server.order_cache_timeout)
+        if ordering[0] == 'THREAD':
+            return message_list, message_list.ids
+        return message_list, message_list
+
+    def ordering(self):
+        '''Describes how the message list is obtained, returns a tuple with
+        the method (THREAD, SORT, INDEX or SEARCH) and its arguments.
+        '''
+        if self.show_style == THREADED and self.server_threading():
+            return ('THREAD', self.thread_alg)
+        elif self.server_sorting():
+            return ('SORT', self.sort_string())
+        elif self.index_sorting():
+            return ('INDEX', self.sort_string())
+        return ('SEARCH',)
+
+    def run_ordering(self, ordering):
+        '''Gets the message list from the server, see ordering'''
+        method = ordering[0]
+        if method == 'THREAD':
             # We have the THREAD extension:
-            message_list = self._imap.thread(self.thread_alg,
-                                             'utf-8', self.search_expression)
-            flat_message_list = list(flaten_nested(message_list))
-        elif SORTED in self.search_capability:
+            # The message list is a ThreadList, the message ids are kept
+            # in the thread order on its ids array.
+            return self._imap.thread(self.thread_alg, 'utf-8',
+                                     self.search_expression)
+        elif method == 'SORT':
             # We have the SORT extension on the server:
-            message_list = self._imap.sort(self.sort_string(),
-                                           'utf-8', self.search_expression)
-            flat_message_list = message_list[:]
-        else:
-            # Just get the list.
-            message_list = list(self._imap.search(self.search_expression))
-            flat_message_list = message_list[:]
-        return message_list, flat_message_list
+            return self._imap.sort(self.sort_string(), 'utf-8',
+                                   self.search_expression)
+        elif method == 'INDEX':
+            # Sort the messages using the folder sort index, only the
+            # messages not yet on the index are fetched.
+            uids = self._imap.search(self.search_expression)
+            index = self.server.sort_index(self.folder)
+            return array('I', index.sort(uids, self.sort_program))
+        # Just get the list.
+        return self._imap.search(self.search_expression)
+
+    def mailbox_state(self):
+        '''Mailbox state used to validate the cached message lists. It's
+        taken from the SELECT response, and kept up to date by the untagged
+        responses: (UIDVALIDITY, UIDNEXT, EXISTS) and, if the search
+        expression isn't ALL, HIGHESTMODSEQ, since the search results can
+        depend on the flags. A connection kept between requests has to
+        select the folder again to get the current state (see
+        FolderTree.select).
+
+        @return: the state tuple, or None if the message list can't be
+            cached (the server didn't give us the necessary information).
+        '''
+        current = self._imap.sstatus['current_folder']
+        state = tuple(current.get(Xi)
+                      for Xi in ('UIDVALIDITY', 'UIDNEXT', 'EXISTS'))
+        if self.search_expression.upper() != 'ALL':
+            state += (current.get('HIGHESTMODSEQ'),)
+        if None in state:
+            return None
+        return state
 
     def create_message_dict(self, flat_message_list):
         '''Create here a message dict in the form:
@@ -296,10 +521,24 @@ class MessageList(object):
                                         'level': 0}
         return message_dict
 
-    def update_message_dict(self, message_list, message_dict):
-        for msg_id, level, parent in threaded_tree(message_list):
+    def update_message_dict(self, message_list, message_dict,
+                            positions=None):
+        '''Updates the message dict with the thread information.
+
+        @param message_list: ThreadList instance
+        @param message_dict: message dict
+        @param positions: indexes, on the ThreadList, of the messages to
+            process. By default all the messages are processed.
+        '''
+        ids = message_list.ids
+        if positions is None:
+            positions = range(len(ids))
+        for index in positions:
+            msg_id = ids[index]
             if msg_id not in message_dict:
                 continue
+            level = message_list.levels[index]
+            parent = message_list.parent_id(index)
             if level > 0:
                 if parent in message_dict:
                     if msg_id not in message_dict[parent]['children']:
@@ -309,27 +548,183 @@ class MessageList(object):
                 message_dict[msg_id]['data'].level = level
         return message_dict
 
+    def set_fetch_profile(self, profile):
+        '''Define the fetch profile used for the messages on the list (see
+        FETCH_PROFILES), None to choose it automatically.
+        '''
+        if profile is not None:
+            fetch_query(profile)
+        self.fetch_profile = profile
+
+    def set_previews(self, previews=True):
+        '''Set the preview of the messages of the current page (the
+        Message.preview attribute), see ImapServer.message_previews.
+        '''
+        self.previews = previews
+
+    def fetch_items(self):
+        '''Message items to fetch, the Message-ID, In-Reply-To and
+        References headers are only needed to thread client side with the
+        REFERENCES algorithm.
+        '''
+        if self.fetch_profile is not None:
+            return fetch_query(self.fetch_profile)
+        if (self.show_style == THREADED and self.thread_alg == 'REFERENCES'
+                and not self.server_threading()):
+            return fetch_query('thread')
+        return fetch_query('list')
+
     def create_message_objects(self, flat_message_list, message_dict):
         if flat_message_list:
             for msg_id, msg_info in self._imap.fetch(flat_message_list,
-                                                     ('(ENVELOPE RFC822.SIZE '
-                                                      'FLAGS INTERNALDATE '
-                                                      'BODY.PEEK[HEADER.FIELDS'
-                                                      ' (REFERENCES)])')
+                                                     self.fetch_items()
                                                      ).items():
                 message_dict[msg_id]['data'] = Message(
                     self.server, self.folder, msg_info)
         return message_dict
 
-    def paginate(self, flat_message_list):
+    def page_range(self, flat_message_list):
+        '''Returns the (first, last) slice of the current page'''
         if self.paginator.msg_per_page == -1:
-            message_list = self.flat_message_list
-        else:
-            first_msg = (self.paginator.current_page - 1
-                         ) * self.paginator.msg_per_page
-            last_message = first_msg + self.paginator.msg_per_page - 1
-            message_list = flat_message_list[first_msg:last_message+1]
-        return message_list
+            return 0, len(flat_message_list)
+        first_msg = (self.paginator.current_page - 1
+                     ) * self.paginator.msg_per_page
+        return first_msg, first_msg + self.paginator.msg_per_page
+
+    def paginate(self, flat_message_list):
+        '''Slices the current page from the message list, the message list
+        arrays are sliced directly.
+        '''
+        first_msg, last_message = self.page_range(flat_message_list)
+        return flat_message_list[first_msg:last_message]
+
+    # Threaded view pagination
+    def thread_paging(self):
+        '''True if the message list is paginated by thread, each page shows
+        whole threads.
+        '''
+        return (self.show_style == THREADED and
+                self.paginator.msg_per_page != -1)
+
+    def thread_pages(self, thread_list):
+        '''Splits the threads in pages. The threads are added to a page
+        while the number of messages shown, at most thread_cap per thread,
+        doesn't go over msg_per_page. A page always has at least one thread.
+
+        @param thread_list: ThreadList instance
+
+        @return: array with the index of the first thread of each page.
+        '''
+        per_page = self.paginator.msg_per_page
+        roots = thread_list.roots
+        pages = array('I')
+        count = 0
+        for thread, start in enumerate(roots):
+            end = (roots[thread + 1] if thread + 1 < len(roots)
+                   else len(thread_list.ids))
+            size = end - start
+            if self.thread_cap:
+                size = min(size, self.thread_cap)
+            if not pages or (count and count + size > per_page):
+                pages.append(thread)
+                count = 0
+            count += size
+        return pages
+
+    def _get_number_thread_pages(self):
+        if self._thread_pages is None:
+            if self.server_threading():
+                self._thread_pages = self.thread_pages(
+                    self.load_message_list()[0])
+            else:
+                # Client side threading, all the messages are needed
+                self.refresh_messages()
+        return len(self._thread_pages)
+    number_thread_pages = property(_get_number_thread_pages)
+
+    def paginate_threads(self, thread_list):
+        '''Selects the messages of the threads on the current page.
+
+        Since the messages of each thread are in depth first order, when a
+        thread is cut at thread_cap messages the parents of the messages
+        shown are also shown.
+
+        @param thread_list: ThreadList instance
+
+        @return: (threads, shown, hidden), threads is the (first, last)
+            slice of the threads on the page, shown and hidden are lists
+            of indexes, on the ThreadList, of the messages shown and of the
+            messages cut from the threads.
+        '''
+        self._thread_pages = self.thread_pages(thread_list)
+        pages = self._thread_pages
+        if not pages:
+            return (0, 0), [], []
+        page = min(self.paginator.current_page, len(pages)) - 1
+        first = pages[page]
+        last = (pages[page + 1] if page + 1 < len(pages)
+                else len(thread_list.roots))
+        shown = []
+        hidden = []
+        for thread in range(first, last):
+            start, end = thread_list.thread(thread)
+            cut = min(end, start + self.thread_cap) if self.thread_cap else end
+            shown.extend(range(start, cut))
+            hidden.extend(range(cut, end))
+        return (first, last), shown, hidden
+
+    def update_thread_info(self, thread_list, threads, message_dict,
+                           msg_info):
+        '''Sets the thread attribute of the first message of each thread
+        on the page, a dict with:
+
+            * size - number of messages on the thread;
+            * unread - number of messages without the \\Seen flag;
+            * latest - INTERNALDATE of the most recent message;
+            * hidden - number of messages not shown, see thread_cap.
+
+        @param thread_list: ThreadList instance
+        @param threads: (first, last) slice of the threads on the page
+        @param message_dict: message dict
+        @param msg_info: {message id: fetch response} with the FLAGS and
+            INTERNALDATE of the messages that aren't on message_dict.
+        '''
+        ids = thread_list.ids
+        for thread in range(*threads):
+            start, end = thread_list.thread(thread)
+            unread = 0
+            latest = None
+            for index in range(start, end):
+                msg_id = ids[index]
+                self.thread_roots[msg_id] = ids[start]
+                if 'data' in message_dict.get(msg_id, {}):
+                    message = message_dict[msg_id]['data']
+                    flags, date = message.flags, message.internaldate
+                elif msg_id in msg_info:
+                    flags = msg_info[msg_id]['FLAGS']
+                    date = msg_info[msg_id]['INTERNALDATE']
+                    self.hidden_flags[msg_id] = flags
+                else:
+                    continue
+                if SEEN not in flags:
+                    unread += 1
+                if latest is None or date > latest:
+                    latest = date
+            root = message_dict.get(ids[start], {}).get('data')
+            if root is not None:
+                root.thread = {'size': end - start,
+                               'unread': unread,
+                               'latest': latest,
+                               'hidden': max(0, end - start - self.thread_cap)
+                               if self.thread_cap else 0}
+
+    def load_message_list(self):
+        '''Returns the result of get_message_list, it's kept until the next
+        refresh_messages.
+        '''
+        if self._message_list is None:
+            self._message_list = self.get_message_list()
+        return self._message_list
 
     def refresh_messages(self):
         '''
@@ -365,83 +760,206 @@ class MessageList(object):
         message header information for a page of messages instead of getting
         the information for all messages on the search program (ALL by
         default).
+
+        - Without the SORT capability the messages are sorted using the
+        folder sort index (see ImapServer.sort_index) when the UIDs are
+        available, the pagination is then also done before step 2.
+
+        - The threaded view is paginated by thread, see thread_pages. The
+        messages of a thread beyond thread_cap aren't shown, only their
+        FLAGS and INTERNALDATE are fetched for the thread information (see
+        update_thread_info).
         '''
         # Obtain the message list
-        message_list, flat_message_list = self.get_message_list()
+        message_list, flat_message_list = self.load_message_list()
+        self._message_list = None
         # Set the number of message present in the folder according to the
         # current search expression
         self._number_messages = len(flat_message_list)
+        positions = None
+        threads = None
+        hidden = []
+        self.page_sliced = False
+        self.thread_roots = {}
+        self.hidden_flags = {}
         # Paginate now if we have SORT or THREAD capability, this way we don't
         # have to retrieve message headers to all messages returned by the
         # search program
-        if (SORTED in self.search_capability or
-           THREADED in self.search_capability):
+        if self.show_style == THREADED and self.server_threading():
+            if self.thread_paging():
+                threads, positions, hidden = self.paginate_threads(
+                    message_list)
+                flat_message_list = [message_list.ids[Xi]
+                                     for Xi in positions]
+                self.page_sliced = True
+        elif self.show_style == SORTED and (self.server_sorting() or
+                                            self.index_sorting()):
             flat_message_list = self.paginate(flat_message_list)
-            if (not(self.show_style == THREADED and
-               THREADED in self.search_capability)):
-                message_list = list(flat_message_list)
+            message_list = list(flat_message_list)
+            self.page_sliced = True
         # Create the message dictionary
         message_dict = self.create_message_dict(flat_message_list)
         # Get message's header information
         message_dict = self.create_message_objects(flat_message_list,
                                                    message_dict)
         # Client side threading
-        if (self.show_style == THREADED and
-           THREADED not in self.search_capability):
-            message_list = Threader(message_list, message_dict).run()
-            flat_message_list = list(flaten_nested(message_list))
+        if self.show_style == THREADED and not self.server_threading():
+            message_list = Threader(message_list, message_dict,
+                                    self.thread_alg).run()
+            flat_message_list = message_list.ids
+            if self.thread_paging():
+                threads, positions, hidden = self.paginate_threads(
+                    message_list)
+                flat_message_list = [message_list.ids[Xi]
+                                     for Xi in positions]
+                self.page_sliced = True
         # Client side sorting
-        if SORTED not in self.search_capability and self.show_style == SORTED:
+        if (self.show_style == SORTED and not self.server_sorting() and
+                not self.index_sorting()):
             message_list = Sorter(
-                    message_list,
+                    list(message_list),
                     message_dict,
                     self.sort_program).run()
             flat_message_list = list(message_list)
         # Update the message dict with the level information of the
         # thread level of each message and each message children
         if self.show_style == THREADED:
-            message_dict = self.update_message_dict(message_list, message_dict)
+            message_dict = self.update_message_dict(message_list, message_dict,
+                                                    positions)
+            if threads is not None:
+                missing = [message_list.ids[Xi] for Xi in hidden
+                           if message_list.ids[Xi] not in message_dict]
+                msg_info = (self._imap.fetch(missing, '(FLAGS INTERNALDATE)')
+                            if missing else {})
+                self.update_thread_info(message_list, threads, message_dict,
+                                        msg_info)
             # TODO: Sort the threads according to the defined program unless
             # we have the sort extension
         # House keeping
         self.message_dict = message_dict
         self.flat_message_list = flat_message_list
         self.refresh = False
+        if self.previews:
+            self.load_previews()
+
+    def load_previews(self):
+        '''Sets the preview of the current page messages, all the previews
+        are fetched together.
+        '''
+        page = self.page_message_ids()
+        previews = self.server.message_previews(self.folder, page)
+        for msg_id in page:
+            self.message_dict[msg_id]['data'].preview = previews.get(msg_id)
+
+    def get_window(self, first, last):
+        '''Returns the number of messages and the messages of the slice
+        [first:last] of the sorted message list, a list of Message
+        instances. With SORT or the folder sort index only these messages
+        are fetched, otherwise all the messages are fetched and sorted
+        client side.
+
+        The threaded view isn't supported, the messages are always sorted.
+        The messages the FETCH doesn't return (expunged by another client
+        since the message list was obtained) are left out.
+        '''
+        self.set_sorted()
+        message_list, flat_message_list = self.load_message_list()
+        self._message_list = None
+        self._number_messages = len(flat_message_list)
+        if self.server_sorting() or self.index_sorting():
+            window = list(flat_message_list[first:last])
+            message_dict = self.create_message_objects(
+                window, self.create_message_dict(window))
+        else:
+            flat_message_list = list(flat_message_list)
+            message_dict = self.create_message_objects(
+                flat_message_list, self.create_message_dict(flat_message_list))
+            flat_message_list = [Xi for Xi in flat_message_list
+                                 if 'data' in message_dict[Xi]]
+            self._number_messages = len(flat_message_list)
+            window = Sorter(flat_message_list, message_dict,
+                            self.sort_program).run()[first:last]
+        return (self._number_messages,
+                [message_dict[Xi]['data'] for Xi in window
+                 if 'data' in message_dict[Xi]])
+
+    def update_flags(self, message_ids, command, flags):
+        '''Applies a STORE command to the messages on the list, so the list
+        doesn't have to be retrieved again. The FLAGS sent by the server
+        (the reply to a non silent STORE, or unsolicited) are used when
+        present, otherwise the command is applied to the known flags. The
+        thread information unread count is also updated.
+
+        If the search expression isn't ALL the messages on the list may
+        depend on their flags, the list is then retrieved again when next
+        used.
+
+        @param message_ids: messages changed;
+        @param command: FLAGS, +FLAGS or -FLAGS, with or without .SILENT;
+        @param flags: the flags of the command.
+        '''
+        if self.refresh:
+            return
+        if self.search_expression.upper() != 'ALL':
+            self.refresh = True
+            return
+        changed = response_flags(self._imap)
+        for msg_id in set(message_ids) | set(changed):
+            if 'data' in self.message_dict.get(msg_id, {}):
+                message = self.message_dict[msg_id]['data']
+                # The flags aren't fetched just for this
+                old = message.__dict__.get('flags')
+                message.update_flags(command, flags, changed)
+                new = message.__dict__.get('flags')
+            elif msg_id in self.hidden_flags:
+                old = self.hidden_flags[msg_id]
+                if msg_id in changed:
+                    new = changed[msg_id]
+                else:
+                    new = store_flags(old, command, flags)
+                self.hidden_flags[msg_id] = new
+            else:
+                continue
+            if (old is None or new is None or (SEEN in old) == (SEEN in new)
+                    or msg_id not in self.thread_roots):
+                continue
+            root = self.message_dict[self.thread_roots[msg_id]]['data']
+            if root.thread is not None:
+                root.thread['unread'] += 1 if SEEN in old else -1
 
     # Handle a request for a single message:
-    def get_message(self, message_id):
+    def get_message(self, message_id, profile='message'):
         '''Gets a _single_ message from the server
+
+        @param message_id: message UID, or number if the server doesn't
+            have UIDs;
+        @param profile: fetch profile, see FETCH_PROFILES. Use 'action' when
+            only the message flags or parts are needed.
         '''
-        # We need to get the msg envelope to initialize the
-        # Message object
         try:
             msg_info = self._imap.fetch(message_id,
-                                        ('(ENVELOPE RFC822.SIZE FLAGS '
-                                         'INTERNALDATE BODY.PEEK[HEADER.FIELDS'
-                                         ' (REFERENCES)])'))[message_id]
+                                        fetch_query(profile))[message_id]
         except KeyError:
             raise MessageNotFound('%s message not found' % message_id)
         return Message(self.server, self.folder, msg_info)
 
     # Iterators
+    def page_message_ids(self):
+        '''Message ids of the current page'''
+        if self.paginator.msg_per_page == -1 or self.page_sliced:
+            # If we're using the SORT or THREAD extentions the
+            # flat_message_list is truncated early in order to avoid
+            # downloading the message information for all the messages in
+            # the folder.
+            return self.flat_message_list
+        return self.paginate(self.flat_message_list)
+
     def msg_iter_page(self):
         '''Iteract through the current range (page) of messages.
         '''
         if self.refresh:
             self.refresh_messages()
-        if self.paginator.msg_per_page == -1:
-            message_list = self.flat_message_list
-        elif len(self.flat_message_list) > self.paginator.msg_per_page:
-            first_msg = (self.paginator.current_page - 1
-                         ) * self.paginator.msg_per_page
-            last_message = first_msg + self.paginator.msg_per_page - 1
-            message_list = self.flat_message_list[first_msg:last_message+1]
-        else:
-            # If we're using the SORT extention the flat_message_list is
-            # truncated early in order to avoid downloading the message
-            # information for all the messages in the folder.
-            message_list = self.flat_message_list
-        for msg_id in message_list:
+        for msg_id in self.page_message_ids():
             yield self.message_dict[msg_id]['data']
 
     # Special methods
@@ -449,44 +967,93 @@ class MessageList(object):
         return '<MessageList instance in folder "%s">' % (self.folder.name)
 
 
+class PartialEnvelope(Envelope):
+    '''Envelope with some of the fields, taken from the message headers.
+    The whole ENVELOPE is fetched when a missing field is used.
+    '''
+
+    def __init__(self, fields, message):
+        dict.__init__(self, fields)
+        self.message = message
+
+    def __missing__(self, key):
+        if key not in ENVELOPE_KEYS or self.message is None:
+            raise KeyError(key)
+        message, self.message = self.message, None
+        message.backfill('envelope')
+        for field, value in message.envelope.items():
+            self.setdefault(field, value)
+        message.envelope = self
+        return self[key]
+
+
 class Message(object):
     def __init__(self, server, folder, msg_info):
         self.server = server
         self._imap = server._imap
         self.folder = folder
-        # Problem: msg_info carries lots of information that can vary quite a
-        # bit. We could query this information from within this class, but then
-        # we would have to query the IMAP server once for each message this is
-        # not efficient.
-        # It seems that collecting this info is arbitrary and will force the
-        # user to alter this class if new information is necessary.
-        # This should be open.
-        # TODO: Create a manager to collect this information on demand or
-        # to store it if it is available in msg_info when creating a new
-        # Message instance.
-        self.envelope = msg_info['ENVELOPE']
-        self.size = msg_info['RFC822.SIZE']
-        self.uid = msg_info['UID']
+        # msg_info has the fields of the fetch profile used (see
+        # FETCH_PROFILES), the other attributes are fetched when they're
+        # first used, see __getattr__.
+        self.uid = msg_info.get('UID')
         self.id = msg_info['ID']
-        self.get_flags(msg_info['FLAGS'])
-        self.internaldate = msg_info['INTERNALDATE']
-        self.references = self.get_references(msg_info)
         self.level = 0  # Thread level
+        self.thread = None  # Thread information, see update_thread_info
+        self.preview = None  # See MessageList.set_previews
+        self.sort_keys = {}  # Client side sort keys cache
         self.__bodystructure = None
+        self.load(msg_info)
+
+    def load(self, msg_info):
+        '''Sets the attributes from a fetch response'''
+        if 'ENVELOPE' in msg_info:
+            self.envelope = msg_info['ENVELOPE']
+        if 'RFC822.SIZE' in msg_info:
+            self.size = msg_info['RFC822.SIZE']
+        if 'FLAGS' in msg_info:
+            self.get_flags(msg_info['FLAGS'])
+        if 'INTERNALDATE' in msg_info:
+            self.internaldate = msg_info['INTERNALDATE']
+        headers = header_fields(msg_info)
+        if headers:
+            names, text = headers
+            if 'REFERENCES' in names:
+                self.references = self.get_references(text)
+            fields = header_envelope(text, names)
+            if 'envelope' in self.__dict__:
+                for key, value in fields.items():
+                    self.envelope.setdefault(key, value)
+            elif fields:
+                self.envelope = PartialEnvelope(fields, self)
+
+    def __getattr__(self, name):
+        '''Fetches the attributes that weren't on the fetch profile used'''
+        field = ATTRIBUTE_FIELDS.get(name)
+        if field is None or '_imap' not in self.__dict__:
+            raise AttributeError(name)
+        self.backfill(field)
+        return self.__dict__[name]
+
+    def backfill(self, *fields):
+        '''Fetches fields (see FETCH_FIELDS) from the server'''
+        msg_id = self.uid if self.uid is not None else self.id
+        try:
+            msg_info = self._imap.fetch(msg_id, fetch_query(fields))[msg_id]
+        except KeyError:
+            raise MessageNotFound('%s message not found' % msg_id)
+        self.load(msg_info)
+        if 'references' in fields and 'references' not in self.__dict__:
+            self.references = []
 
     # References
-    def get_references(self, msg_info):
-        ref_list = []
-        if 'BODY.PEEK[HEADER.FIELDS (REFERENCES)]' in msg_info:
-            ref_list = msg_info['BODY.PEEK[HEADER.FIELDS (REFERENCES)]']
-            ref_list = ref_list.split('References:')
-            if len(ref_list) < 2:
-                return []
-            return [ref.strip(' \r\n\t')
-                    for ref in msg_info['BODY.PEEK[HEADER.FIELDS '
-                                        '(REFERENCES)]'].split(
-                    'References:')[1].split() if ref.strip(' \r\n\t')]
-        return []
+    def get_references(self, header):
+        '''Returns the msg-ids on the References header'''
+        if isinstance(header, bytes):
+            header = str(header, 'utf-8', 'replace')
+        match = references_re.search(header)
+        if not match:
+            return []
+        return ['<%s>' % Xi for Xi in message_ids(match.group(1))]
 
     # Fetch messages
     def get_bodystructure(self):
@@ -565,6 +1132,7 @@ class Message(object):
 
     # Flags:
     def get_flags(self, flags):
+        self.flags = flags
         self.seen = SEEN in flags
         self.deleted = DELETED in flags
         self.answered = ANSWERED in flags
@@ -573,6 +1141,7 @@ class Message(object):
         self.recent = RECENT in flags
 
     def set_flags(self, *args):
+        self.folder.writable()
         self._imap.store(self.uid, '+FLAGS', args)
         if self._imap.expunged():
             # The message might have been expunged
@@ -582,11 +1151,25 @@ class Message(object):
                 raise MessageNotFound('The message was expunged,'
                                       ' Google IMAP does this...')
 
-        self.get_flags(self._imap.sstatus['fetch_response'][self.uid]['FLAGS'])
+        self.update_flags('+FLAGS', args, response_flags(self._imap))
 
     def reset_flags(self, *args):
+        self.folder.writable()
         self._imap.store(self.uid, '-FLAGS', args)
-        self.get_flags(self._imap.sstatus['fetch_response'][self.uid]['FLAGS'])
+        self.update_flags('-FLAGS', args, response_flags(self._imap))
+
+    def update_flags(self, command, flags, changed):
+        '''Updates the flags after a STORE command, see
+        MessageList.update_flags.
+
+        @param changed: the flags received with the command, see
+            response_flags.
+        '''
+        msg_id = self.uid if self.uid is not None else self.id
+        if msg_id in changed:
+            self.get_flags(changed[msg_id])
+        elif 'flags' in self.__dict__:
+            self.get_flags(store_flags(self.flags, command, flags))
 
     # Special methods
     def __repr__(self):
@@ -22,8 +22,11 @@
 # Helder Guerreiro <helder@tretas.org>
 #
 
+import hashlib
 import socket
 from .imapfolder import FolderTree
+from .message_preview import fetch_previews
+from .sort_index import SortIndex
 from imaplib2.imapp import IMAP4P
 
 
@@ -44,7 +47,12 @@ class ImapServer(object):
     '''
 
     def __init__(self, host='localhost', port=None, ssl=False,
-                 keyfile=None, certfile=None):
+                 keyfile=None, certfile=None, imap_class=None,
+                 delimiter=None, utf8=False, folder_cache=None,
+                 folder_cache_timeout=None, lazy_folders=False,
+                 index_cache=None, index_cache_timeout=None,
+                 order_cache=None, order_cache_timeout=None,
+                 preview_cache=None, preview_cache_timeout=None):
         '''
         @param host: host name of the imap server;
         @param port: port to be used. If not specified it will default to 143
@@ -53,6 +61,42 @@ class ImapServer(object):
         @type ssl: Bool
         @param keyfile: PEM formatted private key;
         @param certfile: certificate chain file for the SSL connection.
+        @param imap_class: low level connection class, see IMAP4P.
+        @param delimiter: hierarchy delimiter used by the server, if known
+            beforehand. With it the folders can be selected without listing
+            them first.
+        @param utf8: enable UTF8=ACCEPT (RFC6855) after the login, if the
+            server has it. The mailbox names are then exchanged in UTF-8
+            instead of modified UTF-7. It costs an ENABLE command.
+        @param folder_cache: cache object used to keep the folder list
+            between ImapServer instances, see hlimap.cache. A Django cache can
+            also be used.
+        @param folder_cache_timeout: folder list lifetime on the cache, in
+            seconds. If None the cache default is used.
+        @param lazy_folders: list the folders level by level, only the top
+            level folders and the sub folders of the folders on the expand
+            list are retrieved. This is only done if the server tells us
+            which folders have children (LIST-EXTENDED capability, or
+            CHILDREN when listing all the folders, not only the subscribed
+            ones). The iter_all folder iterator always gets the complete
+            folder list.
+        @param index_cache: cache object used to keep the folder sort
+            indexes between ImapServer instances, see hlimap.sort_index.
+            The indexes are only used when the server doesn't have the SORT
+            extension.
+        @param index_cache_timeout: sort index lifetime on the cache, in
+            seconds. If None the cache default is used.
+        @param order_cache: cache object used to keep the message lists
+            (SEARCH, SORT or THREAD results) between ImapServer instances,
+            so the pages of a message list can be shown without repeating
+            the command. See MessageList.get_message_list.
+        @param order_cache_timeout: message list lifetime on the cache, in
+            seconds. If None the cache default is used.
+        @param preview_cache: cache object used to keep the message
+            previews, see message_previews. The cache must also have the
+            get_many and set_many methods.
+        @param preview_cache_timeout: preview lifetime on the cache, in
+            seconds. If None the cache default is used.
         '''
         object.__init__(self)
 
@@ -62,12 +106,27 @@ class ImapServer(object):
                                 ssl=ssl,
                                 keyfile=keyfile,
                                 certfile=certfile,
-                                autologout=False)
+                                autologout=False,
+                                imap_class=imap_class)
             self.connected = True
         except socket.gaierror:
             self.connected = False
             raise
 
+        self.host = host
+        self.port = port
+        self.username = None
+        self.delimiter = delimiter
+        self.utf8 = utf8
+        self.folder_cache = folder_cache
+        self.folder_cache_timeout = folder_cache_timeout
+        self.lazy_folders = lazy_folders
+        self.index_cache = index_cache
+        self.index_cache_timeout = index_cache_timeout
+        self.order_cache = order_cache
+        self.order_cache_timeout = order_cache_timeout
+        self.preview_cache = preview_cache
+        self.preview_cache_timeout = preview_cache_timeout
         self.special_folders = []
         self.expand_list = []
         self.__folder_tree = None
@@ -80,10 +139,28 @@ class ImapServer(object):
         @param username:
         @param password:
 
+        If the server advertised AUTH=PLAIN and SASL-IR on the greeting the
+        credentials are sent with AUTHENTICATE PLAIN, this is also done if the
+        server has the LOGINDISABLED capability. Otherwise LOGIN is used. We
+        never ask the server for the capabilities just to choose the
+        authentication method.
+
         @return: it returns the LOGIN imap4 command response on the format
             defined on the imaplib2 library.
         '''
-        return self._imap.login(username, password)
+        self.username = username
+        imap = self._imap
+        if imap.capabilities and imap.has_capability('AUTH=PLAIN') and (
+                imap.has_capability('SASL-IR') or
+                imap.has_capability('LOGINDISABLED')):
+            result = imap.login_auth(username, password)
+        else:
+            result = imap.login(username, password)
+
+        if self.utf8 and imap.has_capability('UTF8=ACCEPT'):
+            imap.enable('UTF8=ACCEPT')
+
+        return result
 
     # Folder list management
 
@@ -105,11 +182,143 @@ class ImapServer(object):
         return self.__folder_tree
     folder_tree = property(_get_folder_tree)
 
+    def folder_cache_key(self, subscribed):
+        '''Key of the folder list on the folder cache. The key is unique for
+        each user and server, and safe to use with any Django cache backend.
+        The mailbox names are in UTF-8 or in modified UTF-7 depending on
+        UTF8=ACCEPT being enabled, so it's also part of the key.
+        '''
+        key = '%s\0%s\0%s\0%s\0%s' % (self.username, self.host, self.port,
+                                      bool(subscribed),
+                                      'UTF8=ACCEPT' in self._imap.enabled)
+        return 'hlimap.folders.v2.%s' % hashlib.sha1(
+            bytes(key, 'utf-8')).hexdigest()
+
+    def sort_index_key(self, path):
+        '''Key of the sort index of a folder on the index cache'''
+        key = '%s\0%s\0%s\0%s' % (self.username, self.host, self.port, path)
+        return 'hlimap.sortindex.v1.%s' % hashlib.sha1(
+            bytes(key, 'utf-8')).hexdigest()
+
+    def sort_index(self, folder):
+        '''Returns the sort index of a folder, up to date with the server.
+        The folder must be the selected one.
+
+        Without an index cache the index is kept on the folder instance.
+        '''
+        if self.index_cache is not None:
+            key = self.sort_index_key(folder.path)
+            index = self.index_cache.get(key)
+        else:
+            index = folder.sort_index
+        if index is None:
+            index = SortIndex()
+        if index.update(self._imap) and self.index_cache is not None:
+            self.index_cache.set(key, index, self.index_cache_timeout)
+        folder.sort_index = index
+        return index
+
+    def order_cache_key(self, path, *ordering):
+        '''Key of a message list on the order cache.
+
+        @param path: folder path;
+        @param ordering: strings that identify the message list, for
+            instance the search expression and the sort program.
+        '''
+        key = '\0'.join(['%s' % Xi for Xi in (self.username, self.host,
+                                               self.port, path) + ordering])
+        return 'hlimap.order.v1.%s' % hashlib.sha1(
+            bytes(key, 'utf-8')).hexdigest()
+
+    def preview_cache_key(self, path, uidvalidity, uid):
+        '''Key of a message preview on the preview cache'''
+        key = '%s\0%s\0%s\0%s\0%s\0%s' % (self.username, self.host,
+                                         self.port, path, uidvalidity, uid)
+        return 'hlimap.preview.v1.%s' % hashlib.sha1(
+            bytes(key, 'utf-8')).hexdigest()
+
+    def message_previews(self, folder, message_ids):
+        '''Returns the previews of messages, {message id: preview}. The
+        folder must be the selected one.
+
+        The previews are kept on the preview cache by UIDVALIDITY and UID,
+        only the missing ones are fetched, see hlimap.message_preview.
+        Without UIDs the previews aren't cached.
+        '''
+        uidvalidity = self._imap.sstatus['current_folder'].get('UIDVALIDITY')
+        if (self.preview_cache is None or uidvalidity is None or
+                not self._imap.has_capability('IMAP4REV1')):
+            return fetch_previews(self._imap, message_ids)
+
+        keys = dict((self.preview_cache_key(folder.path, uidvalidity, Xi),
+                     Xi) for Xi in message_ids)
+        previews = dict((keys[key], preview) for key, preview in
+                        self.preview_cache.get_many(list(keys)).items())
+        missing = [Xi for Xi in message_ids if Xi not in previews]
+        if missing:
+            fetched = fetch_previews(self._imap, missing)
+            self.preview_cache.set_many(
+                dict((self.preview_cache_key(folder.path, uidvalidity, Xi),
+                      preview) for Xi, preview in fetched.items()),
+                self.preview_cache_timeout)
+            previews.update(fetched)
+        return previews
+
+    def load_folders(self, subscribed=True, parent=None):
+        '''Loads folders to the folder tree, from the folder cache if
+        possible.
+
+        The cache entry for each user is a dict, the keys are the parent
+        folder paths of each loaded level ('*' for the complete folder list)
+        and the values are the folder tree snapshots.
+
+        @param parent: load only the sub folders of parent, '' is the top
+            level. If None the complete folder list is loaded.
+        '''
+        level = '*' if parent is None else parent
+        levels = {}
+        if self.folder_cache is not None:
+            key = self.folder_cache_key(subscribed)
+            levels = self.folder_cache.get(key) or {}
+
+        snapshot = levels.get(level)
+        if snapshot is None:
+            snapshot = self.folder_tree.list_folders(subscribed, parent)
+            if self.folder_cache is not None:
+                levels[level] = snapshot
+                self.folder_cache.set(key, levels, self.folder_cache_timeout)
+
+        self.folder_tree.load(snapshot)
+
+    def expand_folder(self, path, subscribed=True):
+        '''Loads the sub folders of path, if they aren't loaded yet'''
+        if not self.folder_tree.is_loaded(path):
+            self.load_folders(subscribed, path)
+
     def refresh_folders(self, subscribed=True):
         '''This method extracts the folder list from the
         server.
+
+        If there's a folder cache the folder list is only retrieved from
+        the server if it isn't on the cache. With lazy_folders only the top
+        level and the sub folders of the folders on the expand list are
+        loaded, unless the folder iterator is iter_all, which needs the
+        complete folder list.
         '''
-        self.folder_tree.refresh_folders(subscribed)
+        # LSUB responses don't have the CHILDREN attributes, for the
+        # subscribed folders LIST-EXTENDED is needed
+        if (self.lazy_folders and self.folder_iterator != 'iter_all' and
+                (self._imap.has_capability('LIST-EXTENDED') or
+                 (self._imap.has_capability('CHILDREN') and
+                  not subscribed))):
+            self.load_folders(subscribed, '')
+            # The parent folders have shorter paths, they're loaded first.
+            # Folders whose parent isn't loaded aren't visible.
+            for path in sorted(self.expand_list, key=len):
+                if path in self.folder_tree.folder_dict:
+                    self.expand_folder(path, subscribed)
+        else:
+            self.load_folders(subscribed)
 
         self.folder_tree.set_properties(self.expand_list,
                                         self.special_folders)
@@ -132,19 +341,67 @@ class ImapServer(object):
         else:
             raise NoFolderListError('No folder list')
 
+    def invalidate_folders(self):
+        '''Discards the folder list, from this instance and from the folder
+        cache. Used every time the folder list changes on the server.
+        '''
+        if self.folder_cache is not None:
+            for subscribed in (True, False):
+                self.folder_cache.delete(self.folder_cache_key(subscribed))
+        self.__folder_tree = None
+        if hasattr(self, 'folders'):
+            del self.folders
+
+    # Folder operations
+    def create_folder(self, path, subscribe=True):
+        '''Creates a folder.
+
+        @param path: folder path, as used by the server;
+        @param subscribe: subscribe the new folder.
+        '''
+        self._imap.create(path)
+        if subscribe:
+            self._imap.subscribe(path)
+        self.invalidate_folders()
+
+    def delete_folder(self, path):
+        self._imap.delete(path)
+        self.invalidate_folders()
+
+    def rename_folder(self, old_path, new_path):
+        self._imap.rename(old_path, new_path)
+        self.invalidate_folders()
+
+    def subscribe(self, path):
+        self._imap.subscribe(path)
+        self.invalidate_folders()
+
+    def unsubscribe(self, path):
+        self._imap.unsubscribe(path)
+        self.invalidate_folders()
+
     # Special methods
     def __del__(self):
         '''Logs out from the imap server when the class instance is deleted'''
         if self.connected:
             self._imap.logout()
 
+    def get_folder(self, path, readonly=False, refresh=False):
+        '''Returns a selected folder object.
+
+        @param path: folder path;
+        @param readonly: select the folder with EXAMINE, use it when the
+            folder isn't going to be changed;
+        @param refresh: select the folder again if it's already selected,
+            see FolderTree.select.
+        '''
+        if isinstance(path, bytes):
+            path = str(path, 'utf-8')
+        return self.folder_tree.get_folder(path, readonly, refresh)
+
     def __getitem__(self, path):
         '''Returns a folder object'''
-        if not self.folder_tree:
-            self.folder_tree = FolderTree(self)
-        if isinstance(path, bytes):
-            path = str(path, 'ascii')
-        return self.folder_tree.get_folder(path)
+        return self.get_folder(path)
 
     def __iter__(self):
         '''Iteracts through the folders'''
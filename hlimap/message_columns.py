@@ -0,0 +1,132 @@
+# WebPyMail - IMAP python/django web mail client
+# Copyright (C) 2008 Helder Guerreiro
+
+# This file is part of WebPyMail.
+#
+# WebPyMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WebPyMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@tretas.org>
+#
+
+'''Columnar message data, used by the client side sorting.
+
+Each message attribute is kept on an array, the message numbers or UIDs on
+ids, the numeric sort keys (dates as epoch ints, sizes) as they are, and the
+text sort keys replaced by their rank (the position of the value on the
+sorted list of the column values).
+
+If numpy is available the arrays are used as numpy arrays, without copying,
+and the sort programs are executed with numpy.lexsort. Otherwise the same
+operations are done in pure python.
+'''
+
+# Global imports
+from array import array
+
+try:
+    import numpy
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
+
+class MessageColumns(object):
+    '''Columnar storage of the message sort keys.
+
+    @param ids: message numbers or UIDs, the row order; the rows with the
+        same sort keys keep this order;
+    @param use_numpy: use numpy, if available.
+    '''
+
+    def __init__(self, ids, use_numpy=True):
+        self.ids = array('I', ids)
+        self.columns = {}
+        self.use_numpy = use_numpy and HAS_NUMPY
+
+    def add_column(self, name, values):
+        '''Adds a sort key column, the ints are stored as they are, the other
+        values are replaced by their rank.
+        '''
+        if all(isinstance(Xi, int) for Xi in values):
+            self.columns[name] = array('q', values)
+        else:
+            unique = sorted(set(values))
+            rank = dict(zip(unique, range(len(unique))))
+            self.columns[name] = array('I', map(rank.__getitem__, values))
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _numpy(self, column):
+        return numpy.frombuffer(column, dtype=column.typecode)
+
+    # Sort
+    def order(self, program):
+        '''Returns the row order.
+
+        @param program: list of (column name, reverse) tuples.
+        '''
+        if self.use_numpy:
+            return self._order_numpy(program)
+        return self._order_python(program)
+
+    def _order_numpy(self, program):
+        keys = []
+        for name, reverse in program:
+            column = self._numpy(self.columns[name]).astype(numpy.int64)
+            keys.append(-column if reverse else column)
+        # lexsort uses the last key as the primary one, it's stable
+        keys.reverse()
+        return numpy.lexsort(keys)
+
+    def _order_python(self, program):
+        count = len(self.ids)
+        if len(program) == 1:
+            name, reverse = program[0]
+            # The sort is stable, also when reversed
+            return sorted(range(count), key=self.columns[name].__getitem__,
+                          reverse=reverse)
+
+        # The ranks of the columns are combined in a single integer, the
+        # last digit is the row, so the integers are unique
+        key = None
+        for name, reverse in program:
+            values = self.columns[name]
+            unique = sorted(set(values), reverse=reverse)
+            ranks = map(dict(zip(unique, range(len(unique)))).__getitem__,
+                        values)
+            if key is None:
+                key = list(ranks)
+            else:
+                size = len(unique)
+                key = [Xi * size + Yi for Xi, Yi in zip(key, ranks)]
+        key = [Xi * count + Yi for Xi, Yi in zip(key, range(count))]
+        key.sort()
+        return [Xi % count for Xi in key]
+
+    def sort(self, program):
+        '''Returns the ids sorted according to the program.
+
+        @param program: list of (column name, reverse) tuples.
+        '''
+        if not program:
+            return list(self.ids)
+        order = self.order(program)
+        if self.use_numpy:
+            return self._numpy(self.ids)[order].tolist()
+        return [self.ids[Xi] for Xi in order]
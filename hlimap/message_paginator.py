@@ -42,6 +42,8 @@ class Paginator(object):
     def _get_max_page(self):
         if self.msg_per_page == -1:
             return 1
+        if self.msg_list.thread_paging():
+            return self.msg_list.number_thread_pages
         if self.msg_list.number_messages % self.msg_per_page:
             return 1 + self.msg_list.number_messages // self.msg_per_page
         else:
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+# hlimap - High level IMAP library
+# Copyright (C) 2008 Helder Guerreiro
+
+# This file is part of hlimap.
+#
+# hlimap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# hlimap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@tretas.org>
+#
+
+'''Message previews, a short text taken from the start of the message body
+to be shown on the message list.
+
+If the server has the PREVIEW extension (RFC8970) the previews are made by
+the server, a single FETCH (PREVIEW) gets them for a whole page. Otherwise
+the BODYSTRUCTURE of the page messages is fetched, the text part of each
+message is chosen (the first TEXT/PLAIN part that isn't an attachment, or
+else the first TEXT/HTML one) and only its first PARTIAL_SIZE octets are
+fetched with BODY.PEEK[<part>]<0.PARTIAL_SIZE>. The messages are grouped
+by part number, so usually there are only one or two of these commands per
+page.
+
+The previews never change, ImapServer.message_previews keeps them on a cache
+by folder, UIDVALIDITY and UID.
+'''
+
+# Global imports
+import base64
+import binascii
+import codecs
+import html
+import quopri
+import re
+
+# Constants
+PREVIEW_LENGTH = 200  # Maximum preview length, in characters
+PARTIAL_SIZE = 512  # Octets of the text part fetched without PREVIEW
+
+# Blocks without text, the ones cut at the end of the partial fetch are
+# removed up to the end
+block_re = re.compile(r'<(style|script|head)\b.*?(?:</\1\s*>|$)|'
+                      r'<!--.*?(?:-->|$)', re.S | re.I)
+# Tags, including one cut at the end
+tag_re = re.compile(r'<[^>]*(?:>|$)')
+quoted_re = re.compile(r'^[ \t]*>.*$', re.M)
+space_re = re.compile(r'\s+')
+base64_skip_re = re.compile(r'[^A-Za-z0-9+/=]')
+# Soft line break or encoded octet cut at the end of the partial fetch
+qp_tail_re = re.compile(r'=[0-9A-Fa-f]?$')
+
+
+def snippet(text, is_html=False, length=PREVIEW_LENGTH):
+    '''Returns the preview of a text, the quoted lines are dropped and the
+    white space is collapsed. The text is cut on a word boundary.
+
+    @param text: start of the message text;
+    @param is_html: remove the HTML markup;
+    @param length: maximum length of the preview.
+    '''
+    if is_html:
+        text = html.unescape(tag_re.sub(' ', block_re.sub(' ', text)))
+    text = space_re.sub(' ', quoted_re.sub('', text)).strip()
+    if len(text) > length:
+        text = text[:length + 1]
+        cut = text.rfind(' ', length // 2)
+        text = text[:cut if cut != -1 else length].rstrip() + '...'
+    return text
+
+
+def text_part(bodystructure):
+    '''Returns the part used for the preview, or None if the message has no
+    text part.
+    '''
+    html_part = None
+    for part in bodystructure.serial_message():
+        if not part.is_text() or part.is_attachment():
+            continue
+        if part.is_plain():
+            return part
+        if part.is_html() and html_part is None:
+            html_part = part
+    return html_part
+
+
+def decode_partial(text, part):
+    '''Decodes the start of a text part. The transfer encoding and the
+    charset may be cut anywhere, an incomplete sequence at the end is
+    dropped.
+
+    @param text: the partial fetch response, imapll has already decoded the
+        8bit parts;
+    @param part: the text part, from the BODYSTRUCTURE.
+    '''
+    encoding = (part.body_fld_enc or '').upper()
+    if encoding == 'BASE64':
+        text = base64_skip_re.sub('', text)
+        text = text[:len(text) - len(text) % 4]
+        try:
+            data = base64.b64decode(text)
+        except (binascii.Error, ValueError):
+            return ''
+    elif encoding == 'QUOTED-PRINTABLE':
+        data = quopri.decodestring(bytes(qp_tail_re.sub('', text), 'utf-8'))
+    else:
+        return text
+
+    try:
+        decoder = codecs.getincrementaldecoder(part.charset())('replace')
+    except LookupError:
+        decoder = codecs.getincrementaldecoder('iso-8859-1')()
+    return decoder.decode(data)
+
+
+def fetch_previews(imap, message_ids, length=PREVIEW_LENGTH):
+    '''Fetches the previews of messages of the selected folder.
+
+    @param imap: IMAP4P instance;
+    @param message_ids: message UIDs, or numbers if the server doesn't have
+        UIDs;
+    @param length: maximum length of the previews.
+
+    @return: a dict {message id: preview}, the preview of a message without
+        text is an empty string.
+    '''
+    previews = {}
+    if not message_ids:
+        return previews
+
+    if imap.has_capability('PREVIEW'):
+        for msg_id, msg_info in imap.fetch(message_ids,
+                                           '(PREVIEW)').items():
+            previews[msg_id] = snippet(msg_info.get('PREVIEW') or '',
+                                       length=length)
+        return previews
+
+    sections = {}
+    for msg_id, msg_info in imap.fetch(message_ids,
+                                       '(BODYSTRUCTURE)').items():
+        part = text_part(msg_info['BODYSTRUCTURE'])
+        if part is None:
+            previews[msg_id] = ''
+        else:
+            sections.setdefault(part.part_number, []).append((msg_id, part))
+
+    for section, parts in sections.items():
+        # The response item is BODY[<section>]<0>
+        key = 'BODY[%s]<0>' % section
+        response = imap.fetch([msg_id for msg_id, part in parts],
+                              '(BODY.PEEK[%s]<0.%d>)' % (section,
+                                                         PARTIAL_SIZE))
+        for msg_id, part in parts:
+            text = response.get(msg_id, {}).get(key) or ''
+            previews[msg_id] = snippet(decode_partial(text, part),
+                                       part.is_html(), length)
+    return previews
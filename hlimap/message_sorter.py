@@ -22,16 +22,169 @@
 
 '''
 Client side message sorting
+
+The sort program is compiled: for each sort keyword a column with the key of
+each message is computed (epoch ints for the dates, case folded strings for
+the text keys), and the messages are sorted once on all the columns, see
+MessageColumns. The key of each message is cached on the Message instance,
+so sorting the same messages again with another program only computes the
+new columns.
+
+The programs with one or two keywords, the usual ones, are sorted without
+MessageColumns: a stable sort on each keyword, from the last to the first,
+with the dates compared as the datetimes returned by imaplib2.
+
+The keys follow RFC 5256 and RFC 5957 (DISPLAYFROM and DISPLAYTO), the
+messages with the same keys are kept on the message number order.
 '''
 
+# Global imports
+import datetime
+
+# Local imports
+from .message_columns import MessageColumns
+from .message_threader import base_subject
+
+# Constants
+EPOCH = datetime.datetime(1970, 1, 1)
+UTC = datetime.timezone.utc
+# Date returned by imaplib2 for missing or invalid dates
+INVALID_DATE = datetime.datetime.fromtimestamp(0)
+
 
 class SortProgError(Exception):
     pass
 
 
-class Sorter:
-    '''This class provides the comparison function for sorting messages
-    according to the provided sort program.
+def epoch(date):
+    '''Seconds since 1970-01-01, the naive dates (the ones returned by
+    imaplib2) are used as they are.
+    '''
+    if date is None:
+        return 0
+    if date.tzinfo is not None:
+        return int(date.timestamp())
+    # Faster than dividing by a timedelta
+    delta = date - EPOCH
+    return delta.days * 86400 + delta.seconds
+
+
+def naive_utc(date):
+    '''The date as a naive datetime, the aware dates are converted to UTC.
+    Compares like epoch.
+    '''
+    if date.tzinfo is not None:
+        return date.astimezone(UTC).replace(tzinfo=None)
+    return date
+
+
+def first_mailbox(addresses):
+    '''The local part of the first address, lower case'''
+    if not addresses:
+        return ''
+    return addresses[0][1].rpartition('@')[0].casefold()
+
+
+def first_display(addresses):
+    '''The display name of the first address or, if it hasn't one, the
+    address, case folded.
+    '''
+    if not addresses:
+        return ''
+    name, address = addresses[0]
+    return (name or address).casefold()
+
+
+def key_ARRIVAL(message):
+    return epoch(message.internaldate)
+
+
+def key_CC(message):
+    return first_mailbox(message.envelope['env_cc'])
+
+
+def key_DATE(message):
+    # If the sent date is missing or invalid use the internal date
+    date = message.envelope['env_date']
+    if date is None or date == INVALID_DATE:
+        date = message.internaldate
+    return epoch(date)
+
+
+def key_DISPLAYFROM(message):
+    return first_display(message.envelope['env_from'])
+
+
+def key_DISPLAYTO(message):
+    return first_display(message.envelope['env_to'])
+
+
+def key_FROM(message):
+    return first_mailbox(message.envelope['env_from'])
+
+
+def key_SIZE(message):
+    try:
+        return int(message.size)
+    except (TypeError, ValueError):
+        return 0
+
+
+def key_SUBJECT(message):
+    return base_subject(message.envelope['env_subject'])[0].casefold()
+
+
+def key_TO(message):
+    return first_mailbox(message.envelope['env_to'])
+
+
+def datetime_column(messages, keyword):
+    '''The ARRIVAL or DATE keys of the messages as naive datetimes, in the
+    same order as key_ARRIVAL and key_DATE.
+    '''
+    if keyword == 'DATE':
+        dates = [Xi.envelope['env_date'] for Xi in messages]
+        dates = [Yi.internaldate if Xi is None or Xi == INVALID_DATE else Xi
+                 for Xi, Yi in zip(dates, messages)]
+    else:
+        dates = [Xi.internaldate for Xi in messages]
+    return [EPOCH if Xi is None else naive_utc(Xi) for Xi in dates]
+
+
+KEY_FUNCTIONS = {'ARRIVAL': key_ARRIVAL,
+                 'CC': key_CC,
+                 'DATE': key_DATE,
+                 'DISPLAYFROM': key_DISPLAYFROM,
+                 'DISPLAYTO': key_DISPLAYTO,
+                 'FROM': key_FROM,
+                 'SIZE': key_SIZE,
+                 'SUBJECT': key_SUBJECT,
+                 'TO': key_TO}
+
+
+def compile_program(sort_program):
+    '''Compiles a sort program.
+
+    @param sort_program: sequence of sort keywords, each one optionally
+        prefixed by '-' for the reverse order.
+
+    @return: list of (keyword, key function, reverse) tuples.
+    '''
+    program = []
+    for keyword in sort_program:
+        reverse = keyword[:1] == '-'
+        if reverse:
+            keyword = keyword[1:]
+        keyword = keyword.upper()
+        try:
+            program.append((keyword, KEY_FUNCTIONS[keyword], reverse))
+        except KeyError:
+            raise SortProgError('Sort key unknown: %s' % keyword)
+    return program
+
+
+class Sorter(object):
+    '''Sorts a message list according to the provided sort program.
     '''
 
     def __init__(self, message_list, message_dict, sort_program):
@@ -44,36 +197,90 @@ class Sorter:
         self.message_list = message_list
         self.message_dict = message_dict
         self.sort_program = sort_program
+        self.program = compile_program(sort_program)
 
-    def key_ARRIVAL(self, k):
-        return self.message_dict[k]['data'].internaldate
-
-    def key_CC(self, k):
-        return ', '.join(self.message_dict[k]['data'].envelope.cc_short())
-
-    def key_FROM(self, k):
-        return ', '.join(self.message_dict[k]['data'].envelope.from_short())
-
-    def key_DATE(self, k):
-        return self.message_dict[k]['data'].envelope['env_date']
-
-    def key_SIZE(self, k):
-        return self.message_dict[k]['data'].size
-
-    def key_SUBJECT(self, k):
-        return self.message_dict[k]['data'].envelope['env_subject']
+    def column(self, messages, keyword, function):
+        '''Returns the key of each message, the keys are cached on the
+        Message instances.
+        '''
+        try:
+            return [Xi.sort_keys[keyword] for Xi in messages]
+        except KeyError:
+            pass
+        if messages and keyword not in messages[0].sort_keys:
+            # Usually none of the keys is cached
+            values = [function(Xi) for Xi in messages]
+            for message, value in zip(messages, values):
+                message.sort_keys[keyword] = value
+            return values
+        values = []
+        append = values.append
+        for message in messages:
+            cache = message.sort_keys
+            if keyword not in cache:
+                cache[keyword] = function(message)
+            append(cache[keyword])
+        return values
 
-    def key_TO(self, k):
-        return ', '.join(self.message_dict[k]['data'].envelope.to_short())
+    def sort_dates(self, message_list, keyword, reverse):
+        '''Sorts the messages by ARRIVAL or DATE, as key_ARRIVAL and
+        key_DATE do. The dates are first compared as imaplib2 returns them,
+        naive datetimes. If that fails (aware dates) or the lowest date is
+        missing or invalid, datetime_column is used.
+        '''
+        message_dict = self.message_dict
+        if keyword == 'DATE':
+            def key(message_id):
+                return message_dict[message_id]['data'].envelope['env_date']
+        else:
+            def key(message_id):
+                return message_dict[message_id]['data'].internaldate
+        try:
+            result = sorted(message_list, key=key, reverse=reverse)
+            # The missing or invalid dates would be the lowest ones
+            if not result or key(result[-1 if reverse else 0]) > INVALID_DATE:
+                return result
+        except TypeError:
+            pass
+        column = datetime_column([message_dict[Xi]['data']
+                                  for Xi in message_list], keyword)
+        return sorted(message_list,
+                      key=dict(zip(message_list, column)).__getitem__,
+                      reverse=reverse)
 
     def run(self):
         '''Read the sort program and executes it
         '''
-        for keyword in reversed(self.sort_program):
-            reverse = False
-            if keyword[0] == '-':
-                reverse = True
-                keyword = keyword[1:]
-            key_meth = getattr(self, 'key_%s' % keyword)
-            self.message_list.sort(key=key_meth, reverse=reverse)
+        if not self.program:
+            return self.message_list
+        message_list = sorted(self.message_list)
+        if len(self.program) <= 2:
+            # Short programs are sorted straight on the keys, a stable sort
+            # for each keyword from the last to the first, this is faster
+            # than building the MessageColumns
+            keys = {}
+            for keyword, function, reverse in self.program:
+                if keyword not in ('ARRIVAL', 'DATE'):
+                    # Computed on the message number order, before sorting
+                    messages = [self.message_dict[Xi]['data']
+                                for Xi in message_list]
+                    keys[keyword] = dict(zip(message_list, self.column(
+                        messages, keyword, function))).__getitem__
+            for keyword, function, reverse in reversed(self.program):
+                if keyword in keys:
+                    message_list.sort(key=keys[keyword], reverse=reverse)
+                else:
+                    message_list = self.sort_dates(message_list, keyword,
+                                                   reverse)
+            self.message_list = message_list
+            return self.message_list
+        messages = [self.message_dict[Xi]['data'] for Xi in message_list]
+        columns = MessageColumns(message_list)
+        for keyword, function, reverse in self.program:
+            if keyword not in columns:
+                columns.add_column(keyword,
+                                   self.column(messages, keyword, function))
+        self.message_list = columns.sort([(keyword, reverse) for
+                                          keyword, function, reverse in
+                                          self.program])
         return self.message_list
@@ -20,44 +20,54 @@
 # Helder Guerreiro <helder@tretas.org>
 #
 
-import collections
-import datetime
-import uuid
+'''Client side REFERENCES threading (RFC 5256).
 
+Used when the server doesn't have the THREAD extension. The messages are kept
+on flat lists indexed by a node number, the Message-IDs are mapped to nodes
+on a dict, and all the tree traversals are iterative, so the running time is
+linear on the number of messages (and references) and deep threads don't hit
+the recursion limit.
 
-def transverse_thread(thread_messages, message_id):
-    m = thread_messages
-    for child in m[message_id]['children']:
-        yield transverse_thread(thread_messages, child)
-    if message_id != 'root':
-        yield message_id
+The ORDEREDSUBJECT algorithm is also available, it only needs the message
+envelopes, so it's cheaper than REFERENCES.
+'''
 
+# Global imports
+import functools
+import re
 
-class Threader:
-    '''Implements the client side REFERENCES threading algorithm defined in
-    RFC 5256 - https://tools.ietf.org/html/rfc5256
+from imaplib2.utils import ThreadList
 
-    This is an adaptation of the threading algorithm by Jamie Zawinski which
-    was included in Netscape News and Mail 2.0 and 3.0:
+# Constants
+THREAD_ALGORITHMS = ('ORDEREDSUBJECT', 'REFERENCES')
+CACHE_SIZE = 8192
 
-    https://www.jwz.org/doc/threading.html
-    '''
+# Regexps
+message_id_re = re.compile(r'<([^<>]*)>')
+quoted_re = re.compile(r'"((?:[^"\\]|\\.)*)"')
+quoted_pair_re = re.compile(r'\\(.)')
 
-    def __init__(self, message_list, message_dict):
-        self.message_list = message_list
-        self.message_dict = message_dict
-        self.thread_messages = collections.defaultdict(
-                lambda: {'imap_id': None,
-                         'parent': None,
-                         'children': [],
-                         'references': [],
-                         'dummy': True,
-                         'sent_date': datetime.datetime(1970, 1, 1, 0, 0, 0),
-                         'subject': '', })
-
-    def normalize_message_id(self, message_id):
-        '''
-        From the RFC:
+subj_trailer_re = re.compile(r'(?:\s*\(fwd\))+\s*$', re.I)
+subj_refwd_re = re.compile(r'(?:\[[^\[\]]*\]\s*)*(?:re|fwd?)\s*'
+                           r'(?:\[[^\[\]]*\]\s*)?:', re.I)
+subj_blob_re = re.compile(r'\[[^\[\]]*\]\s*')
+subj_fwd_re = re.compile(r'\[fwd:(.*)\]$', re.I)
+
+
+class ThreadAlgError(Exception):
+    pass
+
+
+def unquote_message_id(message_id):
+    message_id = message_id.strip()
+    if '"' in message_id:
+        message_id = quoted_re.sub(
+            lambda Xi: quoted_pair_re.sub(r'\1', Xi.group(1)), message_id)
+    return message_id
+
+
+def normalize_message_id(message_id):
+    '''Normalizes a msg-id. From the RFC:
 
         Implementations of the REFERENCES threading algorithm MUST
         normalize any msg-id in order to avoid false non-matches due
@@ -68,183 +78,371 @@ class Threader:
         and the msg-id
            <01KF8JCEOCBS0045PS@xxx.yyy.com>
         MUST be interpreted as being the same Message ID.
-        '''
-        # This is the simplistic aproach for this problem
-        # in the future a more robust soluction must be found
-        if message_id:
-            return message_id.replace('<', ''
-                                      ).replace('>', ''
-                                                ).replace('"', '')
+
+    @return: the msg-id without the angle brackets and quoting, or '' if
+        message_id isn't a valid msg-id.
+    '''
+    if not message_id:
         return ''
+    match = message_id_re.search(message_id)
+    if not match:
+        return ''
+    return unquote_message_id(match.group(1))
 
-    def get_message_id(self, msg_id, message_id_list):
-        '''Get the header "Message-ID:" from the message with UID or sequence
-        number "msg_id".
-        Each "Message-ID" must be normalized.
-        '''
-        message = self.message_dict[msg_id]['data']
-        # Get the message_id header
-        message_id = message.envelope['env_message_id']
-        # Normalize the Message-ID:
-        message_id = self.normalize_message_id(message_id)
-        # If two or more messages have the same Message ID,
-        # then only use that Message ID in the first (lowest
-        # sequence number) message, and assign a unique
-        # Message ID to each of the subsequent messages with
-        # a duplicate of that Message ID.
-        if message_id in message_id_list:
-            message_id = str(uuid.uuid4()) + '+' + message_id
-        message_id_list.append(message_id)
-        return message_id
-
-    def get_messages_references(self, msg_id):
-        '''
-        Retrive the references of the message, normalize them and store them
-        '''
-        message = self.message_dict[msg_id]['data']
-        references = [self.normalize_message_id(message_id)
-                      for message_id in message.references]
-        return references
 
-    def collect_message_information(self):
-        message_id_list = []
-        for msg_id in sorted(self.message_list):
-            message_id = self.get_message_id(msg_id, message_id_list)
-            references = self.get_messages_references(msg_id)
-            self.thread_messages[message_id]['dummy'] = False
-            self.thread_messages[message_id]['references'] = references
-            self.thread_messages[message_id]['imap_id'] = msg_id
-            self.thread_messages[message_id]['sent_date'] = (
-                self.message_dict[msg_id]['data'].envelope['env_date'])
-            self.thread_messages[message_id]['subject'] = (
-                self.message_dict[msg_id]['data'].envelope['env_subject'])
-
-    def find_family_from_references(self):
-        '''
-        Step (1)
-        (A) Using the Message IDs in the message's references, link
-        the corresponding messages (those whose Message-ID
-        header line contains the given reference Message ID)
-        together as parent/child.  Make the first reference the
-        parent of the second (and the second a child of the
-        first), the second the parent of the third (and the
-        third a child of the second), etc.
-
-        (B) Create a parent/child link between the last reference
-        (or NIL if there are no references) and the current
-        message.  If the current message already has a parent,
-        it is probably the result of a truncated References
-        header line, so break the current parent/child link
-        before creating the new correct one.  As in step 1.A,
-        do not create the parent/child link if creating that
-        link would introduce a loop.  Note that if this message
-        has no references, it will now have no parent.
-        '''
-        m = self.thread_messages
-        for message_id in list(self.thread_messages.keys()):
-            references = m[message_id]['references']
-            for ref_1, ref_2 in zip(references, references[1:]):
-                if ref_2 not in m[ref_1]['children']:
-                    m[ref_1]['children'].append(ref_2)
-                # Do not create a parent/child link if creating that
-                # link would introduce a loop.  For example, before
-                # making message A the parent of B, make sure that A
-                # is not a descendent of B.
-                if ref_1 not in m[ref_2]['children']:
-                    m[ref_2]['parent'] = ref_1
-            if references:
-                m[message_id]['parent'] = references[-1]
-                if message_id not in m[references[-1]]['children']:
-                    m[references[-1]]['children'].append(message_id)
-            # House keeping
-            del m[message_id]['references']
-
-    def create_root_message(self):
-        '''
-        Step (2)
-        Gather together all of the messages that have no parents
-        and make them all children (siblings of one another) of a
-        dummy parent (the "root").  These messages constitute the
-        first (head) message of the threads created thus far.
-        '''
-        m = self.thread_messages
-        for message_id in list(self.thread_messages.keys()):
-            if not m[message_id]['parent']:
-                m[message_id]['parent'] = 'root'
-                m['root']['children'].append(message_id)
+def message_ids(text):
+    '''Returns the normalized msg-ids found on a References or In-Reply-To
+    header value.
+    '''
+    if not text:
+        return []
+    return [unquote_message_id(Xi) for Xi in message_id_re.findall(text)
+            if Xi.strip()]
 
-    def prune_dummy_messages(self):
-        '''
-        Step (3)
-        Prune dummy messages from the thread tree.  Traverse each
-        thread under the root, and for each message:
 
-            If it is a dummy message with NO children, delete it.
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def base_subject(subject):
+    '''Extracts the base subject as defined in RFC 5256 section 2.1. The
+    results are memoized, the replies share the subject of the original
+    message.
 
-            If it is a dummy message with children, delete it, but
-            promote its children to the current level.  In other
-            words, splice them in with the dummy's siblings.
+    @return: (base subject, is_reply) where is_reply is True if the subject
+        had a reply or forward marker ("Re:", "Fwd:", "(fwd)" or
+        "[Fwd: ...]").
+    '''
+    # (1) Collapse the white space
+    subject = ' '.join((subject or '').split())
+    is_reply = False
+    while True:
+        # (2) Remove the "(fwd)" trailers
+        subject, count = subj_trailer_re.subn('', subject)
+        if count:
+            is_reply = True
+        # (3), (4) and (5) Remove the "Re:" leaders and the blobs
+        while True:
+            previous = subject
+            subject = subject.lstrip()
+            match = subj_refwd_re.match(subject)
+            if match:
+                subject = subject[match.end():]
+                is_reply = True
+            match = subj_blob_re.match(subject)
+            if match and subject[match.end():].strip():
+                subject = subject[match.end():]
+            if subject == previous:
+                break
+        # (6) Remove the "[Fwd: ... ]" wrapper
+        match = subj_fwd_re.match(subject)
+        if not match:
+            return subject.strip(), is_reply
+        subject = match.group(1)
+        is_reply = True
 
-            Do not promote the children if doing so would make them
-            children of the root, unless there is only one child.
-        '''
-        m = self.thread_messages
-        for message_id in transverse_thread(self.thread_messages, 'root'):
-            if m['message_id']['dummy']:
-                if m['message_id']['children']:
-                    if (m['message_id']['parent'] != 'root' or
-                            len(m['message_id']['children']) == 1):
-                        parent = m['message_id']['parent']
-                        m[parent]['children'] += m['message_id']['children']
-                        for child in m['message_id']['children']:
-                            m[child]['parent'] = parent
-                del m['message_id']
+
+def thread_references(messages, merge_subjects=True):
+    '''Threads messages using the RFC 5256 REFERENCES algorithm.
+
+    @param messages: iterable of (message number or UID, Message-ID,
+        references, sent date, subject) tuples, sorted by message number.
+        The references is a list of msg-ids, already falling back to the
+        first In-Reply-To msg-id if there is no References header;
+    @param merge_subjects: merge the threads with the same base subject
+        (step 5).
+
+    @return: a ThreadList instance.
+    '''
+    nodes = {}        # Message-ID -> node
+    imap_ids = []     # node -> message number, None for dummy messages
+    parents = []      # node -> parent node, -1 for none
+    children = []     # node -> list of child nodes or None
+    dates = []
+    subjects = []
+
+    def node(message_id):
+        index = nodes.get(message_id)
+        if index is None:
+            index = nodes[message_id] = len(imap_ids)
+            imap_ids.append(None)
+            parents.append(-1)
+            children.append(None)
+            dates.append(None)
+            subjects.append(None)
+        return index
+
+    def unlink(child):
+        children[parents[child]].remove(child)
+        parents[child] = -1
+
+    def link(parent, child):
+        # Do not create a parent/child link if creating that link would
+        # introduce a loop, that is, if parent is a descendant of child.
+        # We only have to walk up the tree if child has descendants.
+        if parent == child:
+            return
+        if children[child]:
+            ancestor = parent
+            while ancestor != -1:
+                if ancestor == child:
+                    return
+                ancestor = parents[ancestor]
+        if parents[child] != -1:
+            unlink(child)
+        parents[child] = parent
+        if children[parent] is None:
+            children[parent] = [child]
+        else:
+            children[parent].append(child)
+
+    # Step (1)
+    for imap_id, message_id, references, date, subject in messages:
+        message_id = normalize_message_id(message_id)
+        if (not message_id or (message_id in nodes and
+                               imap_ids[nodes[message_id]] is not None)):
+            # Messages without Message-ID, or with one already used by a
+            # previous message, get an unique id
+            current = node((message_id, imap_id))
+        else:
+            current = node(message_id)
+        imap_ids[current] = imap_id
+        dates[current] = date
+        subjects[current] = subject
+
+        # (A) Link the references together as parent/child, unless the
+        # child is already linked
+        previous = -1
+        for reference in references:
+            reference = normalize_message_id(reference)
+            if not reference:
                 continue
+            reference = node(reference)
+            if previous != -1 and parents[reference] == -1:
+                link(previous, reference)
+            previous = reference
 
-    def sort_messages(self):
-        '''
-        Step (4)
-        Sort the messages under the root (top-level siblings only)
-        by sent date as described in section 2.2.  In the case of a
-        dummy message, sort its children by sent date and then use
-        the first child for the top-level sort.
+        # (B) The last reference is the parent of the current message, if
+        # the message already had a parent it's replaced
+        if parents[current] != previous:
+            if parents[current] != -1:
+                unlink(current)
+            if previous != -1:
+                link(previous, current)
+
+    # Step (2)
+    roots = [Xi for Xi in range(len(imap_ids)) if parents[Xi] == -1]
+
+    def descendants_first(roots):
+        # Reversed pre-order, each node comes after all its descendants
+        order = []
+        stack = list(roots)
+        while stack:
+            index = stack.pop()
+            order.append(index)
+            if children[index]:
+                stack.extend(children[index])
+        order.reverse()
+        return order
+
+    # Step (3) Prune the dummy messages
+    for index in descendants_first(roots):
+        if not children[index]:
+            continue
+        pruned = []
+        for child in children[index]:
+            if imap_ids[child] is not None:
+                pruned.append(child)
+            elif children[child]:
+                # Promote the dummy's children (already pruned)
+                for grandchild in children[child]:
+                    parents[grandchild] = index
+                pruned.extend(children[child])
+        children[index] = pruned
+    pruned = []
+    for root in roots:
+        if imap_ids[root] is None:
+            if not children[root]:
+                continue
+            if len(children[root]) == 1:
+                # Only promote to the root a single child
+                root = children[root][0]
+                parents[root] = -1
+        pruned.append(root)
+    roots = pruned
+
+    def sort_key(index):
+        # Dummy messages are sorted by their first child
+        while imap_ids[index] is None:
+            index = children[index][0]
+        return (dates[index], imap_ids[index])
+
+    # Step (4) Sort the top level messages
+    for root in roots:
+        if imap_ids[root] is None:
+            children[root].sort(key=sort_key)
+    roots.sort(key=sort_key)
+
+    # Step (5) Gather together the threads with the same base subject
+    if merge_subjects:
+        thread_subjects = []
+        is_reply = {}
+        for root in roots:
+            if imap_ids[root] is None:
+                subject = base_subject(subjects[children[root][0]])[0]
+            else:
+                subject, is_reply[root] = base_subject(subjects[root])
+            thread_subjects.append(subject.lower())
+
+        table = {}
+        for root, subject in zip(roots, thread_subjects):
+            if not subject:
+                continue
+            other = table.get(subject)
+            if other is None:
+                table[subject] = root
+            elif (imap_ids[other] is not None and
+                  (imap_ids[root] is None or
+                   (is_reply[other] and not is_reply[root]))):
+                table[subject] = root
+
+        for root, subject in zip(roots, thread_subjects):
+            if not subject or parents[root] != -1:
+                continue
+            other = table[subject]
+            if other == root:
+                continue
+            if imap_ids[other] is None and imap_ids[root] is None:
+                # Both dummies, the children become siblings
+                for child in children[root]:
+                    parents[child] = other
+                children[other].extend(children[root])
+                children[root] = None
+                parents[root] = -2
+            elif imap_ids[other] is None or (
+                    imap_ids[root] is not None and is_reply[root] and
+                    not is_reply.get(other, False)):
+                link(other, root)
+            else:
+                # New dummy with both threads as children
+                dummy = node((None, len(imap_ids)))
+                parents[other] = parents[root] = dummy
+                children[dummy] = [other, root]
+                roots.append(dummy)
+                table[subject] = dummy
+        roots = [Xi for Xi in roots if parents[Xi] == -1]
+
+    # Step (6) Sort the siblings by sent date, the youngest siblings first
+    for index in descendants_first(roots):
+        if children[index] and len(children[index]) > 1:
+            children[index].sort(key=sort_key)
+    roots.sort(key=sort_key)
+
+    # Create the thread list, the dummy messages are omitted
+    result = ThreadList()
+    ids = result.ids
+    levels = result.levels
+    for root in roots:
+        result.roots.append(len(ids))
+        stack = [(root, -1)]
+        while stack:
+            index, parent = stack.pop()
+            if imap_ids[index] is None:
+                position = parent
+            else:
+                position = len(ids)
+                ids.append(imap_ids[index])
+                result.parents.append(parent)
+                levels.append(levels[parent] + 1 if parent != -1 else 0)
+            if children[index]:
+                stack.extend((Xi, position)
+                             for Xi in reversed(children[index]))
+    return result
+
+
+def thread_orderedsubject(messages):
+    '''Threads messages using the RFC 5256 ORDEREDSUBJECT algorithm. The
+    messages are grouped by base subject, the first message (by sent date)
+    of each group is the parent of the other messages of the group. The
+    threads are sorted by the sent date of their first message.
+
+    @param messages: iterable of (message number or UID, Message-ID,
+        references, sent date, subject) tuples, the Message-ID and the
+        references are ignored.
+
+    @return: a ThreadList instance.
+    '''
+    groups = {}
+    for imap_id, message_id, references, date, subject in messages:
+        subject = base_subject(subject)[0].lower()
+        if subject in groups:
+            groups[subject].append((date, imap_id))
+        else:
+            groups[subject] = [(date, imap_id)]
+    for group in groups.values():
+        group.sort()
+    threads = sorted(groups.values(), key=lambda Xi: Xi[0])
+
+    result = ThreadList()
+    ids = result.ids
+    parents = result.parents
+    levels = result.levels
+    for group in threads:
+        root = len(ids)
+        result.roots.append(root)
+        ids.append(group[0][1])
+        parents.append(-1)
+        levels.append(0)
+        for date, imap_id in group[1:]:
+            ids.append(imap_id)
+            parents.append(root)
+            levels.append(1)
+    return result
+
+
+class Threader(object):
+    '''Implements the client side threading algorithms defined in RFC 5256 -
+    https://tools.ietf.org/html/rfc5256
+
+    The REFERENCES algorithm is an adaptation of the threading algorithm by
+    Jamie Zawinski which was included in Netscape News and Mail 2.0 and 3.0:
+
+    https://www.jwz.org/doc/threading.html
+
+    @param message_list: message numbers or UIDs to thread;
+    @param message_dict: dict with the Message instances, on
+        message_dict[msg_id]['data'];
+    @param algorithm: REFERENCES or ORDEREDSUBJECT.
+    '''
+
+    def __init__(self, message_list, message_dict, algorithm='REFERENCES'):
+        algorithm = algorithm.upper()
+        if algorithm not in THREAD_ALGORITHMS:
+            raise ThreadAlgError('Unknown threading algorithm: %s' %
+                                 algorithm)
+        self.message_list = message_list
+        self.message_dict = message_dict
+        self.algorithm = algorithm
+
+    def messages(self):
+        '''Yields the information needed by thread_references for each
+        message.
         '''
-        def sort_by_date(thread_messages, message_id):
-            def children_sort(message_id):
-                if not thread_messages[message_id]['dummy']:
-                    return thread_messages[message_id]['sent_date']
-                sort_by_date(thread_messages, message_id)
-                first_born = thread_messages[message_id]['children'][0]
-                return thread_messages[first_born]['sent_date']
-            if thread_messages[message_id]['children']:
-                thread_messages[message_id]['children'].sort(key=children_sort)
-        sort_by_date(self.thread_messages, 'root')
-
-    def create_thread_list(self, message_id='root'):
-        m = self.thread_messages
-        message_list = []
-        if not m[message_id]['dummy']:
-            message_list.append(m[message_id]['imap_id'])
-        if len(m[message_id]['children']) == 1:
-            first_child = m[message_id]['children'][0]
-            message_list += self.create_thread_list(first_child)
-        elif len(m[message_id]['children']) > 1:
-            for child in m[message_id]['children']:
-                message_list.append(self.create_thread_list(child))
-        return message_list
+        for msg_id in sorted(self.message_list):
+            message = self.message_dict[msg_id]['data']
+            envelope = message.envelope
+            if self.algorithm == 'ORDEREDSUBJECT':
+                # Only the subject and date are used
+                yield (msg_id, None, [], envelope['env_date'],
+                       envelope['env_subject'])
+                continue
+            references = message.references
+            if not references and self.algorithm == 'REFERENCES':
+                # If a message doesn't have a References header line use the
+                # first In-Reply-To Message ID
+                references = message_ids(envelope['env_in_reply_to'])[:1]
+            yield (msg_id, envelope['env_message_id'], references,
+                   envelope['env_date'], envelope['env_subject'])
 
     def run(self):
-        self.collect_message_information()
-        # Step (1)
-        self.find_family_from_references()
-        # Step (2)
-        self.create_root_message()
-        # Step (3)
-        self.prune_dummy_messages()
-        # Step (4)
-        self.sort_messages()
-        # Step (5)
-
-        print("#"*80)
-
-        return self.create_thread_list('root')
+        '''@return: a ThreadList instance'''
+        if self.algorithm == 'ORDEREDSUBJECT':
+            return thread_orderedsubject(self.messages())
+        return thread_references(self.messages())
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+
+# hlimap - High level IMAP library
+# Copyright (C) 2008 Helder Guerreiro
+
+# This file is part of hlimap.
+#
+# hlimap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# hlimap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@tretas.org>
+#
+
+'''Byte ranges of the decoded contents of a message part, fetched with
+partial FETCH (BODY.PEEK[<part>]<<start>.<length>>), used to answer HTTP
+Range requests without downloading the whole attachment.
+
+Two transfer encodings are supported:
+
+    * 7BIT - the decoded contents are the encoded ones, the range is
+      fetched directly;
+    * BASE64 - the range is mapped onto the encoded text. This assumes all
+      the lines have the same length except the last one, as every MIME
+      encoder does. The line length is read from the start of the part and
+      the padding from its end, on the same FETCH as the range. If the
+      line length isn't the one guessed (76 characters) a second FETCH is
+      needed. If the part doesn't look like this None is returned and the
+      whole part should be used instead.
+
+The BINARY extension (RFC3516) would avoid the mapping, but its responses are
+raw octets and imapll hands the response lines over as str, which isn't
+lossless for arbitrary octets.
+'''
+
+# Global imports
+import base64
+import binascii
+import re
+
+# Constants
+LINE_LENGTH = 76  # Usual base64 line length, RFC2045 maximum
+HEAD_SIZE = 128  # Octets read to find the line length
+TAIL_SIZE = 8  # Octets read to find the padding and the last line break
+
+base64_skip_re = re.compile(r'[^A-Za-z0-9+/=]')
+
+
+def range_encodings():
+    '''Transfer encodings for which part_range works'''
+    return ('7BIT', 'BASE64')
+
+
+class Base64Layout(object):
+    '''Layout of a base64 encoded part with fixed length lines.
+
+    @param line_length: characters per line, without the line break;
+    @param separator: line break length, 2 for CRLF.
+    '''
+
+    def __init__(self, line_length=LINE_LENGTH, separator=2):
+        self.line_length = line_length
+        self.separator = separator
+
+    @classmethod
+    def from_head(cls, head, octets):
+        '''Returns the layout of a part from its first octets, or None if
+        the line length isn't usable.
+
+        @param head: the first octets of the part;
+        @param octets: encoded size.
+        '''
+        line, newline, rest = head.partition('\n')
+        if newline:
+            layout = cls(len(line.rstrip('\r')), 2 if line.endswith('\r')
+                         else 1)
+        elif len(head) == octets:
+            # A single line
+            layout = cls(len(line), 0)
+        else:
+            # Lines longer than the head
+            return None
+        if not layout.line_length or layout.line_length % 4:
+            return None
+        return layout
+
+    def decoded_size(self, octets, tail):
+        '''Returns the decoded size of a part, or None if it doesn't match
+        the layout.
+
+        @param octets: encoded size;
+        @param tail: the last octets of the part.
+        '''
+        breaks = 0
+        if self.separator:
+            breaks, rest = divmod(octets, self.line_length + self.separator)
+            if rest and tail.endswith('\n'):
+                breaks += 1
+        data_length = octets - breaks * self.separator
+        if not data_length or data_length % 4:
+            return None
+        data = tail.rstrip()
+        return data_length // 4 * 3 - (len(data) - len(data.rstrip('=')))
+
+    def position(self, index):
+        '''Position on the encoded text of the base64 character index'''
+        if not self.separator:
+            return index
+        return index + index // self.line_length * self.separator
+
+    def chunk(self, first, last):
+        '''Returns (start, length) of the encoded text with the decoded
+        bytes [first, last].
+        '''
+        start = self.position(first // 3 * 4)
+        end = self.position(last // 3 * 4 + 3) + 1
+        return start, end - start
+
+
+def fetch_ranges(imap, message_id, section, *ranges):
+    '''Fetches (start, length) ranges of a part on a single FETCH, returns
+    their texts, one for each range ('' for the empty ones). The
+    overlapping ranges are merged, the server would give us the same
+    response item for two ranges with the same start.
+    '''
+    merged = []
+    for start, length in sorted(ranges):
+        if length <= 0:
+            continue
+        if merged and start <= merged[-1][0] + merged[-1][1]:
+            merged_start, merged_length = merged[-1]
+            end = max(merged_start + merged_length, start + length)
+            merged[-1] = (merged_start, end - merged_start)
+        else:
+            merged.append((start, length))
+
+    if not merged:
+        return [''] * len(ranges)
+    query = '(%s)' % ' '.join('BODY.PEEK[%s]<%d.%d>' % (section, start,
+                                                         length)
+                              for start, length in merged)
+    msg_info = imap.fetch(message_id, query).get(message_id, {})
+    texts = []
+    for start, length in ranges:
+        text = ''
+        for merged_start, merged_length in merged:
+            if (length > 0 and
+                    merged_start <= start < merged_start + merged_length):
+                text = msg_info.get('BODY[%s]<%d>' % (section,
+                                                      merged_start)) or ''
+                text = text[start - merged_start:
+                            start - merged_start + length]
+                break
+        texts.append(text)
+    return texts
+
+
+def part_range(imap, message_id, part, first, last=None, max_length=None):
+    '''Fetches a range of the decoded contents of a part.
+
+    @param imap: IMAP4P instance, the message folder must be selected;
+    @param message_id: message UID, or number if the server doesn't have
+        UIDs;
+    @param part: the part, from the BODYSTRUCTURE;
+    @param first: first byte of the range;
+    @param last: last byte of the range (inclusive), None for the end of
+        the part;
+    @param max_length: maximum length of the range, it's shortened if
+        needed.
+
+    @return: (data, first, last, size), the range is clipped to the part
+        size. None if the range can't be fetched this way (transfer
+        encoding not supported, first beyond the end of the part or a base64
+        part without fixed length lines).
+    '''
+    encoding = (part.body_fld_enc or '').upper()
+    try:
+        octets = int(part.body_fld_octets or 0)
+    except (TypeError, ValueError):
+        return None
+    section = part.part_number
+    if max_length is not None and (last is None or
+                                   last - first + 1 > max_length):
+        last = first + max_length - 1
+
+    if encoding == '7BIT':
+        if first >= octets:
+            return None
+        last = octets - 1 if last is None else min(last, octets - 1)
+        data, = fetch_ranges(imap, message_id, section,
+                             (first, last - first + 1))
+        return bytes(data, 'ascii', 'replace'), first, last, octets
+
+    if encoding != 'BASE64' or not octets:
+        return None
+
+    # The range is fetched with the head and tail of the part, guessing the
+    # line length. If the guess puts it past the end of the part nothing is
+    # fetched, it's fetched again once the layout is known (or the range is
+    # past the end).
+    tail_start = max(0, octets - TAIL_SIZE)
+    if last is None:
+        start = Base64Layout().chunk(first, first)[0]
+        length = octets - start
+    else:
+        start, length = Base64Layout().chunk(first, last)
+    start = min(start, octets)
+    length = max(0, min(length, octets - start))
+    head, tail, chunk = fetch_ranges(
+        imap, message_id, section, (0, HEAD_SIZE),
+        (tail_start, octets - tail_start), (start, length))
+
+    layout = Base64Layout.from_head(head, octets)
+    size = layout.decoded_size(octets, tail) if layout else None
+    if size is None or first >= size:
+        return None
+    last = size - 1 if last is None else min(last, size - 1)
+    chunk_start, chunk_length = layout.chunk(first, last)
+    if chunk_start != start or chunk_length > len(chunk):
+        chunk, = fetch_ranges(imap, message_id, section,
+                              (chunk_start, chunk_length))
+
+    text = base64_skip_re.sub('', chunk[:chunk_length])
+    expected = (last // 3 - first // 3 + 1) * 4
+    if len(text) < expected:
+        # The lines aren't what we expected
+        return None
+    try:
+        data = base64.b64decode(text[:expected])
+    except (binascii.Error, ValueError):
+        return None
+    offset = first - first // 3 * 3
+    return data[offset:offset + last - first + 1], first, last, size
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+# hlimap - High level IMAP library
+# Copyright (C) 2008 Helder Guerreiro
+
+# This file is part of hlimap.
+#
+# hlimap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# hlimap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@tretas.org>
+#
+
+'''Pool of logged in ImapServer instances.
+
+The instances are kept between uses, with the folder that was selected still
+selected, so a short request (for instance changing the flags of a message)
+doesn't have to connect, login and select the folder again. An instance is
+only used by one thread at a time: it's taken from the pool with acquire
+and given back with release when the work is done::
+
+    server = pool.acquire(key)
+    if server is None:
+        server = ImapServer(...)
+        server.login(username, password)
+    ... use server ...
+    pool.release(key, server)
+
+The key identifies the user session, the instances are never shared between
+keys. If something goes wrong while using an instance it shouldn't be given
+back, its state is unknown.
+'''
+
+# Global imports
+import threading
+import time
+
+
+class ServerPool(object):
+    '''Keeps idle ImapServer instances by key.
+
+    @param max_idle: seconds an idle instance is kept, after this it's
+        logged out;
+    @param max_size: maximum number of idle instances, when it's reached the
+        ones idle for the longest time are logged out;
+    @param check_after: an instance idle for longer than this many seconds
+        is checked with a NOOP before being returned by acquire, the server
+        may have closed the connection.
+    '''
+
+    def __init__(self, max_idle=300, max_size=50, check_after=30):
+        self.max_idle = max_idle
+        self.max_size = max_size
+        self.check_after = check_after
+        self.lock = threading.Lock()
+        self.idle = {}  # {key: [(release time, server), ...]}
+
+    def acquire(self, key):
+        '''Returns an idle instance for key, or None if there's none. The
+        expired instances of all the keys are logged out.
+        '''
+        with self.lock:
+            culled = self._cull()
+        for server in culled:
+            self.discard(server)
+        while True:
+            with self.lock:
+                try:
+                    released, server = self.idle[key].pop()
+                except (KeyError, IndexError):
+                    return None
+                if not self.idle[key]:
+                    del self.idle[key]
+            idle_time = time.monotonic() - released
+            if idle_time > self.max_idle:
+                self.discard(server)
+                continue
+            if idle_time > self.check_after:
+                try:
+                    server._imap.noop()
+                except Exception:
+                    self.discard(server)
+                    continue
+            return server
+
+    def release(self, key, server):
+        '''Gives an instance back to the pool. Instances that are no longer
+        logged in are discarded.
+        '''
+        if (not server.connected or
+                server._imap.state not in ('AUTH', 'SELECTED')):
+            self.discard(server)
+            return
+        with self.lock:
+            self.idle.setdefault(key, []).append((time.monotonic(), server))
+            culled = self._cull()
+        for server in culled:
+            self.discard(server)
+
+    def discard(self, server):
+        '''Logs out an instance that isn't going to be used again'''
+        if server.connected:
+            server.connected = False
+            try:
+                server._imap.logout()
+            except Exception:
+                pass
+
+    def discard_key(self, key):
+        '''Logs out the idle instances of key, for instance when the user
+        session ends.
+        '''
+        with self.lock:
+            culled = [server for released, server in self.idle.pop(key, [])]
+        for server in culled:
+            self.discard(server)
+
+    def clear(self):
+        '''Logs out all the idle instances'''
+        with self.lock:
+            culled = [server for servers in self.idle.values()
+                      for released, server in servers]
+            self.idle = {}
+        for server in culled:
+            self.discard(server)
+
+    def _cull(self):
+        '''Removes the expired instances and, if there are still too many,
+        the oldest ones. Returns the removed instances, they're logged out
+        outside the lock.
+        '''
+        now = time.monotonic()
+        entries = sorted(((released, key, server)
+                          for key, servers in self.idle.items()
+                          for released, server in servers),
+                         key=lambda Xi: Xi[0])
+        culled = []
+        while entries and (now - entries[0][0] > self.max_idle or
+                           len(entries) > self.max_size):
+            released, key, server = entries.pop(0)
+            self.idle[key].remove((released, server))
+            if not self.idle[key]:
+                del self.idle[key]
+            culled.append(server)
+        return culled
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(servers) for servers in self.idle.values())
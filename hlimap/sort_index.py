@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+# hlimap - High level IMAP library
+# Copyright (C) 2008 Helder Guerreiro
+
+# This file is part of hlimap.
+#
+# hlimap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# hlimap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@tretas.org>
+#
+
+
+'''Per folder index of the message sort keys.
+
+Used to sort the messages client side when the server doesn't have the SORT
+extension. Instead of fetching the envelopes of all the messages on every
+request, the sort keys of each message (see hlimap.message_sorter) are kept
+on a SortIndex, by UID. The index is valid while the folder UIDVALIDITY
+doesn't change, and it's updated incrementally:
+
+    * the messages with UIDs not below the last known UIDNEXT are fetched
+      (ENVELOPE, RFC822.SIZE and INTERNALDATE only);
+    * the UIDs reported on VANISHED responses (QRESYNC) are removed;
+    * if the number of messages still doesn't match the EXISTS count, some
+      messages were expunged, a UID SEARCH ALL is used to find them.
+
+The SortIndex instances can be pickled, so they can be kept on a cache
+between ImapServer instances, see ImapServer.sort_index.
+'''
+
+# Global imports
+from array import array
+
+# Local imports
+from .message_columns import MessageColumns
+from .message_sorter import compile_program, KEY_FUNCTIONS
+
+# Constants
+FETCH_ITEMS = '(ENVELOPE RFC822.SIZE INTERNALDATE)'
+NUMERIC_COLUMNS = ('ARRIVAL', 'DATE', 'SIZE')
+
+
+class IndexedMessage(object):
+    '''The message attributes used by the sort key functions'''
+
+    def __init__(self, msg_info):
+        self.envelope = msg_info['ENVELOPE']
+        self.internaldate = msg_info['INTERNALDATE']
+        self.size = msg_info['RFC822.SIZE']
+
+
+class SortIndex(object):
+    '''Sort keys of the messages of a folder, by UID. The UIDs are kept in
+    ascending order, which is also the message sequence number order.
+    '''
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self, uidvalidity=None):
+        self.uidvalidity = uidvalidity
+        self.uidnext = 1
+        self.uids = array('I')
+        self.columns = dict((keyword, array('q')
+                             if keyword in NUMERIC_COLUMNS else [])
+                            for keyword in KEY_FUNCTIONS)
+
+    def __len__(self):
+        return len(self.uids)
+
+    # Changes
+    def add(self, messages):
+        '''Adds messages to the index.
+
+        @param messages: list of (UID, message) tuples, the UIDs must be
+            bigger than the ones already on the index. The messages must
+            have the envelope, internaldate and size attributes.
+        '''
+        for uid, message in sorted(messages, key=lambda Xi: Xi[0]):
+            if self.uids and uid <= self.uids[-1]:
+                continue
+            self.uids.append(uid)
+            for keyword, column in self.columns.items():
+                column.append(KEY_FUNCTIONS[keyword](message))
+            self.uidnext = max(self.uidnext, uid + 1)
+
+    def keep(self, uids):
+        '''Removes the messages whose UIDs aren't in uids'''
+        uids = set(uids)
+        rows = [Xi for Xi, uid in enumerate(self.uids) if uid in uids]
+        if len(rows) == len(self.uids):
+            return
+        self.uids = array('I', map(self.uids.__getitem__, rows))
+        for keyword, column in self.columns.items():
+            values = map(column.__getitem__, rows)
+            self.columns[keyword] = (array('q', values)
+                                     if keyword in NUMERIC_COLUMNS
+                                     else list(values))
+
+    def remove(self, uids):
+        '''Removes the messages with the given UIDs'''
+        uids = set(uids)
+        self.keep(Xi for Xi in self.uids if Xi not in uids)
+
+    def update(self, imap):
+        '''Brings the index up to date with the selected folder.
+
+        @param imap: IMAP4P instance, with the folder already selected.
+
+        @return: True if the index was changed.
+        '''
+        current = imap.sstatus['current_folder']
+        uidvalidity = current.get('UIDVALIDITY')
+        changed = False
+        if uidvalidity is None or uidvalidity != self.uidvalidity:
+            self.clear(uidvalidity)
+            changed = True
+
+        vanished = current.get('vanished')
+        if vanished:
+            self.remove(vanished)
+            current['vanished'] = []
+            changed = True
+
+        uidnext = current.get('UIDNEXT')
+        exists = current.get('EXISTS')
+        if exists == 0:
+            # Empty folder, the '*' can't be used on the UID FETCH
+            if self.uids:
+                self.clear(uidvalidity)
+                changed = True
+            self.uidnext = max(self.uidnext, uidnext or 1)
+            return changed
+
+        # New messages
+        if uidnext is None or uidnext > self.uidnext:
+            new = imap.fetch_uid('%d:*' % self.uidnext, FETCH_ITEMS)
+            self.add([(uid, IndexedMessage(msg_info))
+                      for uid, msg_info in new.items()
+                      if uid >= self.uidnext])
+            if uidnext is not None:
+                self.uidnext = max(self.uidnext, uidnext)
+            changed = True
+
+        # Expunged messages
+        if exists is None or exists != len(self.uids):
+            uids = imap.search_uid('ALL')
+            self.keep(uids)
+            missing = set(uids).difference(self.uids)
+            if missing:
+                # Shouldn't happen, the UIDs are assigned in ascending order
+                self.rebuild(imap, uids)
+            changed = True
+
+        return changed
+
+    def rebuild(self, imap, uids):
+        '''Fetches the sort keys of all the messages again'''
+        uidvalidity = self.uidvalidity
+        self.clear(uidvalidity)
+        if uids:
+            messages = imap.fetch_uid(uids, FETCH_ITEMS)
+            self.add([(uid, IndexedMessage(msg_info))
+                      for uid, msg_info in messages.items()])
+
+    # Sorting
+    def sort(self, uids, sort_program):
+        '''Sorts a list of UIDs, the UIDs must be on the index.
+
+        @param uids: UIDs to sort, for instance the result of a SEARCH;
+        @param sort_program: sequence of sort keywords, see
+            MessageList.set_sort_program.
+        '''
+        program = compile_program(sort_program)
+        wanted = set(uids)
+        if len(wanted) == len(self.uids):
+            rows = range(len(self.uids))
+        else:
+            rows = [Xi for Xi, uid in enumerate(self.uids) if uid in wanted]
+        columns = MessageColumns(map(self.uids.__getitem__, rows))
+        for keyword, function, reverse in program:
+            if keyword not in columns:
+                column = self.columns[keyword]
+                columns.add_column(keyword,
+                                   [column[Xi] for Xi in rows])
+        return columns.sort([(keyword, reverse)
+                             for keyword, function, reverse in program])
+
+    def __repr__(self):
+        return '<SortIndex UIDVALIDITY %s, %d messages>' % (
+            self.uidvalidity, len(self.uids))
@@ -38,6 +38,10 @@ responses;
 * sexp - scans nested parentheses lists on a string and transforms it in python
 lists;
 * infolog - example infolog class;
+* metrics - per command latency and traffic metrics;
+* fakeserver - in process fake IMAP server, for performance testing;
+* replay - record and replay of the IMAP wire traffic;
+* utf7 - modified UTF-7 mailbox name codec;
 * utils - severall utility functions and classes;
 '''
 
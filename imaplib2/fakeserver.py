@@ -0,0 +1,1905 @@
+# -*- coding: utf-8 -*-
+
+# imaplib2 python module, meant to be a replacement to the python default
+# imaplib module
+# Copyright (C) 2008 Helder Guerreiro
+
+# This file is part of imaplib2.
+#
+# imaplib2 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# imaplib2 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@tretas.org>
+#
+
+'''In process fake IMAP server, meant to be used for local performance
+testing.
+
+The server is not a real IMAP server, it keeps the mailboxes in memory and
+implements only the subset of RFC3501 (and extensions) used by imaplib2,
+hlimap and webpymail. However it's complete enough to let us measure how many
+round trips and how many bytes each library or view path costs.
+
+Features:
+
+    - Synthetic mailboxes of configurable size. The messages are generated
+      from a seeded random generator, so the mailboxes are the same from run
+      to run. Some messages are replies to previous ones, so the threading
+      algorithms have something to work with;
+    - Configurable capability set. The commands that depend on an extension
+      (SORT, THREAD, MOVE, UIDPLUS, ESEARCH, CONDSTORE, ...) are only
+      accepted if the respective capability is advertised. Advertised
+      extensions that aren't implemented (COMPRESS for instance) answer NO;
+    - Latency injection: each round trip (a command or a continuation
+      request) is delayed by 'latency' seconds;
+    - Bandwidth limit: the responses are throttled to 'bandwidth' bytes per
+      second;
+    - Statistics: the number of connections, round trips, bytes received and
+      sent, and the number of commands by name.
+
+Usage example::
+
+    from imaplib2.fakeserver import FakeIMAPServer
+    from hlimap import ImapServer
+
+    with FakeIMAPServer(mailboxes={'INBOX': 5000},
+                        latency=0.05) as server:
+        M = ImapServer('localhost', server.port)
+        M.login('user', 'password')
+        for folder in M:
+            print(folder)
+
+        # An appended message without a Date header is sorted by its
+        # INTERNALDATE together with the synthetic ones
+        M._imap.append('INBOX', 'Subject: no date\\r\\n\\r\\nHello\\r\\n')
+        inbox = M.get_folder('INBOX')
+        inbox.message_list.set_sort_program('-DATE')
+        inbox.message_list.refresh_messages()
+        print(server.stats)
+
+The server can also be used from the command line::
+
+    python3 -m imaplib2.fakeserver -p 1143 -m 5000 -l 50
+'''
+
+# Global imports
+import base64
+import collections
+import datetime
+import email
+import email.generator
+import email.utils
+import io
+import random
+import re
+import socket
+import socketserver
+import threading
+import time
+
+# Local imports
+from . import utf7
+
+# Constants
+CRLF = b'\r\n'
+DELIMITER = '.'
+
+DEFAULT_CAPABILITIES = ('IMAP4rev1', 'LITERAL+', 'SASL-IR', 'AUTH=PLAIN',
+                        'UIDPLUS', 'UNSELECT', 'CHILDREN', 'NAMESPACE',
+                        'SORT', 'THREAD=ORDEREDSUBJECT', 'THREAD=REFERENCES',
+                        'MOVE', 'ESEARCH', 'CONDSTORE')
+
+DEFAULT_MAILBOXES = {'INBOX': 200,
+                     'INBOX.Drafts': 0,
+                     'INBOX.Sent': 20,
+                     'INBOX.Trash': 0}
+
+SYSTEM_FLAGS = ('\\Answered', '\\Flagged', '\\Deleted', '\\Seen', '\\Draft')
+
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+          'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+WORDS = ('alpha', 'budget', 'meeting', 'report', 'release', 'server',
+         'backup', 'invoice', 'project', 'review', 'schedule', 'holiday',
+         'coffee', 'quarterly', 'update', 'network', 'migration', 'design',
+         'feedback', 'planning', 'security', 'patch', 'lunch', 'contract')
+
+NAMES = (('Ana Silva', 'ana', 'example.com'),
+         ('Bruno Costa', 'bruno', 'example.org'),
+         ('Carla Dias', 'carla', 'example.net'),
+         ('Daniel Faria', 'daniel', 'example.com'),
+         ('Eva Gomes', 'eva', 'example.org'),
+         (None, 'noreply', 'lists.example.com'),
+         ('Filipe Henriques', 'filipe', 'example.net'),
+         ('Gil Lopes', 'gil', 'example.com'))
+
+# Regexp
+literal_re = re.compile(br'\{(?P<size>\d+)(?P<plus>\+?)\}\r\n$')
+section_re = re.compile(r'^(?P<item>BODY|BODY\.PEEK|BINARY|BINARY\.PEEK|'
+                        r'BINARY\.SIZE)\[(?P<section>[^\]]*)\]'
+                        r'(?:<(?P<start>\d+)\.(?P<count>\d+)>)?$')
+part_spec_re = re.compile(r'^(?P<path>\d+(?:\.\d+)*)?\.?(?P<spec>.*)$')
+fields_re = re.compile(r'^HEADER\.FIELDS(?P<not>\.NOT)? \((?P<fields>.*)\)$')
+header_name_re = re.compile(br'^([^:\s]+):')
+subject_prefix_re = re.compile(r'^(?:\s*(?:re|fwd?)\s*(?:\[\d+\])?\s*:|'
+                               r'\s*\[[^\]]*\])', re.IGNORECASE)
+subject_trailer_re = re.compile(r'\s*\(fwd\)\s*$', re.IGNORECASE)
+
+# Errors
+
+
+class CommandError(Exception):
+    '''Answered with a tagged BAD'''
+
+
+class CommandFailed(Exception):
+    '''Answered with a tagged NO'''
+
+
+class Disconnect(Exception):
+    '''Closes the connection'''
+
+# Utility functions
+
+
+def quote(value):
+    '''Represents a string using the IMAP syntax.
+    '''
+    if value is None:
+        return b'NIL'
+    if isinstance(value, str):
+        value = bytes(value, 'utf-8')
+    if (not re.search(br'[\x00-\x1f\x7f-\xff"\\]', value) and
+            len(value) < 1024):
+        return b'"' + value + b'"'
+    return b'{' + bytes(str(len(value)), 'ascii') + b'}\r\n' + value
+
+
+def imap_list(items):
+    return b'(' + b' '.join(items) + b')'
+
+
+def utc_datetime(date):
+    '''Returns date as an aware datetime in UTC, a naive datetime is taken
+    as UTC. All the dates of the fake messages are aware, so they can be
+    compared with each other when sorting.
+    '''
+    if date.tzinfo is None:
+        return date.replace(tzinfo=datetime.timezone.utc)
+    return date.astimezone(datetime.timezone.utc)
+
+
+def internaldate(date):
+    return '%02d-%s-%04d %02d:%02d:%02d +0000' % (
+        date.day, MONTHS[date.month - 1], date.year,
+        date.hour, date.minute, date.second)
+
+
+def base_subject(subject):
+    '''Simplified RFC 5256 base subject extraction.'''
+    subject = ' '.join((subject or '').split())
+    while True:
+        stripped = subject_trailer_re.sub('', subject)
+        stripped = subject_prefix_re.sub('', stripped).strip()
+        if stripped == subject:
+            return subject.lower()
+        subject = stripped
+
+
+def parse_set(text, maximum):
+    '''Parses a sequence set.
+
+    @param text: the sequence set, for instance '1:4,7,9:*'
+    @param maximum: the value of '*'
+
+    @return: a list of (first, last) tuples.
+    '''
+    ranges = []
+    for item in text.split(','):
+        try:
+            if ':' in item:
+                first, last = item.split(':')
+                first = maximum if first == '*' else int(first)
+                last = maximum if last == '*' else int(last)
+                if first > last:
+                    first, last = last, first
+            else:
+                first = last = maximum if item == '*' else int(item)
+        except ValueError:
+            raise CommandError('Invalid sequence set: %s' % text)
+        ranges.append((first, last))
+    return ranges
+
+
+def in_set(value, ranges):
+    for first, last in ranges:
+        if first <= value <= last:
+            return True
+    return False
+
+
+def compress_set(values):
+    '''Represents a list of integers as a sequence set.'''
+    values = sorted(values)
+    result = []
+    i = 0
+    while i < len(values):
+        j = i
+        while j + 1 < len(values) and values[j + 1] == values[j] + 1:
+            j += 1
+        if i == j:
+            result.append('%d' % values[i])
+        else:
+            result.append('%d:%d' % (values[i], values[j]))
+        i = j + 1
+    return ','.join(result)
+
+
+def parse_arguments(segments):
+    '''Converts the command line into a nested list of tokens.
+
+    @param segments: list of (kind, value) tuples, kind is either 'text' or
+        'literal'. The literals are bytes objects, all the other tokens are
+        strings.
+    '''
+    result = []
+    stack = [result]
+    for kind, value in segments:
+        if kind == 'literal':
+            stack[-1].append(value)
+            continue
+        pos = 0
+        length = len(value)
+        while pos < length:
+            char = value[pos]
+            if char == ' ':
+                pos += 1
+            elif char == '(':
+                stack[-1].append([])
+                stack.append(stack[-1][-1])
+                pos += 1
+            elif char == ')':
+                if len(stack) == 1:
+                    raise CommandError('Unexpected parenthesis')
+                stack.pop()
+                pos += 1
+            elif char == '"':
+                pos += 1
+                chars = []
+                while pos < length and value[pos] != '"':
+                    if value[pos] == '\\':
+                        pos += 1
+                    chars.append(value[pos])
+                    pos += 1
+                stack[-1].append(''.join(chars))
+                pos += 1
+            else:
+                start = pos
+                depth = 0
+                while pos < length:
+                    char = value[pos]
+                    if char == '[':
+                        depth += 1
+                    elif char == ']':
+                        depth -= 1
+                    elif depth == 0 and char in ' ()':
+                        break
+                    pos += 1
+                stack[-1].append(value[start:pos])
+    if len(stack) != 1:
+        raise CommandError('Unbalanced parenthesis')
+    return result
+
+
+def text(token):
+    if isinstance(token, bytes):
+        return str(token, 'utf-8', 'replace')
+    if isinstance(token, list):
+        raise CommandError('Unexpected list')
+    return token
+
+#
+# Mailbox contents
+#
+
+
+class FakeMessage:
+    '''A message on a fake mailbox.
+
+    The message can be created from a raw RFC822 message, or from its
+    fields. In the latter case the message source is only generated when
+    it's needed.
+    '''
+
+    def __init__(self, raw=None, fields=None, internal_date=None, flags=()):
+        self.uid = None
+        self.flags = set(flags)
+        self.modseq = 1
+        self._raw = raw
+        self._email = None
+        if fields is None:
+            fields = self.parse_fields(raw)
+        self.fields = fields
+        self.internal_date = utc_datetime(
+            internal_date or datetime.datetime.now(datetime.timezone.utc))
+
+    def copy(self):
+        message = FakeMessage(self._raw, self.fields, self.internal_date,
+                              self.flags)
+        message._email = self._email
+        return message
+
+    @staticmethod
+    def parse_fields(raw):
+        msg = email.message_from_bytes(raw)
+
+        def addresses(header):
+            result = []
+            for name, addr in email.utils.getaddresses(msg.get_all(header,
+                                                                   [])):
+                mailbox, _, host = addr.partition('@')
+                result.append((name or None, mailbox, host))
+            return result
+
+        try:
+            date = utc_datetime(
+                email.utils.parsedate_to_datetime(msg['Date']))
+        except (TypeError, ValueError):
+            date = None
+        references = (msg['References'] or '').split()
+        return {'date': date,
+                'subject': msg['Subject'] or '',
+                'from': addresses('From'),
+                'to': addresses('To'),
+                'cc': addresses('Cc'),
+                'message_id': msg['Message-ID'],
+                'in_reply_to': msg['In-Reply-To'],
+                'references': references,
+                'body': None}
+
+    # Message source
+    def _get_raw(self):
+        if self._raw is None:
+            self._raw = self.generate()
+        return self._raw
+    raw = property(_get_raw)
+
+    def _get_email(self):
+        if self._email is None:
+            self._email = email.message_from_bytes(self.raw)
+        return self._email
+    email = property(_get_email)
+
+    def size(self):
+        return len(self.raw)
+
+    def generate(self):
+        '''Generates the message source from the fields'''
+        fields = self.fields
+
+        def addresses(addr_list):
+            return ', '.join('"%s" <%s@%s>' % addr if addr[0] else
+                             '<%s@%s>' % addr[1:] for addr in addr_list)
+
+        headers = ['Date: %s' % email.utils.format_datetime(fields['date']),
+                   'From: %s' % addresses(fields['from']),
+                   'To: %s' % addresses(fields['to'])]
+        if fields['cc']:
+            headers.append('Cc: %s' % addresses(fields['cc']))
+        headers.append('Subject: %s' % fields['subject'])
+        headers.append('Message-ID: %s' % fields['message_id'])
+        if fields['in_reply_to']:
+            headers.append('In-Reply-To: %s' % fields['in_reply_to'])
+        if fields['references']:
+            headers.append('References: %s' %
+                           '\r\n '.join(fields['references']))
+        headers.append('MIME-Version: 1.0')
+
+        text = fields['body'].replace('\n', '\r\n')
+        kind = fields.get('kind', 'plain')
+        if kind == 'plain':
+            headers.append('Content-Type: text/plain; charset=utf-8')
+            headers.append('Content-Transfer-Encoding: 7bit')
+            body = text
+        else:
+            boundary = '==boundary_%s==' % fields['message_id'].strip('<>')
+            headers.append('Content-Type: multipart/%s; boundary="%s"' % (
+                'alternative' if kind == 'alternative' else 'mixed',
+                boundary))
+            parts = ['Content-Type: text/plain; charset=utf-8\r\n'
+                     'Content-Transfer-Encoding: 7bit\r\n\r\n' + text]
+            if kind == 'alternative':
+                parts.append('Content-Type: text/html; charset=utf-8\r\n'
+                             'Content-Transfer-Encoding: 7bit\r\n\r\n'
+                             '<html><body><p>' +
+                             text.replace('\r\n', '<br>\r\n') +
+                             '</p></body></html>\r\n')
+            else:
+                payload = bytes(text * 8, 'utf-8')
+                encoded = base64.encodebytes(payload).replace(b'\n', b'\r\n')
+                parts.append('Content-Type: application/octet-stream; '
+                             'name="report.bin"\r\n'
+                             'Content-Transfer-Encoding: base64\r\n'
+                             'Content-Disposition: attachment; '
+                             'filename="report.bin"\r\n\r\n' +
+                             str(encoded, 'ascii'))
+            body = ''.join('--%s\r\n%s\r\n' % (boundary, part)
+                           for part in parts) + '--%s--\r\n' % boundary
+
+        return bytes('\r\n'.join(headers) + '\r\n\r\n' + body, 'utf-8')
+
+    # Sort keys
+    def sent_date(self):
+        return self.fields['date'] or self.internal_date
+
+    def first_address(self, field, display=False):
+        addr_list = self.fields[field]
+        if not addr_list:
+            return ''
+        name, mailbox, host = addr_list[0]
+        if display and name:
+            return name.lower()
+        if display:
+            return ('%s@%s' % (mailbox, host)).lower()
+        return (mailbox or '').lower()
+
+    # Response items
+    def envelope(self):
+        fields = self.fields
+
+        def addresses(addr_list):
+            if not addr_list:
+                return b'NIL'
+            return imap_list(imap_list((quote(name), b'NIL', quote(mailbox),
+                                        quote(host)))
+                             for name, mailbox, host in addr_list)
+
+        date = None
+        if fields['date']:
+            date = email.utils.format_datetime(fields['date'])
+        sender = addresses(fields['from'])
+        return imap_list((quote(date), quote(fields['subject']), sender,
+                          sender, sender, addresses(fields['to']),
+                          addresses(fields['cc']), b'NIL',
+                          quote(fields['in_reply_to']),
+                          quote(fields['message_id'])))
+
+    def part(self, path):
+        '''Returns the email object for the part path (list of ints)'''
+        obj = self.email
+        for number in path:
+            if obj.is_multipart():
+                try:
+                    obj = obj.get_payload()[number - 1]
+                except IndexError:
+                    return None
+            elif number != 1:
+                return None
+        return obj
+
+    @staticmethod
+    def as_bytes(obj):
+        fp = io.BytesIO()
+        generator = email.generator.BytesGenerator(
+            fp, mangle_from_=False, policy=obj.policy.clone(linesep='\r\n'))
+        generator.flatten(obj)
+        return fp.getvalue()
+
+    @classmethod
+    def split_part(cls, obj):
+        data = cls.as_bytes(obj)
+        header, _, body = data.partition(b'\r\n\r\n')
+        return header + b'\r\n\r\n', body
+
+    @classmethod
+    def leaf_body(cls, obj):
+        if obj.is_multipart():
+            return cls.split_part(obj)[1]
+        payload = obj.get_payload()
+        if isinstance(payload, list):
+            return cls.split_part(obj)[1]
+        return bytes(payload, 'ascii', 'surrogateescape')
+
+    def section(self, section):
+        '''Returns the contents of a BODY[<section>]'''
+        match = part_spec_re.match(section)
+        path = match.group('path')
+        spec = match.group('spec').upper()
+        if not path:
+            header, _, body = self.raw.partition(b'\r\n\r\n')
+            header += b'\r\n\r\n'
+            if spec == '':
+                return self.raw
+            elif spec == 'TEXT':
+                return body
+        else:
+            obj = self.part([int(Xi) for Xi in path.split('.')])
+            if obj is None:
+                return b''
+            if spec == '':
+                return self.leaf_body(obj)
+            header, body = self.split_part(obj)
+            if spec in ('MIME', 'HEADER'):
+                return header
+            elif spec == 'TEXT':
+                return body
+
+        if spec == 'HEADER':
+            return header
+        fields = fields_re.match(spec)
+        if not fields:
+            raise CommandError('Unknown section: %s' % section)
+        names = set(bytes(name, 'ascii').upper()
+                    for name in fields.group('fields').replace('"',
+                                                               '').split())
+        exclude = bool(fields.group('not'))
+        result = []
+        keep = False
+        for line in header.split(b'\r\n'):
+            if not line:
+                continue
+            if line[0] in b' \t':
+                if keep:
+                    result.append(line)
+                continue
+            name = header_name_re.match(line)
+            keep = bool(name) and ((name.group(1).upper() in names) !=
+                                   exclude)
+            if keep:
+                result.append(line)
+        return b''.join(Xi + b'\r\n' for Xi in result) + b'\r\n'
+
+    def binary(self, section):
+        '''Returns the decoded contents of a BINARY[<section>]'''
+        if not section:
+            return self.raw
+        obj = self.part([int(Xi) for Xi in section.split('.')])
+        if obj is None or obj.is_multipart():
+            raise CommandFailed('[UNKNOWN-CTE] Can not decode the part')
+        return obj.get_payload(decode=True)
+
+    def preview(self):
+        '''Returns the PREVIEW (RFC8970) of the message: the start of the
+        first text/plain part, with the white space collapsed.
+        '''
+        for part in self.email.walk():
+            if part.get_content_type() == 'text/plain':
+                charset = part.get_content_charset() or 'us-ascii'
+                text = str(part.get_payload(decode=True) or b'', charset,
+                           'replace')
+                return bytes(' '.join(text.split())[:200], 'utf-8')
+        return None
+
+    def bodystructure(self, obj=None):
+        if obj is None:
+            obj = self.email
+        if obj.is_multipart():
+            return (b'(' +
+                    b''.join(self.bodystructure(part)
+                             for part in obj.get_payload()) +
+                    b' ' + quote(obj.get_content_subtype().upper()) +
+                    b' ("BOUNDARY" ' + quote(obj.get_boundary()) +
+                    b') NIL NIL NIL)')
+
+        params = obj.get_params() or []
+        params = [(name.upper(), value) for name, value in params[1:]]
+        if params:
+            params = imap_list(quote(Xi) for param in params for Xi in param)
+        else:
+            params = b'NIL'
+        body = self.leaf_body(obj)
+        items = [quote(obj.get_content_maintype().upper()),
+                 quote(obj.get_content_subtype().upper()),
+                 params,
+                 quote(obj['Content-ID']),
+                 quote(obj['Content-Description']),
+                 quote((obj['Content-Transfer-Encoding'] or '7BIT').upper()),
+                 bytes(str(len(body)), 'ascii')]
+        if obj.get_content_maintype() == 'text':
+            items.append(bytes(str(body.count(b'\n')), 'ascii'))
+        disposition = obj.get_content_disposition()
+        if disposition:
+            filename = obj.get_filename()
+            dsp = [quote(disposition.upper())]
+            dsp.append(imap_list((b'"FILENAME"', quote(filename)))
+                       if filename else b'NIL')
+            items.extend([b'NIL', imap_list(dsp), b'NIL', b'NIL'])
+        else:
+            items.extend([b'NIL', b'NIL', b'NIL', b'NIL'])
+        return imap_list(items)
+
+
+class FakeMailbox:
+    def __init__(self, name, uidvalidity, subscribed=True):
+        self.name = name
+        self.uidvalidity = uidvalidity
+        self.uidnext = 1
+        self.highestmodseq = 1
+        self.subscribed = subscribed
+        self.messages = []
+        self.keywords = set()
+
+    def append(self, message):
+        message.uid = self.uidnext
+        self.uidnext += 1
+        self.highestmodseq += 1
+        message.modseq = self.highestmodseq
+        self.messages.append(message)
+        self.keywords.update(Xi for Xi in message.flags if Xi[0] != '\\')
+        return message.uid
+
+    def expunge(self, messages):
+        '''Removes the messages, returns the list of expunged sequence
+        numbers, in descending order.'''
+        remove = set(id(Xi) for Xi in messages)
+        expunged = [seq for seq, message in enumerate(self.messages, 1)
+                    if id(message) in remove]
+        self.messages = [Xi for Xi in self.messages if id(Xi) not in remove]
+        if expunged:
+            self.highestmodseq += 1
+        return list(reversed(expunged))
+
+    def unseen(self):
+        return len([Xi for Xi in self.messages if '\\Seen' not in Xi.flags])
+
+    def flags(self):
+        return SYSTEM_FLAGS + tuple(sorted(self.keywords))
+
+
+def synthetic_messages(count, rnd, start=None):
+    '''Creates a list of 'count' synthetic messages.
+    '''
+    if start is None:
+        start = datetime.datetime(2015, 1, 1, 8, 0, 0,
+                                  tzinfo=datetime.timezone.utc)
+    messages = []
+    for index in range(count):
+        date = start + datetime.timedelta(minutes=37 * index +
+                                          rnd.randint(0, 30))
+        sender = rnd.choice(NAMES)
+        recipients = rnd.sample(NAMES, rnd.randint(1, 3))
+        cc = rnd.sample(NAMES, rnd.randint(0, 2))
+        message_id = '<%d.%d@fake.example.com>' % (index, rnd.randint(0,
+                                                                      99999))
+        references = []
+        in_reply_to = None
+        if messages and rnd.random() < 0.35:
+            # A reply to a recent message
+            parent = rnd.choice(messages[-40:])
+            subject = parent.fields['subject']
+            if not subject.lower().startswith('re:'):
+                subject = 'Re: ' + subject
+            references = parent.fields['references'] + [
+                parent.fields['message_id']]
+            in_reply_to = parent.fields['message_id']
+        else:
+            subject = ' '.join(rnd.sample(WORDS, rnd.randint(2, 5)))
+            subject = subject.capitalize()
+            if rnd.random() < 0.1:
+                subject = '[list] ' + subject
+        body = '\n'.join(' '.join(rnd.choice(WORDS)
+                                  for i in range(rnd.randint(6, 14)))
+                         for line in range(rnd.randint(2, 12))) + '\n'
+        kind = rnd.choice(('plain',) * 6 + ('alternative', 'mixed'))
+        flags = set()
+        if index < count * 0.9 or rnd.random() < 0.3:
+            flags.add('\\Seen')
+        if rnd.random() < 0.05:
+            flags.add('\\Flagged')
+        if rnd.random() < 0.1:
+            flags.add('\\Answered')
+        if rnd.random() < 0.03:
+            flags.add('$Important')
+        fields = {'date': date,
+                  'subject': subject,
+                  'from': [sender],
+                  'to': recipients,
+                  'cc': cc,
+                  'message_id': message_id,
+                  'in_reply_to': in_reply_to,
+                  'references': references,
+                  'body': body,
+                  'kind': kind}
+        messages.append(FakeMessage(
+            fields=fields,
+            internal_date=date + datetime.timedelta(seconds=rnd.randint(1,
+                                                                        90)),
+            flags=flags))
+    return messages
+
+
+def synthetic_tree(depth, breadth, prefix='INBOX', messages=0):
+    '''Returns a mailbox dict with a tree of folders 'depth' levels deep and
+    with 'breadth' sub folders on each level. Useful to test the folder tree
+    code. Note that the number of folders grows very fast.
+    '''
+    mailboxes = {}
+    level = [prefix]
+    for i in range(depth):
+        next_level = []
+        for parent in level:
+            for j in range(breadth):
+                name = '%s%sF%d_%d' % (parent, DELIMITER, i, j)
+                mailboxes[name] = messages
+                next_level.append(name)
+        level = next_level
+    return mailboxes
+
+#
+# Server
+#
+
+
+class ServerStats:
+    '''Activity counters of the fake server'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.connections = 0
+            self.round_trips = 0
+            self.bytes_received = 0
+            self.bytes_sent = 0
+            self.commands = collections.Counter()
+
+    def snapshot(self):
+        with self.lock:
+            return {'connections': self.connections,
+                    'round_trips': self.round_trips,
+                    'bytes_received': self.bytes_received,
+                    'bytes_sent': self.bytes_sent,
+                    'commands': dict(self.commands)}
+
+    def __repr__(self):
+        return '<ServerStats %r>' % self.snapshot()
+
+
+class FakeIMAPServer(socketserver.ThreadingTCPServer):
+    '''In process fake IMAP server.
+
+    @param host: address to bind to;
+    @param port: port to bind to, 0 chooses a free port;
+    @param mailboxes: dict in the form {mailbox name: number of messages};
+    @param capabilities: the capabilities advertised by the server;
+    @param latency: delay, in seconds, applied to each round trip;
+    @param bandwidth: maximum throughput, in bytes per second, of the server
+        responses. None means unlimited;
+    @param users: dict in the form {user: password}, if None any user and
+        password are accepted;
+    @param seed: seed used to create the synthetic messages.
+    '''
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, mailboxes=None,
+                 capabilities=DEFAULT_CAPABILITIES, latency=0,
+                 bandwidth=None, users=None, seed=0):
+        self.capabilities = tuple(capabilities)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.users = users
+        self.stats = ServerStats()
+        self.lock = threading.RLock()
+        self.thread = None
+        self.sessions = set()
+
+        rnd = random.Random(seed)
+        self.mailboxes = {}
+        if mailboxes is None:
+            mailboxes = DEFAULT_MAILBOXES
+        for name in sorted(mailboxes):
+            mailbox = self.add_mailbox(name)
+            for message in synthetic_messages(mailboxes[name], rnd):
+                mailbox.append(message)
+
+        socketserver.ThreadingTCPServer.__init__(self, (host, port),
+                                                 IMAPHandler)
+
+    def add_mailbox(self, name, subscribed=True):
+        if name.upper() == 'INBOX':
+            name = 'INBOX'
+        mailbox = FakeMailbox(name, int(time.time()) + len(self.mailboxes),
+                              subscribed)
+        self.mailboxes[name] = mailbox
+        return mailbox
+
+    def has_capability(self, capability):
+        return capability.upper() in (Xi.upper() for Xi in self.capabilities)
+
+    def _get_port(self):
+        return self.server_address[1]
+    port = property(_get_port)
+
+    def start(self):
+        '''Serves the requests on a background thread'''
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       name='FakeIMAPServer')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        # Disconnect the open sessions
+        with self.lock:
+            sessions = list(self.sessions)
+        for connection in sessions:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+class IMAPHandler(socketserver.StreamRequestHandler):
+    '''Handles an IMAP session'''
+
+    def setup(self):
+        socketserver.StreamRequestHandler.setup(self)
+        self.server_state = 'NONAUTH'
+        self.selected = None
+        self.readonly = False
+        self.enabled = set()
+        self.output = []
+        with self.server.stats.lock:
+            self.server.stats.connections += 1
+        with self.server.lock:
+            self.server.sessions.add(self.connection)
+
+    def finish(self):
+        with self.server.lock:
+            self.server.sessions.discard(self.connection)
+        try:
+            socketserver.StreamRequestHandler.finish(self)
+        except OSError:
+            pass
+
+    # Input and output
+    def readline(self):
+        line = self.rfile.readline()
+        if not line:
+            raise Disconnect()
+        with self.server.stats.lock:
+            self.server.stats.bytes_received += len(line)
+        return line
+
+    def read_command(self):
+        '''Reads a command, including its literals.
+
+        @return: a list of (kind, value) tuples.
+        '''
+        segments = []
+        while True:
+            line = self.readline()
+            literal = literal_re.search(line)
+            if not literal:
+                segments.append(('text', str(line.rstrip(b'\r\n'), 'utf-8',
+                                             'replace')))
+                return segments
+            segments.append(('text', str(line[:literal.start()], 'utf-8',
+                                         'replace')))
+            if not literal.group('plus'):
+                self.continuation('Ready for literal data')
+            size = int(literal.group('size'))
+            data = self.rfile.read(size)
+            with self.server.stats.lock:
+                self.server.stats.bytes_received += len(data)
+            segments.append(('literal', data))
+
+    def write(self, data):
+        self.output.append(data)
+
+    def untagged(self, *data):
+        self.write(b'* ' + b' '.join(
+            Xi if isinstance(Xi, bytes) else bytes(Xi, 'utf-8')
+            for Xi in data) + CRLF)
+
+    def flush(self):
+        '''Sends the pending output, this ends a round trip'''
+        data = b''.join(self.output)
+        self.output = []
+        with self.server.stats.lock:
+            self.server.stats.round_trips += 1
+            self.server.stats.bytes_sent += len(data)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.bandwidth:
+            time.sleep(len(data) / float(self.server.bandwidth))
+        self.wfile.write(data)
+        self.wfile.flush()
+
+    def continuation(self, message=''):
+        self.write(b'+ ' + bytes(message, 'utf-8') + CRLF)
+        self.flush()
+
+    # Session
+    def handle(self):
+        capabilities = ' '.join(self.server.capabilities)
+        self.write(bytes('* OK [CAPABILITY %s] Fake IMAP server ready\r\n' %
+                         capabilities, 'utf-8'))
+        self.flush()
+        try:
+            while True:
+                segments = self.read_command()
+                self.handle_command(segments)
+        except (Disconnect, OSError):
+            pass
+
+    def handle_command(self, segments):
+        tag = '*'
+        try:
+            tokens = parse_arguments(segments)
+            if len(tokens) < 2:
+                raise CommandError('Missing command')
+            tag = text(tokens[0])
+            command = text(tokens[1]).upper()
+            args = tokens[2:]
+            uid = False
+            if command == 'UID':
+                if not args:
+                    raise CommandError('Missing command')
+                uid = True
+                command = text(args[0]).upper()
+                args = args[1:]
+            with self.server.stats.lock:
+                self.server.stats.commands[('UID ' if uid else '') +
+                                           command] += 1
+            method = getattr(self, 'cmd_%s' % command.replace('-', '_'),
+                             None)
+            if method is None:
+                raise CommandError('Unknown command %s' % command)
+            if not self.valid_state(command):
+                raise CommandError('Command %s not valid in state %s' %
+                                   (command, self.server_state))
+            with self.server.lock:
+                if uid:
+                    message = method(args, uid=True)
+                else:
+                    message = method(args)
+            self.write(bytes('%s OK %s\r\n' % (tag, message or
+                                               '%s completed' % command),
+                             'utf-8'))
+        except CommandError as e:
+            self.write(bytes('%s BAD %s\r\n' % (tag, e), 'utf-8'))
+        except CommandFailed as e:
+            self.write(bytes('%s NO %s\r\n' % (tag, e), 'utf-8'))
+        self.flush()
+        if self.server_state == 'LOGOUT':
+            raise Disconnect()
+
+    STATES = {'NONAUTH': ('CAPABILITY', 'NOOP', 'LOGOUT', 'LOGIN',
+                          'AUTHENTICATE', 'ID'),
+              'AUTH': ('CAPABILITY', 'NOOP', 'LOGOUT', 'ID', 'SELECT',
+                       'EXAMINE', 'CREATE', 'DELETE', 'RENAME', 'SUBSCRIBE',
+                       'UNSUBSCRIBE', 'LIST', 'LSUB', 'STATUS', 'APPEND',
+                       'NAMESPACE', 'ENABLE', 'COMPRESS')}
+
+    def valid_state(self, command):
+        if self.server_state in ('SELECTED', 'LOGOUT'):
+            return True
+        return command in self.STATES[self.server_state]
+
+    def require(self, capability):
+        if not self.server.has_capability(capability):
+            raise CommandError('%s not supported' % capability)
+
+    # Any state
+    def cmd_CAPABILITY(self, args):
+        self.untagged('CAPABILITY', ' '.join(self.server.capabilities))
+
+    def cmd_NOOP(self, args):
+        self.status_updates()
+
+    def cmd_ID(self, args):
+        self.untagged('ID ("name" "fakeserver")')
+
+    def cmd_LOGOUT(self, args):
+        self.untagged('BYE Logging out')
+        self.server_state = 'LOGOUT'
+
+    # Non authenticated
+    def authenticate_user(self, user, password):
+        users = self.server.users
+        if users is not None and users.get(user) != password:
+            raise CommandFailed('[AUTHENTICATIONFAILED] Invalid credentials')
+        self.server_state = 'AUTH'
+        return '[CAPABILITY %s] Logged in' % ' '.join(
+            self.server.capabilities)
+
+    def cmd_LOGIN(self, args):
+        if len(args) != 2:
+            raise CommandError('LOGIN needs two arguments')
+        return self.authenticate_user(text(args[0]), text(args[1]))
+
+    def cmd_AUTHENTICATE(self, args):
+        if not args or text(args[0]).upper() != 'PLAIN':
+            raise CommandFailed('Unsupported mechanism')
+        self.require('AUTH=PLAIN')
+        if len(args) > 1:
+            self.require('SASL-IR')
+            response = text(args[1])
+        else:
+            self.continuation()
+            response = str(self.readline().strip(), 'ascii')
+        if response == '*':
+            raise CommandError('Authentication cancelled')
+        try:
+            response = '' if response == '=' else response
+            authzid, user, password = str(base64.b64decode(response),
+                                          'utf-8').split('\0')
+        except ValueError:
+            raise CommandError('Invalid response')
+        return self.authenticate_user(user, password)
+
+    # Authenticated
+    def mailbox_name(self, name):
+        '''Mailbox name as stored on the server, from the client name. The
+        names are stored in modified UTF-7, with UTF8=ACCEPT enabled the
+        client uses UTF-8 names.
+        '''
+        name = text(name)
+        if 'UTF8=ACCEPT' in self.enabled:
+            return utf7.encode(name)
+        return name
+
+    def client_name(self, name):
+        '''Mailbox name as sent to the client'''
+        if 'UTF8=ACCEPT' in self.enabled:
+            return utf7.decode_safe(name)
+        return name
+
+    def get_mailbox(self, name):
+        name = self.mailbox_name(name)
+        if name.upper() == 'INBOX':
+            name = 'INBOX'
+        try:
+            return self.server.mailboxes[name]
+        except KeyError:
+            raise CommandFailed('[NONEXISTENT] Mailbox does not exist')
+
+    def cmd_ENABLE(self, args):
+        enabled = []
+        for capability in args:
+            capability = text(capability).upper()
+            if self.server.has_capability(capability) and capability in (
+                    'CONDSTORE', 'UTF8=ACCEPT', 'QRESYNC'):
+                self.enabled.add(capability)
+                enabled.append(capability)
+        self.untagged('ENABLED', *enabled)
+
+    def cmd_COMPRESS(self, args):
+        raise CommandFailed('[CANNOT] Compression is not implemented')
+
+    def cmd_NAMESPACE(self, args):
+        self.untagged('NAMESPACE (("" "%s")) NIL NIL' % DELIMITER)
+
+    def cmd_SELECT(self, args, readonly=False):
+        if not args:
+            raise CommandError('Missing mailbox')
+        self.selected = None
+        self.server_state = 'AUTH'
+        mailbox = self.get_mailbox(args[0])
+        if len(args) > 1 and isinstance(args[1], list):
+            if [text(Xi).upper() for Xi in args[1]] == ['CONDSTORE']:
+                self.require('CONDSTORE')
+                self.enabled.add('CONDSTORE')
+        self.selected = mailbox
+        self.readonly = readonly
+        self.server_state = 'SELECTED'
+        self.exists = len(mailbox.messages)
+        flags = ' '.join(mailbox.flags())
+        self.untagged('FLAGS (%s)' % flags)
+        self.untagged('OK [PERMANENTFLAGS (%s \\*)] Flags permitted' % flags)
+        self.untagged('%d EXISTS' % len(mailbox.messages))
+        self.untagged('0 RECENT')
+        for seq, message in enumerate(mailbox.messages, 1):
+            if '\\Seen' not in message.flags:
+                self.untagged('OK [UNSEEN %d] First unseen' % seq)
+                break
+        self.untagged('OK [UIDVALIDITY %d] UIDs valid' % mailbox.uidvalidity)
+        self.untagged('OK [UIDNEXT %d] Predicted next UID' % mailbox.uidnext)
+        if self.server.has_capability('CONDSTORE'):
+            self.untagged('OK [HIGHESTMODSEQ %d] Highest' %
+                          mailbox.highestmodseq)
+        return '[%s] %s completed' % ('READ-ONLY' if readonly else
+                                      'READ-WRITE',
+                                      'EXAMINE' if readonly else 'SELECT')
+
+    def cmd_EXAMINE(self, args):
+        return self.cmd_SELECT(args, readonly=True)
+
+    def cmd_CREATE(self, args):
+        name = self.mailbox_name(args[0]).rstrip(DELIMITER)
+        if name.upper() == 'INBOX' or name in self.server.mailboxes:
+            raise CommandFailed('[ALREADYEXISTS] Mailbox already exists')
+        self.server.add_mailbox(name, subscribed=False)
+
+    def cmd_DELETE(self, args):
+        mailbox = self.get_mailbox(args[0])
+        if mailbox.name == 'INBOX':
+            raise CommandFailed('Can not delete the INBOX')
+        if mailbox is self.selected:
+            self.selected = None
+            self.server_state = 'AUTH'
+        del self.server.mailboxes[mailbox.name]
+
+    def cmd_RENAME(self, args):
+        mailbox = self.get_mailbox(args[0])
+        new_name = self.mailbox_name(args[1])
+        if new_name in self.server.mailboxes:
+            raise CommandFailed('[ALREADYEXISTS] Mailbox already exists')
+        old_name = mailbox.name
+        for name in list(self.server.mailboxes):
+            if name == old_name or name.startswith(old_name + DELIMITER):
+                child = self.server.mailboxes.pop(name)
+                child.name = new_name + name[len(old_name):]
+                self.server.mailboxes[child.name] = child
+
+    def cmd_SUBSCRIBE(self, args):
+        self.get_mailbox(args[0]).subscribed = True
+
+    def cmd_UNSUBSCRIBE(self, args):
+        self.get_mailbox(args[0]).subscribed = False
+
+    def match_mailboxes(self, reference, pattern, subscribed):
+        '''Returns a list of (name, attributes)'''
+        pattern = self.mailbox_name(reference) + self.mailbox_name(pattern)
+        regex = re.compile('^%s$' % ''.join(
+            '.*' if char == '*' else
+            '[^%s]*' % re.escape(DELIMITER) if char == '%' else
+            re.escape(char) for char in pattern), re.IGNORECASE)
+        children = self.server.has_capability('CHILDREN')
+        mailboxes = self.server.mailboxes
+        result = []
+        seen = set()
+        for name in sorted(mailboxes):
+            mailbox = mailboxes[name]
+            parts = name.split(DELIMITER)
+            # Parent folders that only exist as part of a hierarchy
+            for i in range(1, len(parts)):
+                parent = DELIMITER.join(parts[:i])
+                if (parent not in mailboxes and parent not in seen and
+                        regex.match(parent)):
+                    if not subscribed or mailbox.subscribed:
+                        seen.add(parent)
+                        result.append((parent, ['\\Noselect',
+                                                '\\HasChildren']))
+            if subscribed and not mailbox.subscribed:
+                continue
+            if not regex.match(name) or name in seen:
+                continue
+            seen.add(name)
+            attributes = []
+            if children or self.server.has_capability('LIST-EXTENDED'):
+                has_children = any(Xi.startswith(name + DELIMITER)
+                                   for Xi in mailboxes)
+                attributes.append('\\HasChildren' if has_children else
+                                  '\\HasNoChildren')
+            if subscribed == 'extended' and mailbox.subscribed:
+                attributes.append('\\Subscribed')
+            result.append((name, attributes))
+        return result
+
+    def cmd_LIST(self, args, command='LIST'):
+        subscribed = command == 'LSUB'
+        recursive = False
+        if args and isinstance(args[0], list):
+            # LIST-EXTENDED selection options
+            self.require('LIST-EXTENDED')
+            options = [text(Xi).upper() for Xi in args[0]]
+            if 'SUBSCRIBED' in options:
+                subscribed = 'selection'
+                recursive = 'RECURSIVEMATCH' in options
+            args = args[1:]
+        if len(args) < 2:
+            raise CommandError('LIST needs two arguments')
+        if len(args) > 2:
+            # RETURN (CHILDREN SUBSCRIBED)
+            self.require('LIST-EXTENDED')
+            if subscribed is False and 'SUBSCRIBED' in [
+                    text(Xi).upper() for Xi in args[3]]:
+                subscribed = 'extended'
+        if not text(args[1]):
+            self.untagged('%s (\\Noselect) "%s" ""' % (command, DELIMITER))
+            return
+        if subscribed == 'extended':
+            result = self.match_mailboxes(args[0], args[1], 'extended')
+            result = [(name, [Xi for Xi in attributes
+                              if Xi != '\\Subscribed'] +
+                       (['\\Subscribed'] if name in self.server.mailboxes and
+                        self.server.mailboxes[name].subscribed else []))
+                      for name, attributes in
+                      self.match_mailboxes(args[0], args[1], False)]
+        elif subscribed == 'selection':
+            # The SUBSCRIBED selection implies the SUBSCRIBED return option,
+            # RECURSIVEMATCH adds the unsubscribed mailboxes with subscribed
+            # sub mailboxes
+            mailboxes = self.server.mailboxes
+            result = []
+            for name, attributes in self.match_mailboxes(args[0], args[1],
+                                                         False):
+                if name in mailboxes and mailboxes[name].subscribed:
+                    result.append((name, attributes + ['\\Subscribed']))
+                elif recursive and any(
+                        Xi.startswith(name + DELIMITER) and
+                        mailboxes[Xi].subscribed for Xi in mailboxes):
+                    result.append((name, attributes))
+        else:
+            result = self.match_mailboxes(args[0], args[1], subscribed)
+        for name, attributes in result:
+            self.untagged(b'%s (%s) "%s" %s' % (
+                bytes(command, 'ascii'),
+                bytes(' '.join(attributes), 'ascii'),
+                bytes(DELIMITER, 'ascii'), quote(self.client_name(name))))
+
+    def cmd_LSUB(self, args):
+        return self.cmd_LIST(args, 'LSUB')
+
+    def cmd_STATUS(self, args):
+        mailbox = self.get_mailbox(args[0])
+        items = []
+        for item in args[1]:
+            item = text(item).upper()
+            if item == 'MESSAGES':
+                value = len(mailbox.messages)
+            elif item == 'RECENT':
+                value = 0
+            elif item == 'UIDNEXT':
+                value = mailbox.uidnext
+            elif item == 'UIDVALIDITY':
+                value = mailbox.uidvalidity
+            elif item == 'UNSEEN':
+                value = mailbox.unseen()
+            elif item == 'HIGHESTMODSEQ':
+                self.require('CONDSTORE')
+                value = mailbox.highestmodseq
+            else:
+                raise CommandError('Unknown status item %s' % item)
+            items.append('%s %d' % (item, value))
+        self.untagged(b'STATUS ' + quote(self.client_name(mailbox.name)) +
+                      bytes(' (%s)' % ' '.join(items), 'ascii'))
+
+    def cmd_APPEND(self, args):
+        mailbox = self.get_mailbox(args[0])
+        flags = ()
+        date = None
+        for arg in args[1:-1]:
+            if isinstance(arg, list):
+                flags = [text(Xi) for Xi in arg]
+            else:
+                date = text(arg)
+        message = args[-1]
+        if not isinstance(message, bytes):
+            raise CommandError('The message must be a literal')
+        internal_date = None
+        if date:
+            try:
+                internal_date = datetime.datetime.strptime(
+                    date.strip(), '%d-%b-%Y %H:%M:%S %z')
+            except ValueError:
+                raise CommandError('Invalid date')
+        uid = mailbox.append(FakeMessage(raw=message,
+                                         internal_date=internal_date,
+                                         flags=flags))
+        if self.server.has_capability('UIDPLUS'):
+            return '[APPENDUID %d %d] APPEND completed' % (
+                mailbox.uidvalidity, uid)
+
+    # Selected
+    def status_updates(self):
+        '''Sends the EXISTS updates for the selected mailbox'''
+        if self.selected and len(self.selected.messages) != self.exists:
+            self.exists = len(self.selected.messages)
+            self.untagged('%d EXISTS' % self.exists)
+
+    def cmd_CHECK(self, args):
+        pass
+
+    def cmd_CLOSE(self, args):
+        if not self.readonly:
+            mailbox = self.selected
+            mailbox.expunge([Xi for Xi in mailbox.messages
+                             if '\\Deleted' in Xi.flags])
+        self.selected = None
+        self.server_state = 'AUTH'
+
+    def cmd_UNSELECT(self, args):
+        self.require('UNSELECT')
+        self.selected = None
+        self.server_state = 'AUTH'
+
+    def select_messages(self, message_set, uid):
+        '''Returns a list of (sequence number, message) tuples'''
+        messages = self.selected.messages
+        if isinstance(message_set, list):
+            raise CommandError('Invalid message set')
+        message_set = text(message_set)
+        if message_set == '$':
+            raise CommandError('SEARCHRES not supported')
+        if uid:
+            maximum = messages[-1].uid if messages else 0
+            ranges = parse_set(message_set, maximum)
+            return [(seq, message)
+                    for seq, message in enumerate(messages, 1)
+                    if in_set(message.uid, ranges)]
+        ranges = parse_set(message_set, len(messages))
+        for first, last in ranges:
+            if first < 1 or last > len(messages):
+                raise CommandError('Invalid message sequence number')
+        return [(seq, message) for seq, message in enumerate(messages, 1)
+                if in_set(seq, ranges)]
+
+    def fetch_item(self, message, item, changed):
+        '''Returns the response for a single fetch item'''
+        if item == 'UID':
+            return b'UID %d' % message.uid
+        elif item == 'FLAGS':
+            return b'FLAGS ' + imap_list(bytes(Xi, 'utf-8')
+                                         for Xi in sorted(message.flags))
+        elif item == 'INTERNALDATE':
+            return b'INTERNALDATE ' + quote(internaldate(
+                message.internal_date))
+        elif item == 'RFC822.SIZE':
+            return b'RFC822.SIZE %d' % message.size()
+        elif item == 'ENVELOPE':
+            return b'ENVELOPE ' + message.envelope()
+        elif item in ('BODYSTRUCTURE', 'BODY'):
+            return bytes(item, 'ascii') + b' ' + message.bodystructure()
+        elif item == 'RFC822':
+            changed.append(True)
+            return b'RFC822 ' + quote(message.raw)
+        elif item == 'RFC822.HEADER':
+            return b'RFC822.HEADER ' + quote(message.section('HEADER'))
+        elif item == 'RFC822.TEXT':
+            changed.append(True)
+            return b'RFC822.TEXT ' + quote(message.section('TEXT'))
+        elif item == 'MODSEQ':
+            self.require('CONDSTORE')
+            return b'MODSEQ (%d)' % message.modseq
+        elif item == 'PREVIEW':
+            self.require('PREVIEW')
+            return b'PREVIEW ' + quote(message.preview())
+
+        section = section_re.match(item)
+        if not section:
+            raise CommandError('Unknown fetch item %s' % item)
+        name = section.group('item')
+        if name.startswith('BINARY'):
+            self.require('BINARY')
+            data = message.binary(section.group('section'))
+            if name == 'BINARY.SIZE':
+                return b'BINARY.SIZE[%s] %d' % (
+                    bytes(section.group('section'), 'ascii'), len(data))
+            name = 'BINARY'
+        else:
+            data = message.section(section.group('section'))
+            if name == 'BODY':
+                changed.append(True)
+            name = 'BODY'
+        response = bytes('%s[%s]' % (name, section.group('section')),
+                         'utf-8')
+        if section.group('start') is not None:
+            start = int(section.group('start'))
+            count = int(section.group('count'))
+            data = data[start:start + count]
+            response += b'<%d>' % start
+        return response + b' ' + quote(data)
+
+    def cmd_FETCH(self, args, uid=False):
+        if len(args) < 2:
+            raise CommandError('FETCH needs two arguments')
+        items = args[1]
+        if not isinstance(items, list):
+            items = [items]
+        items = [text(Xi).upper() for Xi in items]
+        macros = {'ALL': ['FLAGS', 'INTERNALDATE', 'RFC822.SIZE',
+                          'ENVELOPE'],
+                  'FAST': ['FLAGS', 'INTERNALDATE', 'RFC822.SIZE'],
+                  'FULL': ['FLAGS', 'INTERNALDATE', 'RFC822.SIZE',
+                           'ENVELOPE', 'BODY']}
+        if len(items) == 1 and items[0] in macros:
+            items = macros[items[0]]
+        changed_since = None
+        if len(args) > 2 and isinstance(args[2], list):
+            modifiers = [text(Xi).upper() for Xi in args[2]]
+            if modifiers[:1] == ['CHANGEDSINCE']:
+                self.require('CONDSTORE')
+                changed_since = int(modifiers[1])
+                if 'MODSEQ' not in items:
+                    items.append('MODSEQ')
+        if 'MODSEQ' in items or 'CONDSTORE' in self.enabled:
+            if self.server.has_capability('CONDSTORE') and \
+               'MODSEQ' not in items and 'CONDSTORE' in self.enabled:
+                items.append('MODSEQ')
+        if uid and 'UID' not in items:
+            items.insert(0, 'UID')
+
+        for seq, message in self.select_messages(args[0], uid):
+            if changed_since is not None and message.modseq <= changed_since:
+                continue
+            changed = []
+            response = [self.fetch_item(message, item, changed)
+                        for item in items]
+            if changed and not self.readonly and \
+               '\\Seen' not in message.flags:
+                self.selected.highestmodseq += 1
+                message.modseq = self.selected.highestmodseq
+                message.flags.add('\\Seen')
+                if 'FLAGS' not in items:
+                    response.append(self.fetch_item(message, 'FLAGS', []))
+            self.untagged(b'%d FETCH ' % seq + imap_list(response))
+
+    def cmd_STORE(self, args, uid=False):
+        if self.readonly:
+            raise CommandFailed('Mailbox is read-only')
+        if len(args) < 3:
+            raise CommandError('STORE needs three arguments')
+        unchanged_since = None
+        if isinstance(args[1], list):
+            modifiers = [text(Xi).upper() for Xi in args[1]]
+            if modifiers[:1] == ['UNCHANGEDSINCE']:
+                self.require('CONDSTORE')
+                unchanged_since = int(modifiers[1])
+            args = [args[0]] + args[2:]
+        operation = text(args[1]).upper()
+        flags = args[2]
+        if not isinstance(flags, list):
+            flags = args[2:]
+        flags = set(text(Xi) for Xi in flags)
+        silent = operation.endswith('.SILENT')
+        operation = operation.replace('.SILENT', '')
+        if operation not in ('FLAGS', '+FLAGS', '-FLAGS'):
+            raise CommandError('Unknown STORE operation')
+        modified = []
+        mailbox = self.selected
+        for seq, message in self.select_messages(args[0], uid):
+            if (unchanged_since is not None and
+                    message.modseq > unchanged_since):
+                modified.append(message.uid if uid else seq)
+                continue
+            old_flags = set(message.flags)
+            if operation == 'FLAGS':
+                message.flags = set(flags)
+            elif operation == '+FLAGS':
+                message.flags |= flags
+            else:
+                message.flags -= flags
+            if message.flags != old_flags:
+                mailbox.highestmodseq += 1
+                message.modseq = mailbox.highestmodseq
+                mailbox.keywords.update(Xi for Xi in message.flags
+                                        if Xi[0] != '\\')
+            if not silent:
+                response = []
+                if uid:
+                    response.append(b'UID %d' % message.uid)
+                response.append(self.fetch_item(message, 'FLAGS', []))
+                if 'CONDSTORE' in self.enabled:
+                    response.append(b'MODSEQ (%d)' % message.modseq)
+                self.untagged(b'%d FETCH ' % seq + imap_list(response))
+        if modified:
+            return '[MODIFIED %s] Conditional STORE failed' % \
+                compress_set(modified)
+
+    def cmd_COPY(self, args, uid=False, move=False):
+        if len(args) != 2:
+            raise CommandError('COPY needs two arguments')
+        try:
+            target = self.get_mailbox(args[1])
+        except CommandFailed:
+            raise CommandFailed('[TRYCREATE] Mailbox does not exist')
+        messages = self.select_messages(args[0], uid)
+        source_uids = []
+        target_uids = []
+        for seq, message in messages:
+            source_uids.append(message.uid)
+            target_uids.append(target.append(message.copy()))
+        code = ''
+        if self.server.has_capability('UIDPLUS') and source_uids:
+            code = '[COPYUID %d %s %s] ' % (target.uidvalidity,
+                                            compress_set(source_uids),
+                                            compress_set(target_uids))
+        if move:
+            if code:
+                self.untagged('OK %sMoved' % code)
+            self.expunge([message for seq, message in messages])
+            return 'MOVE completed'
+        return code + 'COPY completed'
+
+    def cmd_MOVE(self, args, uid=False):
+        self.require('MOVE')
+        if self.readonly:
+            raise CommandFailed('Mailbox is read-only')
+        return self.cmd_COPY(args, uid, move=True)
+
+    def expunge(self, messages):
+        for seq in self.selected.expunge(messages):
+            self.untagged('%d EXPUNGE' % seq)
+        self.exists = len(self.selected.messages)
+
+    def cmd_EXPUNGE(self, args, uid=False):
+        if self.readonly:
+            raise CommandFailed('Mailbox is read-only')
+        messages = [Xi for Xi in self.selected.messages
+                    if '\\Deleted' in Xi.flags]
+        if uid:
+            self.require('UIDPLUS')
+            if len(args) != 1:
+                raise CommandError('UID EXPUNGE needs a set')
+            selected = set(id(message) for seq, message in
+                           self.select_messages(args[0], True))
+            messages = [Xi for Xi in messages if id(Xi) in selected]
+        self.expunge(messages)
+
+    # Search
+    def search_key(self, tokens, uid):
+        '''Consumes a search key from tokens, returns a predicate with the
+        arguments (sequence number, message).
+        '''
+        token = tokens.pop(0)
+        if isinstance(token, list):
+            keys = list(token)
+            predicates = []
+            while keys:
+                predicates.append(self.search_key(keys, uid))
+            return lambda seq, msg: all(Xi(seq, msg) for Xi in predicates)
+        key = text(token).upper()
+        flag_keys = {'ANSWERED': '\\Answered', 'DELETED': '\\Deleted',
+                     'DRAFT': '\\Draft', 'FLAGGED': '\\Flagged',
+                     'SEEN': '\\Seen'}
+        if key == 'ALL':
+            return lambda seq, msg: True
+        elif key in flag_keys:
+            flag = flag_keys[key]
+            return lambda seq, msg: flag in msg.flags
+        elif key.startswith('UN') and key[2:] in flag_keys:
+            flag = flag_keys[key[2:]]
+            return lambda seq, msg: flag not in msg.flags
+        elif key in ('NEW', 'RECENT'):
+            return lambda seq, msg: False
+        elif key == 'OLD':
+            return lambda seq, msg: True
+        elif key in ('KEYWORD', 'UNKEYWORD'):
+            flag = text(tokens.pop(0))
+            if key == 'KEYWORD':
+                return lambda seq, msg: flag in msg.flags
+            return lambda seq, msg: flag not in msg.flags
+        elif key == 'NOT':
+            predicate = self.search_key(tokens, uid)
+            return lambda seq, msg: not predicate(seq, msg)
+        elif key == 'OR':
+            first = self.search_key(tokens, uid)
+            second = self.search_key(tokens, uid)
+            return lambda seq, msg: first(seq, msg) or second(seq, msg)
+        elif key in ('SUBJECT', 'BODY', 'TEXT'):
+            value = text(tokens.pop(0)).lower()
+            if key == 'SUBJECT':
+                return lambda seq, msg: value in (
+                    msg.fields['subject'] or '').lower()
+            return lambda seq, msg: value in str(msg.raw, 'utf-8',
+                                                 'replace').lower()
+        elif key in ('FROM', 'TO', 'CC'):
+            value = text(tokens.pop(0)).lower()
+            field = key.lower()
+            return lambda seq, msg: any(
+                value in ('%s %s@%s' % addr).lower()
+                for addr in msg.fields[field])
+        elif key == 'HEADER':
+            name = text(tokens.pop(0))
+            value = bytes(text(tokens.pop(0)).lower(), 'utf-8')
+            return lambda seq, msg: value in msg.section(
+                'HEADER.FIELDS (%s)' % name).lower().partition(b':')[2]
+        elif key in ('LARGER', 'SMALLER'):
+            size = int(text(tokens.pop(0)))
+            if key == 'LARGER':
+                return lambda seq, msg: msg.size() > size
+            return lambda seq, msg: msg.size() < size
+        elif key in ('SINCE', 'BEFORE', 'ON', 'SENTSINCE', 'SENTBEFORE',
+                     'SENTON'):
+            try:
+                date = datetime.datetime.strptime(text(tokens.pop(0)),
+                                                  '%d-%b-%Y').date()
+            except ValueError:
+                raise CommandError('Invalid date')
+            if key.startswith('SENT'):
+                def get_date(msg):
+                    return msg.sent_date().date()
+                key = key[4:]
+            else:
+                def get_date(msg):
+                    return msg.internal_date.date()
+            if key == 'SINCE':
+                return lambda seq, msg: get_date(msg) >= date
+            elif key == 'BEFORE':
+                return lambda seq, msg: get_date(msg) < date
+            return lambda seq, msg: get_date(msg) == date
+        elif key == 'MODSEQ':
+            self.require('CONDSTORE')
+            modseq = int(text(tokens.pop(-1 if len(tokens) > 1 and
+                                         text(tokens[0]).startswith('"')
+                                         else 0)))
+            return lambda seq, msg: msg.modseq >= modseq
+        elif key == 'UID':
+            message_set = text(tokens.pop(0))
+            messages = self.selected.messages
+            ranges = parse_set(message_set,
+                               messages[-1].uid if messages else 0)
+            return lambda seq, msg: in_set(msg.uid, ranges)
+        elif re.match(r'^[\d*:,]+$', key):
+            ranges = parse_set(key, len(self.selected.messages))
+            return lambda seq, msg: in_set(seq, ranges)
+        raise CommandError('Unknown search key %s' % key)
+
+    def search(self, tokens, uid):
+        '''Returns a list of (sequence number, message) tuples'''
+        tokens = list(tokens)
+        if tokens and text(tokens[0]).upper() == 'CHARSET':
+            tokens = tokens[2:]
+        if not tokens:
+            raise CommandError('Missing search criteria')
+        predicates = []
+        while tokens:
+            predicates.append(self.search_key(tokens, uid))
+        return [(seq, message)
+                for seq, message in enumerate(self.selected.messages, 1)
+                if all(Xi(seq, message) for Xi in predicates)]
+
+    def cmd_SEARCH(self, args, uid=False):
+        return_options = None
+        if len(args) > 1 and text(args[0]).upper() == 'RETURN' and \
+           isinstance(args[1], list):
+            self.require('ESEARCH')
+            return_options = [text(Xi).upper() for Xi in args[1]] or ['ALL']
+            args = args[2:]
+        result = [message.uid if uid else seq
+                  for seq, message in self.search(args, uid)]
+        if return_options is None:
+            self.untagged('SEARCH', *[str(Xi) for Xi in result])
+            return
+        response = []
+        if uid:
+            response.append('UID')
+        if result and 'MIN' in return_options:
+            response.append('MIN %d' % min(result))
+        if result and 'MAX' in return_options:
+            response.append('MAX %d' % max(result))
+        if 'COUNT' in return_options:
+            response.append('COUNT %d' % len(result))
+        if result and 'ALL' in return_options:
+            response.append('ALL %s' % compress_set(result))
+        self.untagged('ESEARCH', *response)
+
+    def sort_key(self, key):
+        '''Returns the sort key function for a SORT key'''
+        if key == 'ARRIVAL':
+            return lambda msg: msg.internal_date
+        elif key == 'DATE':
+            return lambda msg: msg.sent_date()
+        elif key == 'SIZE':
+            return lambda msg: msg.size()
+        elif key == 'SUBJECT':
+            return lambda msg: base_subject(msg.fields['subject'])
+        elif key in ('FROM', 'TO', 'CC'):
+            return lambda msg: msg.first_address(key.lower())
+        elif key in ('DISPLAYFROM', 'DISPLAYTO'):
+            self.require('SORT=DISPLAY')
+            return lambda msg: msg.first_address(key[7:].lower(), True)
+        raise CommandError('Unknown sort key %s' % key)
+
+    def cmd_SORT(self, args, uid=False):
+        self.require('SORT')
+        if len(args) < 3 or not isinstance(args[0], list):
+            raise CommandError('SORT needs a sort program')
+        program = [text(Xi).upper() for Xi in args[0]]
+        # The charset is mandatory
+        messages = self.search(args[2:], uid)
+        keys = []
+        reverse = False
+        for key in program:
+            if key == 'REVERSE':
+                reverse = True
+                continue
+            keys.append((self.sort_key(key), reverse))
+            reverse = False
+        for key, reverse in reversed(keys):
+            messages.sort(key=lambda Xi: key(Xi[1]), reverse=reverse)
+        self.untagged('SORT', *[str(message.uid if uid else seq)
+                                for seq, message in messages])
+
+    def cmd_THREAD(self, args, uid=False):
+        if len(args) < 3:
+            raise CommandError('THREAD needs an algorithm')
+        algorithm = text(args[0]).upper()
+        self.require('THREAD=%s' % algorithm)
+        messages = self.search(args[2:], uid)
+        if algorithm == 'ORDEREDSUBJECT':
+            threads = self.thread_orderedsubject(messages)
+        elif algorithm == 'REFERENCES':
+            threads = self.thread_references(messages)
+        else:
+            raise CommandError('Unknown algorithm')
+
+        def identifier(item):
+            seq, message = item
+            return str(message.uid if uid else seq)
+
+        def format_node(node):
+            item, children = node
+            result = []
+            while True:
+                if item is not None:
+                    result.append(identifier(item))
+                if len(children) == 1:
+                    item, children = children[0]
+                    continue
+                if children:
+                    result.append(''.join('(%s)' % format_node(Xi)
+                                          for Xi in children))
+                return ' '.join(result)
+
+        self.untagged('THREAD ' + ''.join('(%s)' % format_node(Xi)
+                                          for Xi in threads))
+
+    def thread_orderedsubject(self, messages):
+        groups = collections.OrderedDict()
+        for item in sorted(messages, key=lambda Xi: (Xi[1].sent_date(),
+                                                     Xi[0])):
+            subject = base_subject(item[1].fields['subject'])
+            groups.setdefault(subject, []).append(item)
+        threads = []
+        for items in groups.values():
+            threads.append((items[0], [(Xi, []) for Xi in items[1:]]))
+        return threads
+
+    def thread_references(self, messages):
+        '''Simplified REFERENCES algorithm (RFC 5256)'''
+        nodes = {}
+
+        def node(message_id):
+            if message_id not in nodes:
+                nodes[message_id] = {'item': None, 'parent': None,
+                                     'children': []}
+            return nodes[message_id]
+
+        def is_ancestor(ancestor, child):
+            while child is not None:
+                if child is ancestor:
+                    return True
+                child = child['parent']
+            return False
+
+        def link(parent, child):
+            if child['parent'] is parent or is_ancestor(child, parent):
+                return
+            if child['parent'] is not None:
+                child['parent']['children'].remove(child)
+            child['parent'] = parent
+            parent['children'].append(child)
+
+        for index, item in enumerate(messages):
+            message_id = item[1].fields['message_id'] or '<%d@dummy>' % index
+            if message_id in nodes and nodes[message_id]['item'] is not None:
+                message_id = '<dup-%d>%s' % (index, message_id)
+            current = node(message_id)
+            current['item'] = item
+            references = item[1].fields['references'] or []
+            for first, second in zip(references, references[1:]):
+                if node(second)['parent'] is None:
+                    link(node(first), node(second))
+            if references:
+                link(node(references[-1]), current)
+            elif current['parent'] is not None:
+                current['parent']['children'].remove(current)
+                current['parent'] = None
+
+        def date(entry):
+            if entry['item'] is not None:
+                return (entry['item'][1].sent_date(), entry['item'][0])
+            return min(date(Xi) for Xi in entry['children'])
+
+        def prune(entry):
+            children = []
+            for child in entry['children']:
+                child = prune(child)
+                if child is None:
+                    continue
+                if child['item'] is None and (entry['parent'] is not None or
+                                              len(child['children']) == 1):
+                    children.extend(child['children'])
+                else:
+                    children.append(child)
+            entry['children'] = children
+            if entry['item'] is None and not children:
+                return None
+            return entry
+
+        roots = []
+        for entry in nodes.values():
+            if entry['parent'] is None:
+                entry = prune(entry)
+                if entry is None:
+                    continue
+                if entry['item'] is None and len(entry['children']) == 1:
+                    entry = entry['children'][0]
+                roots.append(entry)
+
+        def convert(entry):
+            children = sorted(entry['children'], key=date)
+            return (entry['item'], [convert(Xi) for Xi in children])
+
+        return [convert(Xi) for Xi in sorted(roots, key=date)]
+
+
+if __name__ == '__main__':
+    import getopt
+    import sys
+
+    def usage():
+        print('''Usage: python3 -m imaplib2.fakeserver [options]
+
+    -o <address>    address to bind to (default: 127.0.0.1)
+    -p <port>       port to bind to (default: 1143)
+    -m <messages>   number of messages on the INBOX (default: 200)
+    -f <depth,breadth>
+                    add a synthetic folder tree
+    -l <latency>    round trip latency in ms (default: 0)
+    -b <bandwidth>  bandwidth in bytes/s (default: unlimited)
+    -c <caps>       comma separated capability list
+''')
+
+    try:
+        optlist, args = getopt.getopt(sys.argv[1:], 'ho:p:m:f:l:b:c:')
+    except getopt.error as val:
+        usage()
+        sys.exit(1)
+
+    options = dict(optlist)
+    if '-h' in options:
+        usage()
+        sys.exit(0)
+
+    mailboxes = dict(DEFAULT_MAILBOXES)
+    mailboxes['INBOX'] = int(options.get('-m', 200))
+    if '-f' in options:
+        depth, breadth = options['-f'].split(',')
+        mailboxes.update(synthetic_tree(int(depth), int(breadth)))
+    capabilities = DEFAULT_CAPABILITIES
+    if '-c' in options:
+        capabilities = options['-c'].split(',')
+    bandwidth = options.get('-b')
+
+    server = FakeIMAPServer(host=options.get('-o', '127.0.0.1'),
+                            port=int(options.get('-p', 1143)),
+                            mailboxes=mailboxes,
+                            capabilities=capabilities,
+                            latency=float(options.get('-l', 0)) / 1000,
+                            bandwidth=int(bandwidth) if bandwidth else None)
+    print('Fake IMAP server listening on %s:%d' % server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(server.stats)
+        server.server_close()
@@ -37,6 +37,7 @@ COMMANDS = {
         'CREATE':       ('AUTH', 'SELECTED'),
         'DELETE':       ('AUTH', 'SELECTED'),
         'DELETEACL':    ('AUTH', 'SELECTED'),
+        'ENABLE':       ('AUTH',),
         'EXAMINE':      ('AUTH', 'SELECTED'),
         'EXPUNGE':      ('SELECTED',),
         'FETCH':        ('SELECTED',),
@@ -50,6 +51,7 @@ COMMANDS = {
         'LOGIN':        ('NONAUTH',),
         'LOGOUT':       ('NONAUTH', 'AUTH', 'SELECTED', 'LOGOUT'),
         'LSUB':         ('AUTH', 'SELECTED'),
+        'MOVE':         ('SELECTED',),
         'MYRIGHTS':     ('AUTH', 'SELECTED'),
         'NAMESPACE':    ('AUTH', 'SELECTED'),
         'NOOP':         ('NONAUTH', 'AUTH', 'SELECTED', 'LOGOUT'),
@@ -76,6 +78,7 @@ COMMANDS = {
 STATUS = ('ALERT',
           'BADCHARSET',
           'CAPABILITY',
+          'HIGHESTMODSEQ',  # RFC 7162 - CONDSTORE
           'PARSE',
           'PERMANENTFLAGS',
           'READ-ONLY',
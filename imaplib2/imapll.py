@@ -122,15 +122,17 @@ class IMAP4:
 
         # Create unique tag for this session,
         # and compile tagged response matcher.
-        self.tagpre = Int2AP(random.randint(4096, 65535))
-        self.tagre = re.compile(r'(?P<tag>' + self.tagpre +
-                                r'\d+) (?P<type>[A-Z]+) (?P<data>.*)')
-        self.tagnum = 0
+        self.set_tag_prefix(Int2AP(random.randint(4096, 65535)))
 
         self.tagged_commands = {}
         self.continuation_data = ContinuationRequests()
         self._encoding = 'utf-8'
 
+        # Traffic counters
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.literal_bytes = 0
+
         # Open the connection to the server
         self.open(host, port)
 
@@ -221,6 +223,17 @@ class IMAP4:
         '''
         self.continuation_data.push(obj)
 
+    def set_tag_prefix(self, tagpre):
+        '''Defines the prefix used on the command tags and compiles the
+        tagged response matcher. The tag counter is reset.
+
+        @param tagpre: the new tag prefix, an A-P string.
+        '''
+        self.tagpre = tagpre
+        self.tagre = re.compile(r'(?P<tag>' + self.tagpre +
+                                r'\d+) (?P<type>[A-Z]+) (?P<data>.*)')
+        self.tagnum = 0
+
     ##
     # SEND/RECEIVE commands from the server
     ##
@@ -261,7 +274,7 @@ class IMAP4:
 
         # Send the command to the server
         self.tagged_commands[tag] = tagcommand
-        self.send('%s %s\r\n' % (tag, command))
+        self._send('%s %s\r\n' % (tag, command))
 
         if read_resp:
             return tag, self.read_responses(tag)
@@ -343,6 +356,17 @@ class IMAP4:
     ##
     # Private methods
     ##
+    def _send(self, data):
+        '''Sends data to the server, updating the traffic counters. The
+        counters are in bytes, so the non ASCII data (UTF8=ACCEPT, literals)
+        is counted encoded.
+        '''
+        if data.isascii():
+            self.bytes_sent += len(data)
+        else:
+            self.bytes_sent += len(bytes(data, self._encoding))
+        self.send(data)
+
     def _new_tag(self):
         '''Returns a new tag.'''
         tag = '%s%03d' % (self.tagpre, self.tagnum)
@@ -354,7 +378,9 @@ class IMAP4:
         it will recurse until we have read a complete line.
         '''
         # Read a line from the server
-        line = self.readline()[:-2]
+        line = self.readline()
+        self.bytes_received += len(line)
+        line = line[:-2]
 
         # Verify if a literal is comming
         lt = literal_re.match(line)
@@ -363,6 +389,8 @@ class IMAP4:
             # the line read and read the rest of the line
             size = int(lt.group('size'))
             literal = self.read(size)
+            self.bytes_received += size
+            self.literal_bytes += size
             line += CRLF + literal + bytes(self._get_line(), self._encoding)
 
         try:
@@ -405,7 +433,7 @@ class IMAP4:
             return line
         elif line[:2] == '+ ':
             # It's a continuation, we're sending a literal
-            self.send(self.continuation_data.pop(line[2:]) + '\r\n')
+            self._send(self.continuation_data.pop(line[2:]) + '\r\n')
             return None
         else:
             raise self.Abort('What now??? What\'s this:\nS: %r' % line)
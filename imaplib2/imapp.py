@@ -33,17 +33,21 @@ appropriate data which will be return at the command end.
 '''
 
 # Global imports
+from array import array
 import re
 import socket
+import time
 
 # Local imports
 from .imapll import IMAP4, IMAP4_SSL
 from .infolog import InfoLog
+from .metrics import CommandMetrics, process_metrics
 from .imapcommands import COMMANDS, STATUS
-from .utils import makeTagged, unquote, shrink_fetch_list, list_to_int
+from .utils import makeTagged, unquote, SequenceSet, ThreadList, int_array
 from .parsefetch import FetchParser
 from . import parselist
 from .sexp import scan_sexp
+from . import utf7
 
 # Constants
 D_NOTPARSED = 8
@@ -55,6 +59,7 @@ MAXLOG = 100
 CRLF = '\r\n'
 SP = ' '
 MAXCLILEN = 16384  # max command line lenght accepted by the IMAP server
+MAXTAGLEN = 10  # worst case tag lenght, used to compute the command lenght
 
 # Regexp
 opt_respcode_re = re.compile(r'^\[(?P<code>[a-zA-Z0-9-]+)(?P<args>.*?)\].*$')
@@ -138,7 +143,25 @@ class IMAP4P:
                  keyfile=None,
                  certfile=None,
                  infolog=InfoLog(MAXLOG),
-                 autologout=True):
+                 autologout=True,
+                 imap_class=None,
+                 metrics=None):
+        '''
+        @param imap_class: callable used to create the low level connection
+            instead of IMAP4 or IMAP4_SSL, it's called with the host, port
+            and parse_command keyword arguments, and also keyfile and
+            certfile if ssl is set. This can be used, for
+            instance, to record or replay a session (see imaplib2.replay).
+        @param metrics: CommandMetrics instance where the per command
+            metrics are recorded, by default a new instance is created and
+            the metrics are aggregated on imaplib2.metrics.process_metrics.
+        '''
+
+        # Per command metrics
+        if metrics is None:
+            metrics = CommandMetrics(parent=process_metrics)
+        self.metrics = metrics
+        self._parse_time = 0.0
 
         # Choose the right connection, and then connect to the server
         self.autologout = autologout
@@ -149,7 +172,14 @@ class IMAP4P:
                 port = IMAP4_PORT
 
         try:
-            if ssl:
+            if imap_class and ssl:
+                self.__IMAP4 = imap_class(host=host, port=port,
+                                          keyfile=keyfile, certfile=certfile,
+                                          parse_command=self.parse_command)
+            elif imap_class:
+                self.__IMAP4 = imap_class(host=host, port=port,
+                                          parse_command=self.parse_command)
+            elif ssl:
                 self.__IMAP4 = IMAP4_SSL(host=host, port=port,
                                          keyfile=keyfile, certfile=certfile,
                                          parse_command=self.parse_command)
@@ -176,9 +206,16 @@ class IMAP4P:
         self.infolog.addEntry('WELCOME', self.welcome)
 
         self.capabilities = []
+        self.enabled = set()
         self.has_uid = None
         self.has_sort = None
 
+        # Most servers advertise their capabilities on the greeting, this
+        # way we don't have to issue a CAPABILITY command
+        greeting = response_re.match(self.welcome[2:])
+        if greeting:
+            self.parse_optional_codes(greeting.group('args').strip())
+
     def __del__(self):
         if __debug__:
             if Debug & D_DEL:
@@ -272,8 +309,10 @@ class IMAP4P:
     def parse_command(self, tag, response):
         '''Further processing of the server response.
         '''
+        start = time.perf_counter()
         self._parse_tagged(tag, response['tagged'])
         self._parse_untagged(tag, response['untagged'])
+        self._parse_time += time.perf_counter() - start
 
         return response
 
@@ -339,6 +378,10 @@ class IMAP4P:
 
     def CAPABILITY_response(self, code, args):
         self.sstatus['capability'] = tuple(args.upper().split())
+        self.capabilities = self.sstatus['capability']
+
+    def ENABLED_response(self, code, args):
+        self.sstatus['enabled'] = tuple(args.upper().split())
 
     def EXISTS_response(self, code, args):
         self.sstatus['current_folder']['EXISTS'] = int(args)
@@ -355,6 +398,25 @@ class IMAP4P:
             # S: JBNG008 OK Success<cr><lf>
             self.sstatus['current_folder']['expunge_list'] = []
         self.sstatus['current_folder']['expunge_list'].append(int(args))
+        # Each EXPUNGE decrements the number of messages (RFC3501 7.4.1)
+        if 'EXISTS' in self.sstatus['current_folder']:
+            self.sstatus['current_folder']['EXISTS'] -= 1
+
+    def VANISHED_response(self, code, args):
+        # QRESYNC (RFC7162): * VANISHED [(EARLIER)] <uid set>
+        # The UIDs are accumulated on current_folder['vanished'], it's up to
+        # the user to clear the list.
+        earlier = args.upper().startswith('(EARLIER)')
+        if earlier:
+            args = args[len('(EARLIER)'):]
+        try:
+            uids = list(SequenceSet(args.strip()))
+        except (SequenceSet.Error, ValueError) as e:
+            raise self.Error('Problem parsing the vanished response: %s' % e)
+        current_folder = self.sstatus['current_folder']
+        current_folder.setdefault('vanished', []).extend(uids)
+        if not earlier and 'EXISTS' in current_folder:
+            current_folder['EXISTS'] -= len(uids)
 
     def FETCH_response(self, code, args):
         # Message number
@@ -368,6 +430,12 @@ class IMAP4P:
         # Parse the response:
         response = FetchParser(args[fresp.end():])
         response['ID'] = msg_num
+        if 'MODSEQ' in response:
+            # CONDSTORE, keep the folder HIGHESTMODSEQ up to date
+            current_folder = self.sstatus['current_folder']
+            modseq = int(response['MODSEQ'][0])
+            if modseq > current_folder.get('HIGHESTMODSEQ', modseq):
+                current_folder['HIGHESTMODSEQ'] = modseq
         if 'UID' in response:
             # If UIDPLUS capability, index mes by uid
             self.sstatus['fetch_response'][response['UID']] = response
@@ -428,16 +496,13 @@ class IMAP4P:
         self.sstatus['current_folder']['RECENT'] = int(args)
 
     def SEARCH_response(self, code, args):
-        self.sstatus['search_response'] = tuple([int(Xi)
-                                                 for Xi in args.split()])
+        self.sstatus['search_response'] = int_array(args)
 
     def SORT_response(self, code, args):
-        self.sstatus['sort_response'] = tuple([int(Xi)
-                                               for Xi in args.split()])
+        self.sstatus['sort_response'] = int_array(args)
 
     def THREAD_response(self, code, args):
-        response = scan_sexp(args)
-        self.sstatus['thread_response'] = list_to_int(response)
+        self.sstatus['thread_response'] = ThreadList(args)
 
     def STATUS_response(self, code, args):
         response = scan_sexp(args)
@@ -479,7 +544,7 @@ class IMAP4P:
             command = name
 
         # Sends the command to the server, and parses the response
-        tag, response = self.send_command(command)
+        tag, response = self._send_command(name, command)
 
         # Checks if the command was successfull
         if self._checkok(tag, response):
@@ -518,7 +583,7 @@ class IMAP4P:
 
         return self.processCommand(name, args)
 
-    def authenticate(self, mech, authobject):
+    def authenticate(self, mech, authobject, initial_response=None):
         '''
         Send an AUTHENTICATE command to the server.
 
@@ -538,21 +603,33 @@ class IMAP4P:
         @param authobject: Authentication object, or list of autentication
                            objects
         @type  authobject: callable, or string
+        @param initial_response: base64 encoded initial client response, sent
+            with the command itself (RFC4959). The server must have the
+            SASL-IR capability.
+        @type  initial_response: string
         '''
 
         name = 'AUTHENTICATE'
 
-        try:
-            if isinstance(authobject, str):
+        if initial_response is not None:
+            args = '%s %s' % (mech, initial_response or '=')
+        else:
+            args = mech
+            try:
+                if isinstance(authobject, str):
+                    self.push_continuation(authobject)
+                else:
+                    for obj in authobject:
+                        self.push_continuation(obj)
+            except:
                 self.push_continuation(authobject)
-            else:
-                for obj in authobject:
-                    self.push_continuation(obj)
-        except:
-            self.push_continuation(authobject)
+
+        # The capabilities can change after the authentication, the server
+        # usually sends the new ones on the tagged response
+        self.capabilities = []
 
         try:
-            self.processCommand(name, mech)
+            self.processCommand(name, args)
             self.state = 'AUTH'
         except:
             raise self.Error('Could not login.')
@@ -597,10 +674,12 @@ class IMAP4P:
 
         name = 'COPY'
 
-        message_list = ','.join('%s' % Xi for Xi in message_list)
-        args = ' %s "%s"' % (message_list, mailbox)
+        args = ' "%s"' % mailbox
+        result = self.sstatus
+        for message_set in self._message_sets(message_list, name, args):
+            result = self.processCommand(name, message_set + args)
 
-        return self.processCommand(name, args)
+        return result
 
     def create(self, mailbox):
         '''Create new mailbox.'''
@@ -629,6 +708,23 @@ class IMAP4P:
 
         return self.processCommand(name, '"%s" %s' % (mailbox, identifier))
 
+    def enable(self, *capabilities):
+        '''Enables server extensions (RFC5161), for instance CONDSTORE or
+        UTF8=ACCEPT.
+
+        @param capabilities: capabilities to enable
+
+        @return: tuple with the capabilities the server enabled, those are
+            also added to <instance>.enabled
+        '''
+        name = 'ENABLE'
+
+        self.sstatus['enabled'] = ()
+        self.processCommand(name, ' '.join(capabilities))
+        self.enabled.update(self.sstatus['enabled'])
+
+        return self.sstatus['enabled']
+
     def expunge(self):
         '''Permanently remove deleted items from selected mailbox.
 
@@ -657,59 +753,14 @@ class IMAP4P:
         # IMAP server has a maximum lenght for the command line
         # so if the command line is bigger than a MAXCLILEN we
         # have to make severall fetch commands to complete the
-        # fetch.
-        if isinstance(message_list, list) or \
-           isinstance(message_list, tuple):
-            if not message_list:
-                raise self.Error('Can\'t fetch an empty message list.')
-
-            shrinked_list = shrink_fetch_list(message_list)
-            message_list = ','.join('%s' % Xi for Xi in shrinked_list)
-
-            # Worst case cenario command lenght
-            command_len = len('UID FETCH %s %s' % (message_list,
-                                                   message_parts)) + 2
-
-            if command_len > MAXCLILEN:
-                shrinked_list = list(shrinked_list)
-                len_overhead = len('UID FETCH %s' % (message_parts)) + 2
-                message_list = ''
-                result = {}
-                while shrinked_list:
-                    msg = '%s' % shrinked_list.pop()
-                    if len(message_list)+len(msg)+len_overhead <= MAXCLILEN:
-                        # Compose the partial message list
-                        message_list += ',%s' % msg
-                    else:
-                        # Make a partial fetch
-                        shrinked_list.append(msg)
-                        args = '%s %s' % (message_list.strip(','),
-                                          message_parts)
-                        tmp_result = process_command(name,
-                                                     args)['fetch_response']
-
-                        # Merge the results:
-                        for key in tmp_result:
-                            result[key] = tmp_result[key]
-                        message_list = ''
-
-                if message_list:
-                    args = '%s %s' % (message_list.strip(','),
-                                      message_parts)
-                    tmp_result = process_command(name,
-                                                 args)['fetch_response']
-                    for key in tmp_result:
-                        result[key] = tmp_result[key]
-
-                self.sstatus['fetch_response'] = result
-                return result
-        elif isinstance(message_list, str):
-            message_list = message_list.strip()
-
-        if not message_list:
-            raise self.Error('Can\'t fetch an empty message list.')
-        args = '%s %s' % (message_list,  message_parts)
-        return process_command(name, args)['fetch_response']
+        # fetch. The responses are accumulated on
+        # self.sstatus['fetch_response'].
+        args = ' %s' % message_parts
+        result = self.sstatus
+        for message_set in self._message_sets(message_list, name, args):
+            result = process_command(name, message_set + args)
+
+        return result['fetch_response']
 
     def fetch_seq(self, message_list, message_parts='(FLAGS)'):
         '''Fetch (parts of) messages.'''
@@ -730,16 +781,27 @@ class IMAP4P:
 
         return self.processCommand(name, '"%s"' % mailbox)['acl_response']
 
-    def list(self, directory='', pattern='*'):
+    def list(self, directory='', pattern='*', selection=None,
+             return_options=None):
         '''List mailbox names in directory matching pattern.
+
+        @param selection: LIST-EXTENDED selection options (RFC5258), for
+            instance ('SUBSCRIBED',);
+        @param return_options: LIST-EXTENDED return options, for instance
+            ('CHILDREN',).
         '''
 
         name = 'LIST'
 
         self.sstatus['list_response'] = []
 
-        return self.processCommand(name, '"%s" "%s"' %
-                                   (directory, pattern))['list_response']
+        args = '"%s" "%s"' % (directory, pattern)
+        if selection:
+            args = '(%s) %s' % (' '.join(selection), args)
+        if return_options:
+            args = '%s RETURN (%s)' % (args, ' '.join(return_options))
+
+        return self.processCommand(name, args)['list_response']
 
     def listrights(self, mailbox, identifier):
         '''LISTRIGHTS command takes a mailbox name and an identifier and
@@ -769,6 +831,10 @@ class IMAP4P:
         """
         name = 'LOGIN'
 
+        # The capabilities can change after the login, the server usually
+        # sends the new ones on the tagged response
+        self.capabilities = []
+
         try:
             self.processCommand(name, '%s \"%s\"' % (user, password))
             self.state = 'AUTH'
@@ -785,17 +851,25 @@ class IMAP4P:
 
     def login_auth(self, user, password):
         '''Login using PLAIN mech. Must have AUTH=PLAIN capability.
+
+        If the server has the SASL-IR capability the credentials are sent
+        with the AUTHENTICATE command, saving a round trip.
         '''
         import base64
-        auth_tokens = base64.b64encode('%s\0%s\0%s' % (user, user, password))
+        auth_tokens = str(base64.b64encode(bytes(
+            '%s\0%s\0%s' % (user, user, password), 'utf-8')), 'ascii')
 
+        if self.has_capability('SASL-IR'):
+            return self.authenticate('PLAIN', None,
+                                     initial_response=auth_tokens)
         return self.authenticate('PLAIN', auth_tokens)
 
     def login_login(self, user, password):
         '''Login using LOGIN mech. Must have AUTH=LOGIN capability.
         '''
         import base64
-        auth_tokens = [base64.b64encode(user), base64.b64encode(password)]
+        auth_tokens = [str(base64.b64encode(bytes(token, 'utf-8')), 'ascii')
+                       for token in (user, password)]
 
         return self.authenticate('LOGIN', auth_tokens)
 
@@ -843,6 +917,24 @@ class IMAP4P:
         return self.processCommand(name,
                                    '"%s"' % (mailbox))['myrights_response']
 
+    def move_seq(self, message_list, mailbox):
+        '''Move messages to mailbox.
+
+        The server must support the MOVE capability (RFC6851)
+
+        http://www.ietf.org/rfc/rfc6851.txt
+        '''
+        name = 'MOVE'
+
+        self.sstatus['current_folder']['expunge_list'] = []
+
+        args = ' "%s"' % mailbox
+        result = self.sstatus
+        for message_set in self._message_sets(message_list, name, args):
+            result = self.processCommand(name, message_set + args)
+
+        return result
+
     def namespace(self):
         '''
         '''
@@ -865,16 +957,17 @@ class IMAP4P:
         return self.processCommand(name, '"%s" "%s"' % (oldmailbox,
                                                         newmailbox))
 
-    def search_seq(self, criteria, charset=None):
-        '''Search mailbox for matching messages'''
-        name = 'SEARCH'
-        self.sstatus['search_response'] = ()
-        if charset:
-            args = 'CHARSET %s %s' % (charset, criteria)
-        else:
-            args = '%s' % criteria
+    def search_seq(self, criteria, charset=None, message_set=None):
+        '''Search mailbox for matching messages
 
-        return self.processCommand(name, args)['search_response']
+        @param criteria: search criteria
+        @param charset: charset used on the criteria
+        @param message_set: optional message set to restrict the search, if
+            it's too long to fit in a single command line, severall SEARCH
+            commands are made and the results merged.
+        '''
+        return self._search(self.processCommand, criteria, charset,
+                            message_set)
 
     def select(self, folder, readonly=False):
         '''Selects a folder
@@ -886,7 +979,12 @@ class IMAP4P:
 
         self.sstatus['current_folder'] = {}
 
-        self.processCommand(name, '"%s"' % folder)
+        try:
+            self.processCommand(name, '"%s"' % folder)
+        except self.Error:
+            # A failed SELECT leaves no mailbox selected (RFC3501 6.3.1)
+            self.state = 'AUTH'
+            raise
 
         self.sstatus['current_folder']['name'] = folder
         self.state = 'SELECTED'
@@ -921,7 +1019,7 @@ class IMAP4P:
 
         name = 'SORT'
 
-        self.sstatus['sort_response'] = ()
+        self.sstatus['sort_response'] = array('I')
 
         return self.processCommand(name, '%s %s %s' %
                                    (program,
@@ -966,15 +1064,7 @@ class IMAP4P:
         -FLAGS.SILENT <flag list>
         '''
 
-        name = 'STORE'
-
-        flags = '(%s)' % ' '.join(flags)
-
-        if isinstance(message_set, list):
-            message_set = ','.join('%s' % Xi for Xi in message_set)
-
-        return self.processCommand(name, '%s %s %s' % (message_set,
-                                                       command, flags))
+        return self._store(self.processCommand, message_set, command, flags)
 
     def subscribe(self, mailbox):
         '''
@@ -994,7 +1084,7 @@ class IMAP4P:
 
         name = 'THREAD'
 
-        self.sstatus['thread_response'] = ()
+        self.sstatus['thread_response'] = ThreadList()
 
         return self.processCommand(name, '%s %s %s' %
                                    (thread_alg,
@@ -1034,6 +1124,34 @@ class IMAP4P:
     # Helper methods
     ##
 
+    def _send_command(self, name, command):
+        '''Sends the command to the server and records its metrics.
+
+        @param name: name under which the metrics are recorded.
+        @param command: the complete command, without the tag.
+
+        @return: (tag, response) as returned by send_command.
+        '''
+        imap = self.__IMAP4
+        bytes_sent = imap.bytes_sent
+        bytes_received = imap.bytes_received
+        literal_bytes = imap.literal_bytes
+        self._parse_time = 0.0
+        ok = False
+        start = time.perf_counter()
+        try:
+            tag, response = self.send_command(command)
+            ok = response['tagged'].get(tag, {}).get('status') == 'OK'
+            return tag, response
+        finally:
+            elapsed = time.perf_counter() - start
+            self.metrics.record(name,
+                                max(elapsed - self._parse_time, 0.0),
+                                imap.bytes_sent - bytes_sent,
+                                imap.bytes_received - bytes_received,
+                                imap.literal_bytes - literal_bytes,
+                                self._parse_time, ok)
+
     def has_capability(self, capability):
         '''Checks if the server has a given capability.
 
@@ -1046,6 +1164,76 @@ class IMAP4P:
 
         return capability in self.capabilities
 
+    def decode_mailbox(self, name):
+        '''Converts a mailbox name, as used by the server, to unicode.
+
+        If UTF8=ACCEPT (RFC6855) is enabled the server uses UTF-8 mailbox
+        names and there's nothing to convert, otherwise the names are in
+        modified UTF-7.
+        '''
+        if 'UTF8=ACCEPT' in self.enabled:
+            return name
+        return utf7.decode_safe(name)
+
+    def _message_sets(self, message_set, name, args=''):
+        '''Converts a message set to a list of sequence set strings, each
+        one short enough for the command line to fit in MAXCLILEN.
+
+        @param message_set: int, sequence set string, iterable of message
+            numbers or SequenceSet instance.
+        @param name: command name
+        @param args: command arguments besides the message set.
+
+        @return: list of sequence set strings, empty if the message set is
+            empty: the commands aren't sent, and return an empty result.
+        '''
+        try:
+            message_set = SequenceSet(message_set)
+        except (SequenceSet.Error, ValueError, TypeError) as e:
+            raise self.Error('Invalid message set: %s' % e)
+        if not message_set:
+            return []
+        overhead = len('%s UID %s %s' % ('X' * MAXTAGLEN, name, args)) + 2
+        return list(message_set.chunks(MAXCLILEN - overhead))
+
+    def _store(self, process_command, message_set, command, flags):
+        name = 'STORE'
+
+        self.sstatus['fetch_response'] = {}
+
+        args = ' %s (%s)' % (command, ' '.join(flags))
+        result = self.sstatus
+        for chunk in self._message_sets(message_set, name, args):
+            result = process_command(name, chunk + args)
+
+        return result
+
+    def _search(self, process_command, criteria, charset=None,
+                message_set=None, prefix=''):
+        name = 'SEARCH'
+        self.sstatus['search_response'] = array('I')
+        if charset:
+            args = 'CHARSET %s %s' % (charset, criteria)
+        else:
+            args = '%s' % criteria
+
+        if message_set is None:
+            return process_command(name, args)['search_response']
+
+        # Restricted search, one command for each chunk of the message set
+        search_response = set()
+        for chunk in self._message_sets(message_set, name,
+                                        '%s%s' % (prefix, args)):
+            if charset:
+                chunk_args = 'CHARSET %s %s%s (%s)' % (charset, prefix, chunk,
+                                                       criteria)
+            else:
+                chunk_args = '%s%s (%s)' % (prefix, chunk, criteria)
+            search_response.update(
+                process_command(name, chunk_args)['search_response'])
+        self.sstatus['search_response'] = array('I', sorted(search_response))
+        return self.sstatus['search_response']
+
     # UID commands
     def processCommandUID(self, name, args):
         '''Process commands using the UID alternatives
@@ -1056,7 +1244,7 @@ class IMAP4P:
         command = 'UID %s %s' % (name, args)
 
         # Sends the command to the server, and parses the response
-        tag, response = self.send_command(command)
+        tag, response = self._send_command('UID %s' % name, command)
 
         # Checks if the command was successfull
         if self._checkok(tag, response):
@@ -1070,51 +1258,64 @@ class IMAP4P:
 
         name = 'COPY'
 
-        if isinstance(message_set, list):
-            message_set = shrink_fetch_list(message_set)
-            message_set = ','.join('%s' % Xi for Xi in message_set)
+        args = ' "%s"' % mailbox
+        result = self.sstatus
+        for chunk in self._message_sets(message_set, name, args):
+            result = self.processCommandUID(name, chunk + args)
 
-        args = '%s "%s"' % (message_set, mailbox)
+        return result
 
-        return self.processCommandUID(name, args)
+    def expunge_uid(self, message_set):
+        '''Permanently remove the deleted messages in message_set (UIDs).
 
-    def store_uid(self, message_set, command, flags):
-        '''Alters flag dispositions for messages in mailbox UID version.
+        The server must support the UIDPLUS capability (RFC4315)
+
+        Generates 'EXPUNGE' response for each deleted message.
         '''
+        name = 'EXPUNGE'
 
-        name = 'STORE'
+        self.sstatus['current_folder']['expunge_list'] = []
+
+        result = self.sstatus
+        for chunk in self._message_sets(message_set, name):
+            result = self.processCommandUID(name, chunk)
 
-        flags = '(' + ' '.join(flags) + ')'
+        return result['current_folder']['expunge_list']
+
+    def move_uid(self, message_set, mailbox):
+        '''Move messages to mailbox, UID version.'''
+        name = 'MOVE'
+
+        self.sstatus['current_folder']['expunge_list'] = []
 
-        if isinstance(message_set, list):
-            message_set = shrink_fetch_list(message_set)
-            message_set = ','.join('%s' % Xi for Xi in message_set)
-        args = '%s %s %s' % (message_set, command, flags)
+        args = ' "%s"' % mailbox
+        result = self.sstatus
+        for chunk in self._message_sets(message_set, name, args):
+            result = self.processCommandUID(name, chunk + args)
 
-        result = self.processCommandUID(name, args)
         return result
 
+    def store_uid(self, message_set, command, flags):
+        '''Alters flag dispositions for messages in mailbox UID version.
+        '''
+        return self._store(self.processCommandUID, message_set, command,
+                           flags)
+
     def fetch_uid(self, message_list, message_parts='(FLAGS)'):
         '''Fetch (parts of) messages, UID version.'''
         return self._fetch(True, message_list, message_parts)
 
-    def search_uid(self, criteria, charset=None):
-        '''SEARCH command UID version'''
-
-        name = 'SEARCH'
-        self.sstatus['search_response'] = ()
-        if charset:
-            args = 'CHARSET %s %s' % (charset, criteria)
-        else:
-            args = criteria
-        return self.processCommandUID(name, args)['search_response']
+    def search_uid(self, criteria, charset=None, message_set=None):
+        '''SEARCH command UID version, the message_set is a UID set'''
+        return self._search(self.processCommandUID, criteria, charset,
+                            message_set, 'UID ')
 
     def sort_uid(self, program, charset, search_criteria):
         '''SORT command returning UIDs (the server must support the UIDPLUS
         extension.
         '''
         name = 'SORT'
-        self.sstatus['sort_response'] = ()
+        self.sstatus['sort_response'] = array('I')
         args = '%s %s %s' % (program, charset, search_criteria)
         return self.processCommandUID(name, args)['sort_response']
 
@@ -1122,7 +1323,7 @@ class IMAP4P:
         '''THREAD command returning UIDs
         '''
         name = 'THREAD'
-        self.sstatus['thread_response'] = ()
+        self.sstatus['thread_response'] = ThreadList()
         args = '%s %s %s' % (thread_alg, charset, search_criteria)
         return self.processCommandUID(name, args)['thread_response']
 
@@ -1143,6 +1344,13 @@ class IMAP4P:
         else:
             return self.copy_seq(message_list, mailbox)
 
+    def move(self, message_list, mailbox):
+        self._checkUid()
+        if self.has_uid:
+            return self.move_uid(message_list, mailbox)
+        else:
+            return self.move_seq(message_list, mailbox)
+
     def store(self, message_set, command, flags):
         self._checkUid()
         if self.has_uid:
@@ -1172,12 +1380,12 @@ class IMAP4P:
             else:
                 return self.search_seq(search_criteria, charset)
 
-    def search(self, criteria, charset=None):
+    def search(self, criteria, charset=None, message_set=None):
         self._checkUid()
         if self.has_uid:
-            return self.search_uid(criteria, charset)
+            return self.search_uid(criteria, charset, message_set)
         else:
-            return self.search_seq(criteria, charset)
+            return self.search_seq(criteria, charset, message_set)
 
     def fetch(self, message_list, message_parts='(FLAGS)'):
         self._checkUid()
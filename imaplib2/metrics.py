@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+# imaplib2 python module, meant to be a replacement to the python default
+# imaplib module
+# Copyright (C) 2008 Helder Guerreiro
+
+# This file is part of imaplib2.
+#
+# imaplib2 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# imaplib2 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@tretas.org>
+#
+
+'''Per command metrics.
+
+Each IMAP4P instance records, for each command name (UID commands are
+recorded as 'UID <command>'):
+
+    * count - number of commands sent;
+    * errors - number of commands that didn't end with OK;
+    * rtt - round trip time histogram, in seconds, the response parsing time
+      is not included;
+    * bytes_sent - bytes sent to the server, including the literals;
+    * bytes_received - bytes received from the server;
+    * literal_bytes - bytes received inside literals;
+    * parse_time - time spent parsing the responses, in seconds.
+
+The metrics of all the IMAP4P instances are also aggregated on
+process_metrics, which can be exported as a dict or in the Prometheus text
+format::
+
+    from imaplib2.metrics import process_metrics
+
+    print(process_metrics.prometheus())
+'''
+
+# Global imports
+import threading
+
+# Constants
+RTT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+               10.0)
+
+COUNTERS = (('count', 'command_total', 'Number of IMAP commands sent'),
+            ('errors', 'command_errors_total',
+             'Number of IMAP commands not completed with OK'),
+            ('bytes_sent', 'command_sent_bytes_total',
+             'Bytes sent to the IMAP server'),
+            ('bytes_received', 'command_received_bytes_total',
+             'Bytes received from the IMAP server'),
+            ('literal_bytes', 'command_literal_bytes_total',
+             'Bytes received inside literals'),
+            ('parse_time', 'command_parse_seconds_total',
+             'Time spent parsing the server responses'))
+
+
+class CommandStats(object):
+    '''Metrics for a single command name'''
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.literal_bytes = 0
+        self.parse_time = 0.0
+        self.rtt_sum = 0.0
+        # The last bucket is +Inf
+        self.rtt_buckets = [0] * (len(RTT_BUCKETS) + 1)
+
+    def record(self, rtt, bytes_sent, bytes_received, literal_bytes,
+               parse_time, ok=True):
+        self.count += 1
+        if not ok:
+            self.errors += 1
+        self.bytes_sent += bytes_sent
+        self.bytes_received += bytes_received
+        self.literal_bytes += literal_bytes
+        self.parse_time += parse_time
+        self.rtt_sum += rtt
+        for i, bound in enumerate(RTT_BUCKETS):
+            if rtt <= bound:
+                self.rtt_buckets[i] += 1
+                break
+        else:
+            self.rtt_buckets[-1] += 1
+
+    def copy(self):
+        stats = CommandStats()
+        stats.merge(self)
+        return stats
+
+    def merge(self, other):
+        self.count += other.count
+        self.errors += other.errors
+        self.bytes_sent += other.bytes_sent
+        self.bytes_received += other.bytes_received
+        self.literal_bytes += other.literal_bytes
+        self.parse_time += other.parse_time
+        self.rtt_sum += other.rtt_sum
+        self.rtt_buckets = [a + b for a, b in zip(self.rtt_buckets,
+                                                  other.rtt_buckets)]
+
+    def cumulative_buckets(self):
+        '''Returns a list of (upper bound, cumulative count) tuples'''
+        result = []
+        total = 0
+        for bound, count in zip(RTT_BUCKETS + (float('inf'),),
+                                self.rtt_buckets):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def as_dict(self):
+        return {'count': self.count,
+                'errors': self.errors,
+                'bytes_sent': self.bytes_sent,
+                'bytes_received': self.bytes_received,
+                'literal_bytes': self.literal_bytes,
+                'parse_time': self.parse_time,
+                'rtt_sum': self.rtt_sum,
+                'rtt_buckets': [('+Inf' if bound == float('inf') else bound,
+                                 count)
+                                for bound, count in self.cumulative_buckets()]}
+
+
+class CommandMetrics(object):
+    '''Metrics of the IMAP commands, by command name. This class is thread
+    safe.
+
+    @param parent: another CommandMetrics instance, all the records are also
+        made on the parent.
+    '''
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.lock = threading.Lock()
+        self.commands = {}
+
+    def record(self, name, rtt, bytes_sent=0, bytes_received=0,
+               literal_bytes=0, parse_time=0.0, ok=True):
+        '''Records a command.
+
+        @param name: command name, for instance 'FETCH' or 'UID FETCH';
+        @param rtt: round trip time, in seconds;
+        @param bytes_sent: bytes sent to the server;
+        @param bytes_received: bytes received from the server;
+        @param literal_bytes: bytes received inside literals;
+        @param parse_time: time spent parsing the response, in seconds;
+        @param ok: False if the command failed.
+        '''
+        name = name.upper()
+        with self.lock:
+            if name not in self.commands:
+                self.commands[name] = CommandStats()
+            self.commands[name].record(rtt, bytes_sent, bytes_received,
+                                       literal_bytes, parse_time, ok)
+        if self.parent is not None:
+            self.parent.record(name, rtt, bytes_sent, bytes_received,
+                               literal_bytes, parse_time, ok)
+
+    def merge(self, other):
+        '''Adds the metrics of other to this instance'''
+        with other.lock:
+            commands = [(name, stats.copy())
+                        for name, stats in other.commands.items()]
+        with self.lock:
+            for name, stats in commands:
+                if name not in self.commands:
+                    self.commands[name] = CommandStats()
+                self.commands[name].merge(stats)
+
+    def reset(self):
+        with self.lock:
+            self.commands = {}
+
+    def as_dict(self):
+        '''Returns the metrics in the form {command name: {metric: value}}'''
+        with self.lock:
+            return dict((name, stats.as_dict())
+                        for name, stats in self.commands.items())
+
+    def prometheus(self, prefix='imaplib2'):
+        '''Returns the metrics in the Prometheus text exposition format'''
+        # The stats are copied, the records made while the text is built
+        # don't mix with the copied values
+        with self.lock:
+            commands = sorted((name, stats.copy())
+                              for name, stats in self.commands.items())
+        lines = []
+        for attr, metric, description in COUNTERS:
+            metric = '%s_%s' % (prefix, metric)
+            lines.append('# HELP %s %s' % (metric, description))
+            lines.append('# TYPE %s counter' % metric)
+            for name, stats in commands:
+                lines.append('%s{command="%s"} %s' % (metric, name,
+                                                      getattr(stats, attr)))
+
+        metric = '%s_command_rtt_seconds' % prefix
+        lines.append('# HELP %s IMAP command round trip time' % metric)
+        lines.append('# TYPE %s histogram' % metric)
+        for name, stats in commands:
+            for bound, count in stats.cumulative_buckets():
+                lines.append('%s_bucket{command="%s",le="%s"} %d' % (
+                    metric, name,
+                    '+Inf' if bound == float('inf') else bound, count))
+            lines.append('%s_sum{command="%s"} %s' % (metric, name,
+                                                      stats.rtt_sum))
+            lines.append('%s_count{command="%s"} %d' % (metric, name,
+                                                        stats.count))
+        return '\n'.join(lines) + '\n'
+
+    def __repr__(self):
+        return '<CommandMetrics %s>' % ', '.join(
+            '%s: %d' % (name, stats.count)
+            for name, stats in sorted(self.commands.items()))
+
+
+# Metrics of all the IMAP4P instances on this process
+process_metrics = CommandMetrics()
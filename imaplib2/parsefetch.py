@@ -27,6 +27,10 @@
 '''
 
 # Imports
+import email.parser
+import email.utils
+import re
+
 from .utils import (getUnicodeHeader, getUnicodeMailAddr,
                     internaldate2datetime, envelopedate2datetime)
 from .sexp import scan_sexp
@@ -390,6 +394,67 @@ def envelope(structure):
             'env_message_id': structure[9]}
 
 
+# Envelope fields and the headers they're taken from
+ENVELOPE_HEADERS = (('env_date', 'DATE'),
+                    ('env_subject', 'SUBJECT'),
+                    ('env_from', 'FROM'),
+                    ('env_sender', 'SENDER'),
+                    ('env_reply_to', 'REPLY-TO'),
+                    ('env_to', 'TO'),
+                    ('env_cc', 'CC'),
+                    ('env_bcc', 'BCC'),
+                    ('env_in_reply_to', 'IN-REPLY-TO'),
+                    ('env_message_id', 'MESSAGE-ID'))
+ADDRESS_HEADERS = ('FROM', 'SENDER', 'REPLY-TO', 'TO', 'CC', 'BCC')
+
+unfold_re = re.compile(r'\r?\n(?=[ \t])')
+
+
+def header_address_list(value):
+    '''Converts an address header to the ENVELOPE address structure'''
+    if not value:
+        return None
+    result = []
+    for name, address in email.utils.getaddresses([value]):
+        if not address:
+            continue
+        mailbox, _, host = address.partition('@')
+        result.append([name or None, None, mailbox, host])
+    return result or None
+
+
+def header_envelope(headers, names):
+    '''Builds the envelope fields from the message headers, for instance
+    the result of a BODY.PEEK[HEADER.FIELDS (DATE SUBJECT FROM)] fetch. The
+    fields are in the same format as the ones from the ENVELOPE.
+
+    @param headers: header text;
+    @param names: names of the headers requested, only the envelope fields
+        taken from these headers are returned.
+
+    @return: dict with the envelope fields.
+    '''
+    if isinstance(headers, bytes):
+        headers = str(headers, 'utf-8', 'replace')
+    message = email.parser.HeaderParser().parsestr(headers or '')
+    names = set(Xi.upper() for Xi in names)
+    structure = {}
+    for name in names:
+        value = message.get(name)
+        if value is not None:
+            value = unfold_re.sub('', value).strip()
+        if name in ADDRESS_HEADERS:
+            value = header_address_list(value)
+        structure[name] = value
+    # The server uses From as Sender and Reply-To when they're missing
+    for name in ('SENDER', 'REPLY-TO'):
+        if name in structure and not structure[name]:
+            structure[name] = structure.get('FROM')
+    fields = envelope([structure.get(name) for key, name in ENVELOPE_HEADERS])
+    return dict((key, fields[key]) for key, name in ENVELOPE_HEADERS
+                if name in names)
+
+
 def real_name(address):
     '''From an address returns the person real name or if this is empty the
     email address'''
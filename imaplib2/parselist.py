@@ -32,6 +32,8 @@ import base64
 NOSELECT = r'\Noselect'
 HASCHILDREN = r'\HasChildren'
 HASNOCHILDREN = r'\HasNoChildren'
+NONEXISTENT = r'\NonExistent'
+SUBSCRIBED = r'\Subscribed'
 
 
 class Mailbox(object):
@@ -50,11 +52,29 @@ class Mailbox(object):
         return attr in self.attributes
 
     def noselect(self):
-        return self.test_attribute(NOSELECT)
+        # \NonExistent implies \Noselect (RFC5258)
+        return (self.test_attribute(NOSELECT) or
+                self.test_attribute(NONEXISTENT))
+
+    def subscribed(self):
+        '''Only meaningful on the LIST-EXTENDED responses with the SUBSCRIBED
+        selection or return option.
+        '''
+        return self.test_attribute(SUBSCRIBED)
 
     def has_children(self):
         return self.test_attribute(HASCHILDREN)
 
+    def children(self):
+        '''Returns True or False if the server told us if the mailbox has
+        children (RFC3348 or RFC5258), None if we don't know.
+        '''
+        if self.test_attribute(HASCHILDREN):
+            return True
+        if self.test_attribute(HASNOCHILDREN):
+            return False
+        return None
+
     # Operators
     def __eq__(self, y):
         '''Compares the mailbox name against a string or against another
@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+
+# imaplib2 python module, meant to be a replacement to the python default
+# imaplib module
+# Copyright (C) 2008 Helder Guerreiro
+
+# This file is part of imaplib2.
+#
+# imaplib2 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# imaplib2 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@tretas.org>
+#
+
+'''Record and replay of the IMAP wire traffic.
+
+The recording transports capture every line and literal received from the
+server and every piece of data sent by the client, together with the time
+elapsed since the connection was opened. The credentials sent with LOGIN and
+AUTHENTICATE are redacted before they reach the replay file.
+
+The replay transport feeds the recorded server data back to IMAP4 (and so
+to IMAP4P and hlimap) without touching the network. This allows us to turn a
+real session into a repeatable offline benchmark.
+
+The replay file has one JSON object per line. The first line is the header::
+
+    {"imaplib2_replay": 1, "host": "...", "port": 143, "tagpre": "KDAB"}
+
+The following lines are the events::
+
+    {"t": 0.0012, "d": "S", "k": "line", "data": "* OK ready\\r\\n"}
+    {"t": 0.0150, "d": "C", "k": "send", "data": "KDAB0 CAPABILITY\\r\\n"}
+    {"t": 0.0380, "d": "S", "k": "literal", "data": "..."}
+
+"d" is the direction (S - from the server, C - from the client) and "k" the
+kind of read made ("line" for readline, "literal" for read). The data is
+stored as a latin-1 string, so that any byte sequence can be restored.
+
+Usage example::
+
+    from functools import partial
+    from imaplib2.imapp import IMAP4P
+    from imaplib2.replay import IMAP4_Record, IMAP4_Replay
+
+    # Record a session
+    M = IMAP4P('imap.example.com',
+               imap_class=partial(IMAP4_Record, record_file='session.rpl'))
+    M.login(USER, PASSWD)
+    ...
+
+    # Replay it
+    M = IMAP4P('imap.example.com',
+               imap_class=partial(IMAP4_Replay, replay_file='session.rpl'))
+    M.login(USER, PASSWD)
+    ...
+'''
+
+# Global imports
+import json
+import re
+import time
+
+# Local imports
+from .imapll import IMAP4, IMAP4_SSL, IMAP4_PORT
+
+# Constants
+REPLAY_VERSION = 1
+REDACTED = '"***"'
+
+# Regexp
+login_re = re.compile(r'^(?P<tag>\S+ )(?P<command>LOGIN) .*?(?P<crlf>\r\n)?$',
+                      re.IGNORECASE | re.DOTALL)
+authenticate_re = re.compile(r'^(?P<tag>\S+ )(?P<command>AUTHENTICATE '
+                             r'\S+)(?P<ir> \S+)?(?P<crlf>\r\n)?$',
+                             re.IGNORECASE | re.DOTALL)
+command_re = re.compile(r'^\S+ (?:UID )?(?P<command>[A-Za-z]+)')
+
+
+class ReplayError(Exception):
+    '''The replayed session diverged from the recorded one'''
+
+
+def redact(data, authenticating=False):
+    '''Removes the credentials from the data sent by the client.
+
+    @param data: data sent to the server.
+    @param authenticating: True if we're answering an AUTHENTICATE
+        continuation request.
+
+    @return: a tuple (data, redacted), redacted is True if the data was
+        changed.
+    '''
+    if authenticating:
+        return REDACTED + '\r\n', True
+
+    login = login_re.match(data)
+    if login:
+        return '%s%s %s %s%s' % (login.group('tag'), login.group('command'),
+                                 REDACTED, REDACTED,
+                                 login.group('crlf') or ''), True
+
+    auth = authenticate_re.match(data)
+    if auth and auth.group('ir'):
+        return '%s%s %s%s' % (auth.group('tag'), auth.group('command'),
+                              REDACTED, auth.group('crlf') or ''), True
+
+    return data, False
+
+
+def load_session(replay_file):
+    '''Reads a replay file.
+
+    @param replay_file: path to the replay file.
+
+    @return: a tuple (header, events), the events are dicts with the server
+        and client data converted to bytes.
+    '''
+    with open(replay_file, 'r', encoding='utf-8') as fd:
+        header = json.loads(fd.readline())
+        if header.get('imaplib2_replay') != REPLAY_VERSION:
+            raise ReplayError('%s is not a replay file.' % replay_file)
+        events = []
+        for line in fd:
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            event['data'] = bytes(event['data'], 'latin-1')
+            events.append(event)
+    return header, events
+
+
+class Recorder:
+    '''Writes the session events to the replay file. Each event is flushed,
+    the file can be replayed while the connection is still open. The events
+    after close are dropped.
+    '''
+
+    def __init__(self, record_file):
+        '''
+        @param record_file: path to the replay file or a file like object
+            opened in text mode.
+        '''
+        if isinstance(record_file, str):
+            self.fd = open(record_file, 'w', encoding='utf-8')
+            self.close_fd = True
+        else:
+            self.fd = record_file
+            self.close_fd = False
+        self.start = None
+        self.closed = False
+
+    def begin(self, host, port, tagpre):
+        self.start = time.monotonic()
+        self._write({'imaplib2_replay': REPLAY_VERSION,
+                     'host': host,
+                     'port': port,
+                     'tagpre': tagpre})
+
+    def event(self, direction, kind, data, redacted=False):
+        if isinstance(data, str):
+            data = bytes(data, 'utf-8')
+        event = {'t': round(time.monotonic() - self.start, 6),
+                 'd': direction,
+                 'k': kind,
+                 'data': str(data, 'latin-1')}
+        if redacted:
+            event['redacted'] = True
+        self._write(event)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.close_fd:
+            self.fd.close()
+        else:
+            self.fd.flush()
+
+    def _write(self, obj):
+        if self.closed:
+            return
+        self.fd.write(json.dumps(obj))
+        self.fd.write('\n')
+        self.fd.flush()
+
+
+class RecordMixin:
+    '''Adds recording to the IMAP4 transport methods. Must be used with an
+    IMAP4 based class.
+
+    The replay file is closed when the session ends: on the tagged response
+    to LOGOUT, on a BYE sent by the server without LOGOUT, or on shutdown.
+    '''
+
+    def __init__(self, *args, record_file=None, **kwargs):
+        self.recorder = Recorder(record_file)
+        self._authenticating = False
+        self._logout = False
+        super().__init__(*args, **kwargs)
+
+    def open(self, host='localhost', port=IMAP4_PORT):
+        super().open(host, port)
+        self.recorder.begin(host, port, self.tagpre)
+
+    def read(self, size):
+        data = super().read(size)
+        self.recorder.event('S', 'literal', data)
+        return data
+
+    def readline(self):
+        line = super().readline()
+        self.recorder.event('S', 'line', line)
+        # The tagged response ends the authentication exchange
+        if line.startswith(bytes(self.tagpre, 'ascii')):
+            self._authenticating = False
+            if self._logout:
+                self.recorder.close()
+        elif line.startswith(b'* BYE') and not self._logout:
+            self.recorder.close()
+        return line
+
+    def send(self, data):
+        if data.startswith(self.tagpre):
+            command = command_re.match(data)
+            name = command.group('command').upper() if command else None
+            self._authenticating = name == 'AUTHENTICATE'
+            self._logout = name == 'LOGOUT'
+            recorded, redacted = redact(data)
+        else:
+            # Continuation data, literals are kept intact
+            recorded, redacted = redact(data, self._authenticating)
+        self.recorder.event('C', 'send', recorded, redacted)
+        super().send(data)
+
+    def shutdown(self):
+        try:
+            super().shutdown()
+        finally:
+            self.recorder.close()
+
+
+class IMAP4_Record(RecordMixin, IMAP4):
+    '''IMAP4 transport that records the session.
+
+    Instantiate with: IMAP4_Record(host, port, parse_command, record_file)
+    '''
+
+
+class IMAP4_SSL_Record(RecordMixin, IMAP4_SSL):
+    '''IMAP4_SSL transport that records the session.
+
+    Instantiate with: IMAP4_SSL_Record(host, port, keyfile, certfile,
+    parse_command, record_file)
+    '''
+
+
+class IMAP4_Replay(IMAP4):
+    '''IMAP4 transport that replays a recorded session, no network
+    connection is made.
+
+    @param replay_file: path to the replay file;
+    @param strict: if True the data sent by the client is checked against
+        the recorded session (the redacted data is not checked);
+    @param realtime: if True the server responses are delayed in order to
+        reproduce the recorded timings.
+
+    keyfile and certfile are accepted, and ignored, so that a session
+    recorded over SSL can be replayed with the same IMAP4P arguments.
+    '''
+
+    def __init__(self, host='localhost', port=IMAP4_PORT, parse_command=None,
+                 replay_file=None, strict=True, realtime=False, keyfile=None,
+                 certfile=None):
+        self.header, self.events = load_session(replay_file)
+        self.strict = strict
+        self.realtime = realtime
+        self.position = 0
+        IMAP4.__init__(self, host=host, port=port,
+                       parse_command=parse_command)
+
+    def _next_event(self, direction, kind):
+        try:
+            event = self.events[self.position]
+        except IndexError:
+            raise self.Abort('replay error: end of the recorded session')
+        if event['d'] != direction or event['k'] != kind:
+            raise ReplayError('replay error: expected %s/%s got %s/%s at '
+                              'event %d' % (direction, kind, event['d'],
+                                            event['k'], self.position))
+        self.position += 1
+        if self.realtime and direction == 'S':
+            delay = event['t'] - (time.monotonic() - self.start)
+            if delay > 0:
+                time.sleep(delay)
+        return event
+
+    def open(self, host='localhost', port=IMAP4_PORT):
+        self.host = host
+        self.port = port
+        self.start = time.monotonic()
+        # The tags must be the same used on the recorded session
+        self.set_tag_prefix(self.header['tagpre'])
+
+    def read(self, size):
+        data = self._next_event('S', 'literal')['data']
+        if len(data) != size:
+            raise ReplayError('replay error: expected a %d bytes literal, '
+                              'got %d bytes' % (size, len(data)))
+        return data
+
+    def readline(self):
+        return self._next_event('S', 'line')['data']
+
+    def send(self, data):
+        event = self._next_event('C', 'send')
+        if (self.strict and not event.get('redacted') and
+                event['data'] != bytes(data, self._encoding)):
+            raise ReplayError('replay error: the client sent %r, the recorded '
+                              'session has %r' % (data, event['data']))
+
+    def shutdown(self):
+        self.position = len(self.events)
+
+    def socket(self):
+        return None
+
+    def replayed(self):
+        '''Returns True if all the recorded events were used.'''
+        return self.position == len(self.events)
+
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) != 2:
+        print('Usage: python3 -m imaplib2.replay <replay file>')
+        sys.exit(1)
+
+    header, events = load_session(sys.argv[1])
+
+    commands = {}
+    received = sent = literal = 0
+    for event in events:
+        if event['d'] == 'C':
+            sent += len(event['data'])
+            command = command_re.match(str(event['data'], 'latin-1'))
+            if command and event['data'].startswith(
+                    bytes(header['tagpre'], 'ascii')):
+                name = command.group('command').upper()
+                commands[name] = commands.get(name, 0) + 1
+        else:
+            received += len(event['data'])
+            if event['k'] == 'literal':
+                literal += len(event['data'])
+
+    print('Session with %s:%s' % (header['host'], header['port']))
+    print('Duration: %.3f s' % (events[-1]['t'] if events else 0))
+    print('Sent: %d bytes' % sent)
+    print('Received: %d bytes (%d bytes in literals)' % (received, literal))
+    print()
+    for name in sorted(commands):
+        print('%-16s %6d' % (name, commands[name]))
@@ -28,7 +28,9 @@ import re
 
 # Regexp
 literal_re = re.compile(r'^{(\d+)}\r\n')
-simple_re = re.compile(r'^([^ ()\[]+(?:\[[^\]]*\])?)')
+# Atoms, including the fetch items with a section and an origin octet, for
+# instance BODY[1]<0>
+simple_re = re.compile(r'^([^ ()\[]+(?:\[[^\]]*\](?:<\d+>)?)?)')
 quoted_re = re.compile(r'^"((?:[^"\\]|\\")*?)"')
 
 # Errors
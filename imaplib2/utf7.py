@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+# imaplib2 python module, meant to be a replacement to the python default
+# imaplib module
+# Copyright (C) 2008 Helder Guerreiro
+
+# This file is part of imaplib2.
+#
+# imaplib2 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# imaplib2 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with hlimap.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@tretas.org>
+#
+
+'''Modified UTF-7 mailbox name codec (RFC3501 section 5.1.3).
+
+The printable US-ASCII characters, except "&", represent themselves. "&" is
+represented by "&-". The other characters are encoded in UTF-16BE and then in
+modified BASE64 (the "/" is replaced by ","), between "&" and "-".
+
+The results are memoized, the same mailbox names are converted over and over
+again when the folder lists are rendered.
+
+Usage::
+
+    >>> encode('Correio Enviado/Ol\\xe1')
+    'Correio Enviado/Ol&AOE-'
+    >>> decode('Correio Enviado/Ol&AOE-')
+    'Correio Enviado/Ol\\xe1'
+'''
+
+# Global imports
+import base64
+import binascii
+import functools
+
+# Constants
+CACHE_SIZE = 4096
+
+
+class Error(Exception):
+    pass
+
+
+def _b64encode(text):
+    return str(base64.b64encode(bytes(text, 'utf-16be')),
+               'ascii').rstrip('=').replace('/', ',')
+
+
+def _b64decode(text):
+    text = text.replace(',', '/')
+    text += '=' * (-len(text) % 4)
+    try:
+        return str(base64.b64decode(text, validate=True), 'utf-16be')
+    except (binascii.Error, UnicodeDecodeError) as e:
+        raise Error('Invalid modified UTF-7 sequence "&%s-": %s' %
+                    (text, e))
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def encode(name):
+    '''Encodes a mailbox name in modified UTF-7.
+
+    @param name: mailbox name
+    @type  name: str
+
+    @return: the encoded name, a str with only US-ASCII characters.
+    '''
+    result = []
+    shifted = []
+    for char in name:
+        if '\x20' <= char <= '\x7e':
+            if shifted:
+                result.append('&%s-' % _b64encode(''.join(shifted)))
+                shifted = []
+            result.append('&-' if char == '&' else char)
+        else:
+            shifted.append(char)
+    if shifted:
+        result.append('&%s-' % _b64encode(''.join(shifted)))
+
+    return ''.join(result)
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def decode(name):
+    '''Decodes a modified UTF-7 mailbox name.
+
+    @param name: encoded mailbox name
+    @type  name: str
+
+    @return: the decoded name.
+
+    @raise Error: if name isn't valid modified UTF-7.
+    '''
+    if '&' not in name:
+        return name
+
+    result = []
+    pos = 0
+    while True:
+        start = name.find('&', pos)
+        if start == -1:
+            result.append(name[pos:])
+            break
+        end = name.find('-', start)
+        if end == -1:
+            raise Error('Unterminated modified UTF-7 sequence in "%s"' % name)
+        result.append(name[pos:start])
+        if end == start + 1:
+            result.append('&')
+        else:
+            result.append(_b64decode(name[start + 1:end]))
+        pos = end + 1
+
+    return ''.join(result)
+
+
+def decode_safe(name):
+    '''Same as decode but returns the name unchanged if it isn't valid
+    modified UTF-7. Some servers don't encode the mailbox names.
+    '''
+    try:
+        return decode(name)
+    except Error:
+        return name
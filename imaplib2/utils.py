@@ -27,12 +27,17 @@
 '''
 
 # Global imports
+from array import array
+import bisect
 import time
 import datetime
 import re
 from email.header import decode_header
 from email.errors import HeaderParseError
 
+# Regexp
+thread_token_re = re.compile(r'[()]|\d+')
+
 
 def to_bytes(s, encoding='utf-8'):
     if isinstance(s, str):
@@ -243,50 +248,12 @@ def list_to_int(msg_list):
                         for msg_id in msg_list]
 
 
-def shrink_fetch_list(msg_list):
-    '''Shrinks the message list to use on the fetch command, consecutive msg_list
-    numbers will be converted to first:last.
-
-    @param msg_list: a list of message numbers or uids
-    @type msg_list: list
-
-    @return: a list with the shrinked msg_list
+def int_array(text):
+    '''Converts a space separated list of numbers, as found on the SEARCH
+    and SORT responses, to an array of unsigned ints.
     '''
-    tmp = []
-    msg_list = list(msg_list)
-    if not msg_list:
-        return []
-
-    msg_list.sort()
-    last = msg_list[0]
-    anchor = 0
-
-    for msgn in msg_list[1:]:
-        if (last + 1) == msgn and not anchor:
-            anchor = last
-        elif anchor:
-            if (last + 1) != msgn:
-                if (anchor + 1) != last:
-                    tmp.append('%d:%d' % (anchor, last))
-                else:
-                    tmp.append('%d' % anchor)
-                    tmp.append('%d' % last)
-                anchor = 0
-        else:
-            tmp.append(last)
+    return array('I', map(int, text.split()))
 
-        last = msgn
-
-    if anchor:
-        if (anchor + 1) != last:
-            tmp.append('%d:%d' % (anchor, last))
-        else:
-            tmp.append('%d' % anchor)
-            tmp.append('%d' % last)
-    else:
-        tmp.append('%d' % last)
-
-    return tmp
 
 #
 # Classes
@@ -316,3 +283,302 @@ class ContinuationRequests(list):
         # try:
         #     while True: list.pop(self)
         # except: pass
+
+
+class SequenceSet(object):
+    '''IMAP sequence set (RFC 3501 sequence-set, RFC 5182 '$').
+
+    The set is kept as a sorted list of non overlapping, non adjacent
+    (first, last) ranges, so that the string representation is always the
+    shortest possible. '*' is represented by STAR, which is bigger than any
+    message number or UID.
+
+    The set can be created from:
+
+        * an int;
+        * a sequence set string, for instance '1:4,7,9:*' or '$';
+        * an iterable (list, tuple, array, ...) of ints or sequence set
+          strings;
+        * another SequenceSet.
+
+    Usage example::
+
+        >>> s = SequenceSet([1, 2, 3, 7, 9, 10])
+        >>> str(s)
+        '1:3,7,9:10'
+        >>> str(s | SequenceSet('4:5,11:*'))
+        '1:5,7,9:*'
+        >>> list(s.chunks(6))
+        ['1:3,7', '9:10']
+    '''
+    STAR = float('inf')
+    SAVED = '$'
+
+    class Error(Exception):
+        '''Invalid sequence set'''
+
+    def __init__(self, items=None):
+        self.ranges = []
+        self.saved = False
+        if items is None:
+            return
+        if isinstance(items, SequenceSet):
+            self.ranges = list(items.ranges)
+            self.saved = items.saved
+        elif isinstance(items, int):
+            self.ranges = [(items, items)]
+        elif isinstance(items, str):
+            if items.strip() == self.SAVED:
+                self.saved = True
+            else:
+                self.ranges = self._merge(self._parse(items))
+        else:
+            values = []
+            ranges = []
+            for item in items:
+                if isinstance(item, str) and not item.isdigit():
+                    if item.strip() == self.SAVED:
+                        raise self.Error('$ can not be combined with other '
+                                         'message numbers.')
+                    ranges.extend(self._parse(item))
+                else:
+                    values.append(int(item))
+            ranges.extend(self._from_values(values))
+            self.ranges = self._merge(ranges)
+
+    # Construction helpers
+    def _parse(self, text):
+        ranges = []
+        for item in text.strip().split(','):
+            try:
+                if ':' in item:
+                    first, last = item.split(':')
+                    first = self.STAR if first == '*' else int(first)
+                    last = self.STAR if last == '*' else int(last)
+                    if first > last:
+                        first, last = last, first
+                else:
+                    first = last = self.STAR if item == '*' else int(item)
+            except ValueError:
+                raise self.Error('Invalid sequence set: %s' % text)
+            ranges.append((first, last))
+        return ranges
+
+    @staticmethod
+    def _from_values(values):
+        '''Converts a list of ints to a sorted list of ranges.'''
+        ranges = []
+        if not values:
+            return ranges
+        values = sorted(values)
+        first = last = values[0]
+        for value in values[1:]:
+            if value > last + 1:
+                ranges.append((first, last))
+                first = value
+            last = value
+        ranges.append((first, last))
+        return ranges
+
+    @staticmethod
+    def _merge(ranges):
+        '''Sorts the ranges and merges the overlapping or adjacent ones.'''
+        ranges = sorted(ranges)
+        result = []
+        for first, last in ranges:
+            if result and first <= result[-1][1] + 1:
+                if last > result[-1][1]:
+                    result[-1] = (result[-1][0], last)
+            else:
+                result.append((first, last))
+        return result
+
+    # Set operations
+    def add(self, item):
+        '''Adds a message number, or a sequence set, to this set.'''
+        self.update(SequenceSet(item))
+
+    def update(self, other):
+        if not isinstance(other, SequenceSet):
+            other = SequenceSet(other)
+        if self.saved or other.saved:
+            raise self.Error('$ can not be combined with other message '
+                             'numbers.')
+        self.ranges = self._merge(self.ranges + other.ranges)
+
+    def union(self, other):
+        result = SequenceSet(self)
+        result.update(other)
+        return result
+    __or__ = union
+
+    # Special methods
+    def __contains__(self, value):
+        index = bisect.bisect_right(self.ranges, (value, self.STAR)) - 1
+        return index >= 0 and self.ranges[index][0] <= value <= \
+            self.ranges[index][1]
+
+    def __iter__(self):
+        for first, last in self.ranges:
+            if last == self.STAR:
+                raise self.Error('Can not iterate a set with "*".')
+            for value in range(first, last + 1):
+                yield value
+
+    def __len__(self):
+        if self.ranges and self.ranges[-1][1] == self.STAR:
+            raise self.Error('Can not count a set with "*".')
+        return sum(last - first + 1 for first, last in self.ranges)
+
+    def __bool__(self):
+        return self.saved or bool(self.ranges)
+
+    def __eq__(self, other):
+        if not isinstance(other, SequenceSet):
+            return NotImplemented
+        return self.ranges == other.ranges and self.saved == other.saved
+
+    def _range_str(self, first, last):
+        if first == last:
+            return '*' if first == self.STAR else '%d' % first
+        return '%d:%s' % (first, '*' if last == self.STAR else '%d' % last)
+
+    def __str__(self):
+        if self.saved:
+            return self.SAVED
+        return ','.join(self._range_str(first, last)
+                        for first, last in self.ranges)
+
+    def __repr__(self):
+        return '<SequenceSet %s>' % self
+
+    # Command line helpers
+    def chunks(self, max_len):
+        '''Splits the set in strings no longer than max_len characters.
+        The ranges are never split, so a chunk might exceed max_len if a
+        single range is longer than it.
+        '''
+        if self.saved:
+            yield self.SAVED
+            return
+        chunk = []
+        length = 0
+        for first, last in self.ranges:
+            item = self._range_str(first, last)
+            if chunk and length + len(item) + 1 > max_len:
+                yield ','.join(chunk)
+                chunk = []
+                length = 0
+            chunk.append(item)
+            length += len(item) + (1 if length else 0)
+        if chunk:
+            yield ','.join(chunk)
+
+
+class ThreadList(object):
+    '''THREAD response stored on flat arrays.
+
+    The messages are stored in depth first order, the same order they have
+    on the THREAD response, on three parallel arrays:
+
+        * ids - message number or UID;
+        * parents - index, on ids, of the message parent, -1 for the
+          thread roots;
+        * levels - thread depth of each message.
+
+    And, since the messages of each thread are contiguous, the thread
+    boundaries are kept on:
+
+        * roots - index, on ids, of the first message of each thread.
+
+    For instance the response:
+
+        (2)(3 6 (4 23)(44 7 96))
+
+    Is stored as:
+
+        ids     = [2,  3, 6, 4, 23, 44, 7, 96]
+        parents = [-1, -1, 1, 2, 3,  2,  5, 6]
+        levels  = [0,  0, 1, 2, 3,  2,  3, 4]
+        roots   = [0, 1]
+
+    Threads without a root message, like ((3)(5)), have more than one
+    message with level 0.
+    '''
+
+    def __init__(self, text=None):
+        self.ids = array('I')
+        self.parents = array('i')
+        self.levels = array('H')
+        self.roots = array('I')
+        if text:
+            self.parse(text)
+
+    def parse(self, text):
+        '''Parses the THREAD response in a single pass.'''
+        ids = self.ids
+        parents = self.parents
+        levels = self.levels
+        stack = []
+        last = -1
+        for token in thread_token_re.findall(text):
+            if token == '(':
+                if not stack:
+                    self.roots.append(len(ids))
+                stack.append(last)
+            elif token == ')':
+                last = stack.pop()
+            else:
+                ids.append(int(token))
+                parents.append(last)
+                levels.append(levels[last] + 1 if last != -1 else 0)
+                last = len(ids) - 1
+        return self
+
+    @classmethod
+    def from_nested(cls, nested_list):
+        '''Creates a ThreadList from a nested list of message ids, in the
+        same format used by the THREAD response. For instance:
+
+            [[2], [3, 6, [4, 23], [44, 7, 96]]]
+        '''
+        def tokens(item):
+            if isinstance(item, (list, tuple)):
+                yield '('
+                for sub_item in item:
+                    for token in tokens(sub_item):
+                        yield token
+                yield ')'
+            else:
+                yield '%d' % item
+        return cls(' '.join(token for item in nested_list
+                            for token in tokens(item)))
+
+    def thread(self, index):
+        '''Returns the (start, end) slice of the ids of a thread'''
+        start = self.roots[index]
+        if index + 1 < len(self.roots):
+            return start, self.roots[index + 1]
+        return start, len(self.ids)
+
+    def parent_id(self, index):
+        parent = self.parents[index]
+        return self.ids[parent] if parent != -1 else None
+
+    def __iter__(self):
+        '''Yields (message id, level, parent message id) tuples'''
+        ids = self.ids
+        for index, msg_id in enumerate(ids):
+            parent = self.parents[index]
+            yield (msg_id, self.levels[index],
+                   ids[parent] if parent != -1 else None)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, index):
+        return self.ids[index]
+
+    def __repr__(self):
+        return '<ThreadList %d threads, %d messages>' % (len(self.roots),
+                                                        len(self.ids))
@@ -112,6 +112,7 @@ class HtmlSanitize:
                                 'uid': self.message.uid,
                                 'part_number': part.part_number,
                                 })
+                    src += '?v=%s' % self.message.folder.uid_validity()
             elif not self.external_images:
                 self.has_external_images = True
                 src = '/static/img/pixel.png'
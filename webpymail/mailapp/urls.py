@@ -25,7 +25,7 @@
 # Global imports:
 from django.conf.urls import url
 
-from mailapp.views import folder, message_list, message, compose
+from mailapp.views import folder, message_list, message, compose, api
 
 folder_pat = r'FOLDER_(?P<folder>[A-Za-z0-9+.&%_=-]+)'
 
@@ -44,6 +44,20 @@ urlpatterns += [
             name='message_list'),
         ]
 
+# Message actions, JSON views
+urlpatterns += [
+        url(r'^' + folder_pat + r'/api/messages/$', api.message_window,
+            name='mailapp_api_messages'),
+        url(r'^' + folder_pat + r'/api/flags/$', api.set_flags,
+            name='mailapp_api_flags'),
+        url(r'^' + folder_pat + r'/api/move/$', api.move_messages,
+            name='mailapp_api_move'),
+        url(r'^' + folder_pat + r'/api/copy/$', api.copy_messages,
+            name='mailapp_api_copy'),
+        url(r'^' + folder_pat + r'/api/expunge/$', api.expunge,
+            name='mailapp_api_expunge'),
+        ]
+
 # Messages views:
 urlpatterns += [
         url(r'^' + folder_pat + r'/(?P<uid>[\d]+)/$', message.show_message,
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+
+# WebPyMail - IMAP python/django web mail client
+# Copyright (C) 2008 Helder Guerreiro
+
+# This file is part of WebPyMail.
+#
+# WebPyMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WebPyMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WebPyMail.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Helder Guerreiro <helder@tretas.org>
+#
+
+"""JSON views used by the message list to act on messages without
+reloading the page.
+
+The action views only accept POST requests with the same fields as the
+message list form: messages (the UIDs, one field per message), action and
+folder. They use a pooled connection (see mail_utils.pooled_server), so
+usually the only IMAP command sent is the one that does the work.
+
+The message_window view returns a slice of the sorted message list, for
+virtual scrolling. Its responses have an ETag derived from the mailbox state
+and are answered with 304 Not Modified, without any FETCH, while the mailbox
+doesn't change.
+
+The response is a JSON object, on error it has an 'error' key and the HTTP
+status is 400.
+"""
+
+# Imports:
+# Standard lib
+import base64
+import binascii
+import hashlib
+
+# Django
+from django.contrib.auth.decorators import login_required
+from django.http import HttpResponseNotModified, JsonResponse
+from django.views.decorators.http import require_GET, require_POST
+
+# Local
+from .mail_utils import pooled_server
+from .msgactions import (DELETED, SEEN, MARK_READ, MARK_UNREAD, DELETE,
+                         UNDELETE)
+from hlimap.imapmessage import SORT_KEYS, response_flags
+from utils.config import WebpymailConfig
+
+# STORE command of each message list action
+ACTIONS = {MARK_READ: ('+FLAGS', SEEN),
+           MARK_UNREAD: ('-FLAGS', SEEN),
+           DELETE: ('+FLAGS', DELETED),
+           UNDELETE: ('-FLAGS', DELETED)}
+
+# Maximum number of messages returned by message_window
+MAX_WINDOW = 200
+
+
+class RequestError(Exception):
+    pass
+
+
+#
+# Utils
+#
+
+
+def error_response(message):
+    return JsonResponse({'error': message}, status=400)
+
+
+def folder_path(folder):
+    try:
+        return str(base64.urlsafe_b64decode(str(folder)), 'utf-8')
+    except (binascii.Error, UnicodeDecodeError):
+        raise RequestError('Invalid folder')
+
+
+def selected_messages(request):
+    '''UIDs of the messages on the request'''
+    try:
+        messages = [int(Xi) for Xi in request.POST.getlist('messages')]
+    except ValueError:
+        raise RequestError('Invalid message list')
+    if not messages:
+        raise RequestError('No messages selected')
+    return messages
+
+
+def int_param(request, name, default, minimum, maximum):
+    try:
+        value = int(request.GET.get(name, default))
+    except ValueError:
+        raise RequestError('Invalid %s' % name)
+    if not minimum <= value <= maximum:
+        raise RequestError('Invalid %s' % name)
+    return value
+
+
+def sort_program(request):
+    '''Sort program from the query, the same parameters of the message list
+    view: sort_order and sort.
+    '''
+    sort_order = request.GET.get('sort_order', 'DATE').upper()
+    if sort_order not in SORT_KEYS:
+        raise RequestError('Invalid sort order')
+    if request.GET.get('sort', 'DESCENDING').upper() == 'DESCENDING':
+        return '-%s' % sort_order
+    return sort_order
+
+
+def select_folder(M, path, readonly=False):
+    '''Selects a folder. If the pooled connection already had it selected
+    it's selected again, so the mailbox state used by the ETags and the
+    cached message lists has the changes made since the connection was
+    last used.
+    '''
+    return M.get_folder(path, readonly, refresh=True)
+
+
+def mailbox_etag(M, *args):
+    '''ETag of a response that depends only on the mailbox state
+    (UIDVALIDITY, UIDNEXT, EXISTS and, if the server has CONDSTORE,
+    HIGHESTMODSEQ) and on args. Returns None if the server didn't give us
+    the mailbox state.
+
+    Without CONDSTORE the flag changes made by other clients don't change
+    the ETag.
+    '''
+    current = M._imap.sstatus['current_folder']
+    state = tuple(current.get(Xi)
+                  for Xi in ('UIDVALIDITY', 'UIDNEXT', 'EXISTS'))
+    if None in state:
+        return None
+    state += (current.get('HIGHESTMODSEQ'),)
+    key = '\0'.join('%s' % Xi for Xi in state + args)
+    return '"%s"' % hashlib.sha1(bytes(key, 'utf-8')).hexdigest()
+
+
+def etag_matches(request, etag):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH', '')
+    return etag in [Xi.strip() for Xi in if_none_match.split(',')]
+
+
+def message_summary(message, preview=None):
+    envelope = message.envelope
+    date = envelope.get('env_date')
+    return {'uid': message.uid,
+            'subject': envelope.get('env_subject'),
+            'from': envelope.get('env_from'),
+            'to': envelope.get('env_to'),
+            'date': date.isoformat() if date else None,
+            'size': message.size,
+            'flags': list(message.flags),
+            'preview': preview}
+
+
+#
+# Views
+#
+
+
+@login_required
+@require_POST
+def set_flags(request, folder):
+    '''Changes the flags of the messages, action is one of the message list
+    form actions. Returns the new flags, {'flags': {uid: [flag, ...]}}.
+    '''
+    try:
+        path = folder_path(folder)
+        messages = selected_messages(request)
+        command, flag = ACTIONS[int(request.POST.get('action'))]
+    except RequestError as e:
+        return error_response(str(e))
+    except (KeyError, TypeError, ValueError):
+        return error_response('Invalid action')
+
+    with pooled_server(request) as M:
+        folder = M.get_folder(path)
+        # Without .SILENT the server replies with the new flags
+        folder.store(messages, command, (flag,))
+        changed = response_flags(M._imap)
+        flags = dict((uid, changed[uid]) for uid in messages
+                     if uid in changed)
+
+    return JsonResponse({'flags': flags})
+
+
+def transfer(request, folder, move):
+    try:
+        path = folder_path(folder)
+        messages = selected_messages(request)
+        target = folder_path(request.POST.get('folder', ''))
+    except RequestError as e:
+        return error_response(str(e))
+    if target == path:
+        return error_response('The target folder is the current folder')
+
+    with pooled_server(request) as M:
+        folder = M.get_folder(path)
+        if move:
+            folder.move(messages, target)
+        else:
+            folder.copy(messages, target)
+
+    return JsonResponse({'messages': messages})
+
+
+@login_required
+@require_POST
+def move_messages(request, folder):
+    '''Moves the messages to another folder, returns {'messages': [uid,
+    ...]}.
+    '''
+    return transfer(request, folder, True)
+
+
+@login_required
+@require_POST
+def copy_messages(request, folder):
+    '''Copies the messages to another folder, returns {'messages': [uid,
+    ...]}.
+    '''
+    return transfer(request, folder, False)
+
+
+@login_required
+@require_POST
+def expunge(request, folder):
+    '''Expunges the folder, returns the number of messages left,
+    {'exists': n}.
+    '''
+    try:
+        path = folder_path(folder)
+    except RequestError as e:
+        return error_response(str(e))
+
+    with pooled_server(request) as M:
+        folder = M.get_folder(path)
+        folder.expunge()
+        exists = M._imap.sstatus['current_folder'].get('EXISTS')
+
+    return JsonResponse({'exists': exists})
+
+
+@login_required
+@require_GET
+def message_window(request, folder):
+    '''Returns the messages [offset:offset + limit] of the message list
+    sorted according to the sort_order and sort parameters:
+
+        {'total': number of messages,
+         'offset': offset,
+         'messages': [{'uid': ..., 'subject': ..., 'from': ..., 'to': ...,
+                       'date': ..., 'size': ..., 'flags': [...],
+                       'preview': ...}, ...]}
+
+    The response has an ETag, if the request If-None-Match has it the
+    answer is 304 Not Modified, no SORT or FETCH is sent to the server.
+    '''
+    try:
+        path = folder_path(folder)
+        offset = int_param(request, 'offset', 0, 0, 2 ** 32)
+        limit = int_param(request, 'limit', 50, 1, MAX_WINDOW)
+        program = sort_program(request)
+    except RequestError as e:
+        return error_response(str(e))
+    previews = WebpymailConfig(request).getboolean('interface',
+                                                   'message_preview')
+
+    with pooled_server(request) as M:
+        folder = select_folder(M, path, readonly=True)
+        etag = mailbox_etag(M, request.session['username'], path, program,
+                            offset, limit, previews)
+        if etag is not None and etag_matches(request, etag):
+            response = HttpResponseNotModified()
+        else:
+            message_list = folder.message_list
+            message_list.set_sort_program(program)
+            total, messages = message_list.get_window(offset,
+                                                      offset + limit)
+            preview = (M.message_previews(folder,
+                                          [Xi.uid for Xi in messages])
+                       if previews and messages else {})
+            response = JsonResponse({
+                'total': total,
+                'offset': offset,
+                'messages': [message_summary(Xi, preview.get(Xi.uid))
+                             for Xi in messages]})
+
+    if etag is not None:
+        response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+    return response
@@ -310,7 +310,7 @@ def send_message(request, text='', to_addr='', cc_addr='', bcc_addr='',
 def get_message(request, folder, uid):
     server = serverLogin(request)
     folder_name = base64.urlsafe_b64decode(str(folder))
-    folder = server[folder_name]
+    folder = server.get_folder(folder_name, readonly=True)
     return folder[int(uid)]
 
 
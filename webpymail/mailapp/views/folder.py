@@ -61,6 +61,9 @@ def show_folders_view(request):
 
     # Read the subscribed folder list:
     M.refresh_folders(subscribed=True)
+    # Remember the hierarchy delimiter, with it the other views can select
+    # the folders without listing them
+    request.session['delimiter'] = M.folder_tree.dl
 
     # Get the default identity
     config = WebpymailConfig(request)
@@ -74,7 +77,7 @@ def show_folders_view(request):
 
 @login_required
 def set_folder_expand(request, folder):
-    folder_name = base64.urlsafe_b64decode(str(folder))
+    folder_name = str(base64.urlsafe_b64decode(str(folder)), 'utf-8')
     user = request.user
 
     obj_filter = FoldersToExpand.objects.filter
@@ -90,7 +93,7 @@ def set_folder_expand(request, folder):
 
 @login_required
 def set_folder_collapse(request, folder):
-    folder_name = base64.urlsafe_b64decode(str(folder))
+    folder_name = str(base64.urlsafe_b64decode(str(folder)), 'utf-8')
     user = request.user
     FoldersToExpand.objects.filter(user__exact=user,
                                    folder_name__exact=folder_name).delete()
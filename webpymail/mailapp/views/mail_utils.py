@@ -28,12 +28,16 @@
 # Imports
 
 # Sys
+import contextlib
+import functools
+import os.path
 import time
 import textwrap
 import uuid
 
 # Django
 from django.conf import settings
+from django.core.cache import cache
 from django.http import Http404
 
 # Mail
@@ -47,6 +51,8 @@ from email.mime.message import MIMEMessage
 from email import message_from_file
 
 from hlimap import ImapServer
+from hlimap.pool import ServerPool
+from imaplib2.replay import IMAP4_Record, IMAP4_SSL_Record
 
 HAS_SMTP_SSL = False
 try:
@@ -57,12 +63,45 @@ except ImportError:
     from smtplib import SMTP
 
 
+def record_imap_class(ssl):
+    """Returns the IMAP connection class used to record the session, or None
+    if the sessions are not to be recorded.
+    """
+    record_dir = getattr(settings, 'IMAP_RECORD_DIR', None)
+    if not record_dir:
+        return None
+    record_file = os.path.join(record_dir, '%s-%s.rpl' % (
+        time.strftime('%Y%m%d%H%M%S'), uuid.uuid4().hex[:8]))
+    if ssl:
+        return functools.partial(IMAP4_SSL_Record, record_file=record_file)
+    return functools.partial(IMAP4_Record, record_file=record_file)
+
+
 def serverLogin(request):
     """Login to the server
     """
+    folder_cache_timeout = getattr(settings, 'FOLDER_CACHE_TIMEOUT', None)
+    index_cache_timeout = getattr(settings, 'SORT_INDEX_CACHE_TIMEOUT', None)
+    order_cache_timeout = getattr(settings, 'MESSAGE_LIST_CACHE_TIMEOUT',
+                                  None)
+    preview_cache_timeout = getattr(settings, 'PREVIEW_CACHE_TIMEOUT', None)
+
     # Login to the server:
     M = ImapServer(host=request.session['host'], port=request.session['port'],
-                   ssl=request.session['ssl'])
+                   ssl=request.session['ssl'],
+                   imap_class=record_imap_class(request.session['ssl']),
+                   delimiter=request.session.get('delimiter'),
+                   utf8=getattr(settings, 'IMAP_UTF8_ACCEPT', False),
+                   folder_cache=cache if folder_cache_timeout else None,
+                   folder_cache_timeout=folder_cache_timeout,
+                   lazy_folders=getattr(settings, 'FOLDER_LAZY_LOADING',
+                                        False),
+                   index_cache=cache if index_cache_timeout else None,
+                   index_cache_timeout=index_cache_timeout,
+                   order_cache=cache if order_cache_timeout else None,
+                   order_cache_timeout=order_cache_timeout,
+                   preview_cache=cache if preview_cache_timeout else None,
+                   preview_cache_timeout=preview_cache_timeout)
 
     try:
         M.login(request.session['username'],
@@ -77,6 +116,53 @@ def serverLogin(request):
         raise Http404
 
 
+# Logged in connections kept between requests, see pooled_server
+if getattr(settings, 'IMAP_POOL_MAX_IDLE', None):
+    server_pool = ServerPool(max_idle=settings.IMAP_POOL_MAX_IDLE,
+                             max_size=getattr(settings, 'IMAP_POOL_SIZE', 50))
+else:
+    server_pool = None
+
+
+def pool_key(request):
+    """Key of the user session connections on the pool"""
+    return (request.session.session_key, request.session['username'],
+            request.session['host'], request.session['port'])
+
+
+def discard_pooled_servers(request):
+    """Logs out the pooled connections of the user session, used when the
+    user logs out.
+    """
+    if server_pool is not None and 'username' in request.session:
+        server_pool.discard_key(pool_key(request))
+
+
+@contextlib.contextmanager
+def pooled_server(request):
+    """Context manager that gives a logged in server, taken from the
+    connection pool if there's an idle one for the user session. The
+    folder selected on the last use is still selected. The server goes
+    back to the pool unless an exception is raised::
+
+        with pooled_server(request) as M:
+            folder = M.get_folder(folder_name)
+            ...
+    """
+    key = pool_key(request)
+    M = server_pool.acquire(key) if server_pool is not None else None
+    if M is None:
+        M = serverLogin(request)
+    try:
+        yield M
+    except:
+        if server_pool is not None:
+            server_pool.discard(M)
+        raise
+    if server_pool is not None:
+        server_pool.release(key, M)
+
+
 def join_address_list(addr_list):
     '''Returns a comma separated list of mail addresses.
 
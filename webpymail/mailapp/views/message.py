@@ -25,15 +25,22 @@
 
 # Global Imports
 import base64
+import hashlib
+import re
 # Django:
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
+from django.http import Http404
 from django.http import HttpResponse
+from django.http import HttpResponseNotModified
 from django.http import HttpResponseRedirect
 from django.shortcuts import redirect
 from django.utils.translation import gettext_lazy as _
 
 # Local
-from .mail_utils import serverLogin
+from .api import etag_matches
+from .mail_utils import pooled_server, serverLogin
+from hlimap.part_range import part_range, range_encodings
 from themesapp.shortcuts import render
 from utils.config import WebpymailConfig
 from . import msgactions
@@ -83,7 +90,7 @@ def message_header(request, folder, uid):
     folder_name = base64.urlsafe_b64decode(str(folder))
 
     M = serverLogin(request)
-    folder = M[folder_name]
+    folder = M.get_folder(folder_name, readonly=True)
     message = folder[int(uid)]
 
     return render(request, 'mail/message_header.html', {'folder': folder,
@@ -97,8 +104,8 @@ def message_structure(request, folder, uid):
     folder_name = base64.urlsafe_b64decode(str(folder))
 
     M = serverLogin(request)
-    folder = M[folder_name]
-    message = folder[int(uid)]
+    folder = M.get_folder(folder_name, readonly=True)
+    message = folder.get_message(int(uid), 'action')
 
     return render(request, 'mail/message_structure.html', {'folder': folder,
                                                            'message': message})
@@ -111,8 +118,8 @@ def message_source(request, folder, uid):
     folder_name = base64.urlsafe_b64decode(str(folder))
 
     M = serverLogin(request)
-    folder = M[folder_name]
-    message = folder[int(uid)]
+    folder = M.get_folder(folder_name, readonly=True)
+    message = folder.get_message(int(uid), 'action')
     # Assume that we have a single byte encoded string, this is because there
     # can be several different files with different encodings within the same
     # message.
@@ -125,20 +132,42 @@ def message_source(request, folder, uid):
                    'source': source})
 
 
-@login_required
-def get_msg_part(request, folder, uid, part_number, inline=False):
-    '''Gets a message part.
-    '''
-    folder_name = base64.urlsafe_b64decode(str(folder))
+# The message parts never change while the folder UIDVALIDITY stays the same.
+# The part URLs have the UIDVALIDITY on the v parameter, these responses can
+# be kept by the browser for a long time.
+PART_CACHE_CONTROL = 'private, max-age=31536000, immutable'
 
-    M = serverLogin(request)
-    folder = M[folder_name]
-    message = folder[int(uid)]
-    part = message.bodystructure.find_part(part_number)
+range_re = re.compile(r'^bytes=(\d+)-(\d*)$')
+
+
+def part_etag(request, path, uid_validity, uid, part_number, inline):
+    key = '\0'.join('%s' % Xi for Xi in (
+        request.session['username'], request.session['host'],
+        request.session['port'], path, uid_validity, uid, part_number,
+        inline))
+    return '"%s"' % hashlib.sha1(bytes(key, 'utf-8')).hexdigest()
 
-    response = HttpResponse(content_type='%s/%s' % (part.media,
-                                                    part.media_subtype))
 
+def request_range(request, etag):
+    '''Returns the (first, last) bytes asked for on the Range header, last
+    is None for the end of the part. Returns None if there's no Range header,
+    if it isn't a single range from a known position or if If-Range doesn't
+    match the ETag.
+    '''
+    match = range_re.match(request.META.get('HTTP_RANGE', '').strip())
+    if not match:
+        return None
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range is not None and if_range.strip() != etag:
+        return None
+    first = int(match.group(1))
+    last = int(match.group(2)) if match.group(2) else None
+    if last is not None and last < first:
+        return None
+    return first, last
+
+
+def part_headers(response, part, inline, etag, cache_control):
     if part.filename():
         filename = part.filename()
     else:
@@ -156,9 +185,98 @@ def get_msg_part(request, folder, uid, part_number, inline=False):
     else:
         response['Content-Type'] = '%s/%s' % (part.media, part.media_subtype)
 
+    response['ETag'] = etag
+    response['Cache-Control'] = cache_control
+    return response
+
+
+def part_response(request, M, folder, uid, part_number, inline, etag,
+                  cache_control):
+    '''Response with a message part, or with a range of it if the request
+    asks for one, see get_msg_part.
+    '''
+    message = folder.get_message(uid, 'action')
+    part = message.bodystructure.find_part(part_number)
+    ranges = (part.media.upper() != 'TEXT' and
+              (part.body_fld_enc or '').upper() in range_encodings())
+
+    byte_range = request_range(request, etag) if ranges else None
+    if byte_range is not None:
+        first, last = byte_range
+        # An open range is answered with at most PART_RANGE_MAX_LENGTH
+        # bytes, the client asks for the rest if it needs it
+        max_length = (getattr(settings, 'PART_RANGE_MAX_LENGTH', None)
+                      if last is None else None)
+        result = part_range(M._imap, message.uid, part, first, last,
+                            max_length)
+        if result is not None:
+            data, first, last, size = result
+            response = HttpResponse(data, status=206)
+            response['Content-Range'] = 'bytes %d-%d/%d' % (first, last,
+                                                             size)
+            response['Accept-Ranges'] = 'bytes'
+            return part_headers(response, part, inline, etag, cache_control)
+
+    response = part_headers(HttpResponse(), part, inline, etag,
+                            cache_control)
+    if ranges:
+        response['Accept-Ranges'] = 'bytes'
     response.write(message.part(part))
     response.close()
+    return response
+
 
+@login_required
+def get_msg_part(request, folder, uid, part_number, inline=False):
+    '''Gets a message part.
+
+    The response has a strong ETag, built from the folder UIDVALIDITY, the
+    message UID and the part number. If the URL has the UIDVALIDITY on the v
+    parameter, and If-None-Match has the ETag, the answer is 304 Not Modified
+    and the IMAP server isn't contacted.
+
+    The parts that aren't text, with transfer encoding 7BIT or BASE64, can be
+    asked for by ranges (Range: bytes=first-last), only the range is fetched
+    from the server (see hlimap.part_range).
+    '''
+    folder_name = base64.urlsafe_b64decode(str(folder))
+    path = str(folder_name, 'utf-8')
+    uid = int(uid)
+    version = request.GET.get('v', '')
+    if version.isdigit():
+        version = int(version)
+        cache_control = PART_CACHE_CONTROL
+        etag = part_etag(request, path, version, uid, part_number, inline)
+        if etag_matches(request, etag):
+            response = HttpResponseNotModified()
+            response['ETag'] = etag
+            response['Cache-Control'] = cache_control
+            return response
+    else:
+        version = None
+        cache_control = 'private, no-cache'
+
+    with pooled_server(request) as M:
+        folder = M.get_folder(folder_name, readonly=True)
+        uid_validity = M._imap.sstatus['current_folder'].get('UIDVALIDITY')
+        # If the UIDs were reassigned this URL is no longer valid, the 404
+        # is raised outside the block so the connection goes back to the
+        # pool
+        expired = version is not None and version != uid_validity
+        if not expired:
+            etag = part_etag(request, path, uid_validity, uid, part_number,
+                             inline)
+            if etag_matches(request, etag):
+                response = HttpResponseNotModified()
+                response['ETag'] = etag
+                response['Cache-Control'] = cache_control
+            else:
+                response = part_response(request, M, folder, uid,
+                                         part_number, inline, etag,
+                                         cache_control)
+
+    if expired:
+        raise Http404
     return response
 
 
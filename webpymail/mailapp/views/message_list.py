@@ -37,7 +37,7 @@ from .mail_utils import serverLogin
 from themesapp.shortcuts import render
 from utils.config import WebpymailConfig
 from . import msgactions
-from hlimap.imapmessage import SORT_KEYS
+from hlimap.imapmessage import SORT_KEYS, THREAD_ALGORITHMS
 
 #
 # Views
@@ -48,9 +48,11 @@ from hlimap.imapmessage import SORT_KEYS
 def show_message_list_view(request, folder=settings.DEFAULT_FOLDER):
     '''Show the selected Folder message list.
     '''
+    config = WebpymailConfig(request)
     M = serverLogin(request)
     folder_name = base64.urlsafe_b64decode(str(folder))
-    folder = M[folder_name]
+    # The message list is only changed on POST requests
+    folder = M.get_folder(folder_name, readonly=request.method != 'POST')
     message_list = folder.message_list
 
     # Set the search criteria:
@@ -67,6 +69,10 @@ def show_message_list_view(request, folder=settings.DEFAULT_FOLDER):
     show_style = request.GET.get('show_style', 'sorted')
     if show_style.upper() == 'THREADED':
         message_list.set_threaded()
+        thread_alg = request.GET.get(
+            'thread_alg', config.get('interface', 'thread_algorithm')).upper()
+        if thread_alg in THREAD_ALGORITHMS:
+            message_list.set_thread_alg(thread_alg)
 
     sort_order = request.GET.get('sort_order', 'DATE').upper()
     sort = request.GET.get('sort', 'DESCENDING').upper()
@@ -87,6 +93,9 @@ def show_message_list_view(request, folder=settings.DEFAULT_FOLDER):
     if 'page' in query:
         query.pop('page')
 
+    if config.getboolean('interface', 'message_preview'):
+        message_list.set_previews()
+
     # Pagination
     message_list.paginator.msg_per_page = 40
     message_list.paginator.current_page = page
@@ -99,15 +108,12 @@ def show_message_list_view(request, folder=settings.DEFAULT_FOLDER):
     # If it's a POST request
     if request.method == 'POST':
         msgactions.batch_change(request, folder, raw_message_list)
-        # TODO: When setting message flags the MessageList's messages objects
-        # are not updated, so we have to refresh the messages to reflect the
-        # changes in the message list. This should not be necessary, the set
-        # and reset flags method in the Folder objects should update the
-        # message information, saving this way a refresh_messages call.
-        message_list.refresh_messages()
+        # The flag changes are applied to the message list in place, it's
+        # only retrieved again if the folder changed (see Folder.store)
+        if message_list.refresh:
+            message_list.refresh_messages()
 
     # Get the default identity
-    config = WebpymailConfig(request)
     identity_list = config.identities()
     default_address = identity_list[0]['mail_address']
 
@@ -90,10 +90,11 @@ def batch_change(request, folder, message_list):
         folder.reset_flags(selected_messages, SEEN)
 
     if 'move' in new_data or 'copy' in new_data:
-        if folder.url() == form.cleaned_data['folder']:
+        target_folder = str(base64.urlsafe_b64decode(
+                str(form.cleaned_data['folder'])), 'utf-8')
+        if folder.path == target_folder:
             return
-        target_folder = base64.urlsafe_b64decode(
-                str(form.cleaned_data['folder']))
-        folder.copy(selected_messages, target_folder)
         if 'move' in new_data:
-            folder.set_flags(selected_messages, DELETED)
+            folder.move(selected_messages, target_folder)
+        else:
+            folder.copy(selected_messages, target_folder)
@@ -0,0 +1,119 @@
+/*
+ * Message list actions
+ *
+ * The tools menu actions are sent to the JSON views (mailapp/views/api.py)
+ * and the message rows are updated in place, the page isn't reloaded.
+ * Without fetch support the form is posted as usual.
+ */
+
+/* Utils */
+
+function selected_messages(form) {
+    return form.find('input[name=messages]:checked').map( function() {
+        return this.value;
+    }).get();
+};
+
+function post_action(form, url, messages, data) {
+    var body = new URLSearchParams();
+    $.each(messages, function(i, uid) {
+        body.append('messages', uid);
+    });
+    $.each(data, function(key, value) {
+        body.append(key, value);
+    });
+    return fetch(url, {
+        method: 'POST',
+        credentials: 'same-origin',
+        headers: {'X-CSRFToken':
+                  form.find('input[name=csrfmiddlewaretoken]').val()},
+        body: body
+    }).then( function(response) {
+        return response.json().then( function(result) {
+            if (!response.ok) {
+                throw new Error(result.error || response.statusText);
+            };
+            return result;
+        });
+    });
+};
+
+function message_row(uid) {
+    return $('div[data-uid="' + uid + '"]');
+};
+
+function update_flags(flags) {
+    $.each(flags, function(uid, message_flags) {
+        var subject = message_row(uid).find('div.subject');
+        var seen = message_flags.indexOf('\\Seen') != -1;
+        subject.toggleClass('seen', seen);
+        subject.toggleClass('not_seen', !seen);
+        subject.toggleClass('deleted',
+                            message_flags.indexOf('\\Deleted') != -1);
+    });
+};
+
+function remove_messages(messages) {
+    $.each(messages, function(i, uid) {
+        message_row(uid).remove();
+    });
+};
+
+/* Initialization */
+
+$(function() {
+    var form = $('#message_list_form');
+    var clicked = null;
+
+    if (!form.length || !window.fetch) {
+        return;
+    };
+
+    form.find('input[type=submit]').click( function() {
+        clicked = this.name;
+    });
+
+    form.submit( function(event) {
+        var messages = selected_messages(form);
+        var action = clicked;
+        var request = null;
+
+        if (action == 'expunge') {
+            request = post_action(form, form.data('api-expunge'), [], {}
+            ).then( function() {
+                $('div.subject.deleted').closest('div[data-uid]').remove();
+            });
+        } else if (!messages.length) {
+            event.preventDefault();
+            return;
+        } else if (action == 'apply') {
+            if (form.find('[name=action]').val() == '0') {
+                event.preventDefault();
+                return;
+            };
+            request = post_action(form, form.data('api-flags'), messages,
+                                  {action: form.find('[name=action]').val()}
+            ).then( function(result) {
+                update_flags(result.flags);
+            });
+        } else if (action == 'move' || action == 'copy') {
+            request = post_action(form, form.data('api-' + action),
+                                  messages,
+                                  {folder: form.find('[name=folder]').val()}
+            ).then( function(result) {
+                if (action == 'move') {
+                    remove_messages(result.messages);
+                };
+            });
+        } else {
+            return;
+        };
+
+        event.preventDefault();
+        request.then( function() {
+            form.find('input[name=messages]').prop('checked', false);
+        }).catch( function(error) {
+            alert(error.message);
+        });
+    });
+});
@@ -212,6 +212,74 @@ TEXTAREACOLS = 60
 
 TEMPDIR = '/tmp'  # Temporary dir to store the attachements
 
+# IMAP session recording. If defined, each IMAP session is recorded to a
+# replay file on this directory. The replay files can be used to benchmark
+# webpymail offline (see imaplib2.replay). The credentials are redacted.
+IMAP_RECORD_DIR = None
+
+# IMAP command metrics. The metrics aggregated on each worker process are
+# available on /metrics/ (Prometheus text format, or JSON with
+# ?format=json), only to the addresses on this list. The address checked is
+# REMOTE_ADDR: behind a reverse proxy every request comes from the proxy
+# address, so the list doesn't restrict anything, set METRICS_TOKEN too.
+METRICS_ALLOWED_IPS = ('127.0.0.1', '::1')
+
+# If set, the metrics requests must also have the header
+# "Authorization: Bearer <METRICS_TOKEN>".
+METRICS_TOKEN = None
+
+# Enable UTF8=ACCEPT (RFC6855) on the servers that support it, the mailbox
+# names are then exchanged in UTF-8 instead of modified UTF-7. This costs an
+# extra ENABLE command for each IMAP session.
+IMAP_UTF8_ACCEPT = False
+
+# Folder list cache. The folder list of each user is kept on the Django
+# default cache for this many seconds, so the folders aren't listed on every
+# page. The cache is cleared when the folders are changed through webpymail,
+# changes made by other mail clients can take this long to show up. Set to
+# None to disable the cache.
+FOLDER_CACHE_TIMEOUT = 300
+
+# List the folders level by level: only the top level folders and the sub
+# folders of the expanded folders are retrieved from the server. Use it on
+# servers with a very large number of folders.
+FOLDER_LAZY_LOADING = False
+
+# Sort index cache. On servers without the SORT extension the sort keys of the
+# messages of each folder are kept on the Django default cache for this many
+# seconds, only the new messages are fetched to sort the message list. The
+# index of a large folder can be a few MB, make sure the cache backend accepts
+# entries this big (memcached doesn't by default). Set to None to disable the
+# cache.
+SORT_INDEX_CACHE_TIMEOUT = 86400
+
+# Message list cache. The result of the SEARCH, SORT or THREAD command used
+# to build a message list is kept on the Django default cache for this many
+# seconds, so moving between pages doesn't repeat the command. The cached
+# list is only used while the mailbox doesn't change (UIDVALIDITY, UIDNEXT,
+# EXISTS and, for searches other than ALL, HIGHESTMODSEQ). Set to None to
+# disable the cache.
+MESSAGE_LIST_CACHE_TIMEOUT = 300
+
+# Message preview cache. The previews shown on the message list (see the
+# message_preview option on the [interface] section of the configuration) are
+# kept on the Django default cache for this many seconds, by folder,
+# UIDVALIDITY and UID. Set to None to disable the cache.
+PREVIEW_CACHE_TIMEOUT = 86400
+
+# Connection pool. The message actions of the message list (changing flags,
+# moving, copying and expunging messages) reuse the IMAP connection of the
+# previous action of the same session, kept logged in and with the folder
+# selected for this many seconds. Each worker process has its own pool of at
+# most IMAP_POOL_SIZE idle connections. Set to None to disable the pool.
+IMAP_POOL_MAX_IDLE = 300
+IMAP_POOL_SIZE = 50
+
+# Message part ranges. The attachments can be downloaded by byte ranges (HTTP
+# Range requests), only the range is fetched from the IMAP server. A range
+# without end is answered with at most this many bytes, None for no limit.
+PART_RANGE_MAX_LENGTH = 4 * 1024 * 1024
+
 # User configuration directories:
 CONFIGDIR = os.path.join(DJANGO_DIR, 'config')
 USERCONFDIR = os.path.join(CONFIGDIR, 'users')
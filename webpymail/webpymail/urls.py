@@ -30,13 +30,15 @@ from django.conf.urls import include, url
 
 # Local Imports
 from mailapp.views.message import index, not_implemented
-from webpymail.views import about
+from webpymail.views import about, imap_metrics
 
 urlpatterns = [
         # Root:
         url(r'^$', index),
         # About:
         url(r'^about/', about, name='about'),
+        # IMAP metrics:
+        url(r'^metrics/$', imap_metrics, name='imap_metrics'),
         # Mail Interface:
         url(r'^mail/', include('mailapp.urls')),
         # Address book:
@@ -26,9 +26,14 @@ will not work with the themes app so we create them here.
 '''
 
 # Imports:
+import hmac
+
 # Django
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden, JsonResponse
 
 # Local
+from imaplib2.metrics import process_metrics
 from themesapp.shortcuts import render
 
 #
@@ -40,3 +45,27 @@ def about(request):
     '''Show the account folders.
     '''
     return render(request, 'base/about.html')
+
+
+def imap_metrics(request):
+    '''IMAP command metrics aggregated on this worker process.
+
+    The metrics are returned in the Prometheus text format, or as JSON if
+    the query string has format=json. Only the addresses on
+    settings.METRICS_ALLOWED_IPS can access this view and, if
+    settings.METRICS_TOKEN is set, the request must have the header
+    "Authorization: Bearer <token>".
+    '''
+    allowed_ips = getattr(settings, 'METRICS_ALLOWED_IPS', ())
+    if request.META.get('REMOTE_ADDR') not in allowed_ips:
+        return HttpResponseForbidden()
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    if token and not hmac.compare_digest(
+            bytes(request.META.get('HTTP_AUTHORIZATION', ''), 'utf-8'),
+            bytes('Bearer %s' % token, 'utf-8')):
+        return HttpResponseForbidden()
+
+    if request.GET.get('format') == 'json':
+        return JsonResponse(process_metrics.as_dict())
+    return HttpResponse(process_metrics.prometheus(),
+                        content_type='text/plain; version=0.0.4')
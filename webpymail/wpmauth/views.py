@@ -36,6 +36,7 @@ from django.views.decorators.csrf import csrf_protect
 from themesapp.shortcuts import render
 from .forms import LoginForm
 from utils.config import server_config, WebpymailConfig
+from mailapp.views.mail_utils import discard_pooled_servers
 
 
 @csrf_protect
@@ -120,7 +121,9 @@ def logoutView(request):
         logout_page = config.get('general', 'logout_page')
     except KeyError:
         logout_page = '/'
-    # Do the actual logout
+    # Do the actual logout, the IMAP connections kept for the session
+    # are closed too
+    discard_pooled_servers(request)
     request.session.modified = True
     logout(request)
     # Redirect to a success page.